@@ -0,0 +1,120 @@
+"""
+Micro-benchmark of the upload chunk validation of the API.
+
+Compares validate_chunk (swgts_api/validation.py) with the nested per-pair/per-read loop the upload handlers used
+before, on synthetic chunks of short (Illumina-like, optionally paired) and long (ONT-like) reads. Both include joining
+the lines into the job element, which enqueue_chunks does after validate_chunk. Only needs the standard library, the
+validation and config modules are loaded from their files so neither flask nor redis have to be installed.
+
+validate_chunk is not faster: it additionally checks that every line is a string without a line break (the old loop let
+those through to the filter), which costs about 1.2-1.4x the time of the old loop. Checking whole levels of the chunk
+with map/chain/set instead only brought it back to 0.9x, so the simpler loop was kept.
+
+    python benchmark_validation.py --repeat 20
+"""
+import argparse
+import importlib.util
+import os
+import random
+import timeit
+from typing import Any
+
+REPOSITORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+API_DIRECTORY = os.path.join(REPOSITORY, 'swgts-backend', 'swgts_api', 'src', 'swgts_api')
+
+
+def load_module(name: str):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(API_DIRECTORY, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_validation():
+    return load_module('validation')
+
+
+# The default buffer size of the API, the longest read it accepts
+MAXIMUM_READ_LENGTH = load_module('config').MAXIMUM_PENDING_BYTES
+
+
+def legacy_validate(chunk: Any, pair_count: int, maximum_read_length: int):
+    """The loop of post_context_reads / handle_data_upload before the validation module, without the redis calls."""
+    if not isinstance(chunk, list):
+        return 'Passed read chunks are not in list format.'
+    effective_cumulated_chunk_size = 0
+    pairs_short_enough = []
+    for pair in chunk:
+        if not isinstance(pair, list):
+            return 'There is a pair which is not a list.'
+        if len(pair) != pair_count:
+            return f'Expected {pair_count}-paired reads but found pair with {len(pair)} reads.'
+        filtered_pair = []
+        for read in pair:
+            if not isinstance(read, list):
+                return 'There is a read which is not a list.'
+            if len(read) != 4:
+                return 'There is a read with a length != 4.'
+            if len(read[1]) <= maximum_read_length:
+                effective_cumulated_chunk_size += len(read[1])
+                filtered_pair.append(read)
+            else:
+                break
+        else:
+            pairs_short_enough.append(filtered_pair)
+    return pairs_short_enough, effective_cumulated_chunk_size, encode(pairs_short_enough)
+
+
+def encode(pairs: list[list[list[str]]]) -> str:
+    """The job element enqueue_chunks builds from the pairs."""
+    return '\n'.join(line for reads in pairs for read in reads for line in read)
+
+
+def validate(validation, chunk: Any, pair_count: int, maximum_read_length: int):
+    validated = validation.validate_chunk(chunk, pair_count, maximum_read_length)
+    return validated.pairs, validated.size, encode(validated.pairs)
+
+
+def make_chunk(rng: random.Random, pairs: int, pair_count: int, mean_length: int) -> list[list[list[str]]]:
+    chunk = []
+    for index in range(pairs):
+        pair = []
+        for mate in range(pair_count):
+            length = max(1, int(rng.gauss(mean_length, mean_length / 10)))
+            sequence = ''.join(rng.choices('ACGT', k=length))
+            pair.append([f'@read{index}/{mate + 1}', sequence, '+', 'I' * length])
+        chunk.append(pair)
+    return chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs per workload (best is reported)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    validation = load_validation()
+    rng = random.Random(args.seed)
+    # name, pairs per chunk, mates per pair, mean read length; roughly one request worth of data each
+    workloads = [
+        ('illumina single', 5000, 1, 150),
+        ('illumina paired', 2500, 2, 150),
+        ('ont', 100, 1, 8000),
+    ]
+
+    print(f'{"workload":<18}{"reads":>8}{"legacy ms":>12}{"current ms":>12}{"speedup":>10}')
+    for name, pairs, pair_count, mean_length in workloads:
+        chunk = make_chunk(rng, pairs, pair_count, mean_length)
+        assert validate(validation, chunk, pair_count, MAXIMUM_READ_LENGTH) == \
+               legacy_validate(chunk, pair_count, MAXIMUM_READ_LENGTH)
+
+        legacy = min(timeit.repeat(lambda: legacy_validate(chunk, pair_count, MAXIMUM_READ_LENGTH),
+                                   number=1, repeat=args.repeat))
+        current = min(timeit.repeat(lambda: validate(validation, chunk, pair_count, MAXIMUM_READ_LENGTH),
+                                    number=1, repeat=args.repeat))
+        print(f'{name:<18}{pairs * pair_count:>8}{legacy * 1000:>12.2f}{current * 1000:>12.2f}'
+              f'{legacy / current:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
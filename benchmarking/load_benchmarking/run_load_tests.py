@@ -0,0 +1,338 @@
+"""
+Offline end-to-end load test of the API + filter stack.
+
+Starts a local redis-server on a free port, the filter server (FILTER_MODE 'NONE' or 'COMBINED' with a small index
+built from example_data/) and the API, then lets N simulated clients upload a FASTQ file concurrently over HTTP and/or
+socket.io. Reports throughput, per-request latencies, 413/422 rates and time-to-close. Needs the swgts_api and
+swgts_filter packages, a redis-server binary and the packages in requirements.txt.
+
+    python run_load_tests.py --clients 8 --mode both --output load_test_results.json
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Any, Optional
+
+import httpx
+import socketio
+from redis import Redis
+
+REPOSITORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+DEFAULT_READS = os.path.join(REPOSITORY, 'example_data', 'example_cov_ont_reads.fq')
+PATHOGEN_REFERENCE = os.path.join(REPOSITORY, 'example_data', 'EPI_ISL_402124.fasta.gz')
+PATHOGEN_CONTIG = 'hCoV-19/Wuhan/WIV04/2019|EPI_ISL_402124'
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_records(filepath: str) -> list[list[str]]:
+    with open(filepath) as handle:
+        lines = handle.read().splitlines()
+    return [lines[i:i + 4] for i in range(0, len(lines) - 3, 4)]
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+    pick = lambda fraction: values[min(len(values) - 1, int(fraction * len(values)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1], 'count': len(values)}
+
+
+class Stack:
+    """redis-server, filter server and api running as child processes in a temporary working directory."""
+
+    def __init__(self, filter_mode: str, maximum_pending_bytes: int, request_size_factor: int, worker_threads: int):
+        self.directory = tempfile.mkdtemp(prefix='swgts-load-test-')
+        self.redis_port = get_free_port()
+        self.api_port = get_free_port()
+        self.api_url = f'http://127.0.0.1:{self.api_port}'
+        self.processes: list[subprocess.Popen] = []
+
+        input_directory = os.path.join(self.directory, 'input')
+        os.makedirs(os.path.join(self.directory, 'output'))
+        os.makedirs(input_directory)
+        with open(os.path.join(input_directory, 'config_api.py'), 'w') as handle:
+            handle.write(f"REDIS_SERVER = '127.0.0.1'\n"
+                         f"REDIS_PORT = {self.redis_port}\n"
+                         f"HANDS_OFF = True\n"
+                         f"MAXIMUM_PENDING_BYTES = {maximum_pending_bytes}\n"
+                         f"REQUEST_SIZE_FACTOR = {request_size_factor}\n")
+        with open(os.path.join(input_directory, 'config_filter.py'), 'w') as handle:
+            handle.write(f"REDIS_SERVER = '127.0.0.1'\n"
+                         f"REDIS_PORT = {self.redis_port}\n"
+                         f"API_BASE_URL = '{self.api_url}/api/'\n"
+                         f"WORKER_THREADS = {worker_threads}\n"
+                         f"LOG_FILE = 'filter.log'\n"
+                         f"FILTER_MODE = '{filter_mode}'\n"
+                         # mappy builds the index from the FASTA on startup, which takes a second for this genome
+                         f"MINIMAP2_REFERENCE_DATABASE = {PATHOGEN_REFERENCE!r}\n"
+                         f"MINIMAP2_POSITIVE_CONTIG = {PATHOGEN_CONTIG!r}\n")
+
+    def _spawn(self, name: str, command: list[str]) -> None:
+        log = open(os.path.join(self.directory, f'{name}.out'), 'w')
+        self.processes.append(subprocess.Popen(command, cwd=self.directory, stdout=log, stderr=subprocess.STDOUT))
+
+    def start(self) -> None:
+        if shutil.which('redis-server') is None:
+            raise RuntimeError('redis-server was not found in PATH.')
+        self._spawn('redis', ['redis-server', '--port', str(self.redis_port), '--save', '', '--appendonly', 'no'])
+        redis_server = Redis(host='127.0.0.1', port=self.redis_port)
+        self._wait_for(lambda: redis_server.ping(), 'redis')
+
+        # The api writes the shared config values the filter waits for, the filter announces that it is ready
+        self._spawn('api', [sys.executable, '-c',
+                            'from swgts_api.app import app, socketio; '
+                            f"socketio.run(app, host='127.0.0.1', port={self.api_port}, debug=False)"])
+        self._wait_for(lambda: httpx.get(f'{self.api_url}/api/server-status').status_code == 200, 'api')
+        self._spawn('filter', [sys.executable, '-m', 'swgts_filter.server'])
+        self._wait_for(lambda: redis_server.zcount('filter:ready', time.time(), '+inf') > 0, 'filter')
+        print(f'Stack is running in {self.directory} (api {self.api_url}, redis port {self.redis_port})')
+
+    def _wait_for(self, check, name: str, timeout: float = 120) -> None:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for process in self.processes:
+                if process.poll() is not None:
+                    raise RuntimeError(f'A child process exited early, see the logs in {self.directory}')
+            try:
+                if check():
+                    return
+            except Exception:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f'{name} did not come up within {timeout} seconds, see the logs in {self.directory}')
+
+    def stop(self) -> None:
+        # The filter shuts down gracefully on SIGINT, the others don't care
+        for process in reversed(self.processes):
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in reversed(self.processes):
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+class Statistics:
+    """Measurements of all clients of one upload mode, shared between the client threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: list[float] = []
+        self.close_times: list[float] = []
+        self.status_codes: Counter = Counter()
+        self.accepted_bases = 0
+        self.errors: list[str] = []
+
+    def report(self, wall_seconds: float) -> dict[str, Any]:
+        requests = sum(self.status_codes.values())
+        return {
+            'wall_seconds': wall_seconds,
+            'accepted_bases': self.accepted_bases,
+            'bases_per_second': self.accepted_bases / wall_seconds if wall_seconds > 0 else 0.0,
+            'latency_seconds': percentiles(self.latencies),
+            'time_to_close_seconds': percentiles(self.close_times),
+            'status_codes': dict(self.status_codes),
+            'rate_413': self.status_codes[413] / requests if requests > 0 else 0.0,
+            'rate_422': self.status_codes[422] / requests if requests > 0 else 0.0,
+            'errors': self.errors,
+        }
+
+
+def split_chunks(records: list[list[str]], chunk_size: int) -> list[list[list[list[str]]]]:
+    chunks, current, current_size = [], [], 0
+    for record in records:
+        if current and current_size + len(record[1]) > chunk_size:
+            chunks.append(current)
+            current, current_size = [], 0
+        current.append([record])
+        current_size += len(record[1])
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def run_http_client(api_url: str, records: list[list[str]], statistics: Statistics) -> None:
+    with httpx.Client(base_url=f'{api_url}/api', timeout=120) as client:
+        request_size = client.get('/server-status').json()['requestSize']
+        context = client.post('/context/create', json={'filenames': ['load_test.fastq']}).json()['context']
+
+        for chunk in split_chunks(records, request_size):
+            while True:
+                start = time.perf_counter()
+                response = client.post(f'/context/{context}/reads', json=chunk)
+                with statistics.lock:
+                    statistics.latencies.append(time.perf_counter() - start)
+                    statistics.status_codes[response.status_code] += 1
+                if response.status_code == 422:
+                    time.sleep(response.json().get('retryAfter', 0.1))
+                    continue
+                if response.status_code == 200:
+                    with statistics.lock:
+                        statistics.accepted_bases += sum(len(pair[0][1]) for pair in chunk)
+                break
+
+        start = time.perf_counter()
+        response = client.post(f'/context/{context}/close')
+        while True:
+            if response.status_code == 202:
+                # Sealed, the server writes the context once all reads are filtered
+                time.sleep(max(response.json().get('retryAfter', 0.1), 0.05))
+                response = client.get(f'/context/{context}/close')
+                continue
+            with statistics.lock:
+                if response.status_code == 200:
+                    statistics.close_times.append(time.perf_counter() - start)
+                else:
+                    statistics.errors.append(f'close returned {response.status_code}')
+            return
+
+
+def run_socket_client(api_url: str, records: list[list[str]], statistics: Statistics, timeout: float) -> None:
+    client = socketio.Client()
+    closed = threading.Event()
+    state: dict[str, Any] = {'offset': 0, 'context': None, 'close_started': None}
+    # Every processed job triggers one dataRequest, so they are matched with the uploads in FIFO order
+    upload_times: list[float] = []
+
+    def take(size: int) -> tuple[list, int]:
+        chunk, taken = [], 0
+        while state['offset'] < len(records):
+            record = records[state['offset']]
+            if chunk and taken + len(record[1]) >= size:
+                break
+            chunk.append([record])
+            taken += len(record[1])
+            state['offset'] += 1
+        return chunk, taken
+
+    def close() -> None:
+        if state['close_started'] is None:
+            state['close_started'] = time.perf_counter()
+        client.emit('closeContext', {'contextId': state['context']})
+
+    @client.on('dataRequest')
+    def on_data_request(payload):
+        now = time.perf_counter()
+        state['context'] = payload['contextId']
+        with statistics.lock:
+            if upload_times:
+                statistics.latencies.append(now - upload_times.pop(0))
+        chunk, size = take(payload['bytes'])
+        if len(chunk) == 0:
+            close()
+            return
+        upload_times.append(time.perf_counter())
+        client.emit('dataUpload', {'data': chunk, 'bytes': size, 'contextId': state['context']})
+        with statistics.lock:
+            statistics.status_codes['dataUpload'] += 1
+            statistics.accepted_bases += size
+
+    @client.on('dataUploadError')
+    def on_data_upload_error(payload):
+        with statistics.lock:
+            statistics.status_codes['dataUploadError'] += 1
+            statistics.errors.append(payload.get('message', ''))
+
+    @client.on('contextCloseError')
+    def on_context_close_error(payload):
+        with statistics.lock:
+            statistics.errors.append(f"close failed: {payload.get('message', '')}")
+        closed.set()
+
+    @client.on('contextClosed')
+    def on_context_closed(payload):
+        with statistics.lock:
+            statistics.close_times.append(time.perf_counter() - state['close_started'])
+        closed.set()
+
+    client.connect(api_url, socketio_path='/api/socket.io')
+    client.emit('createContext', {'filenames': ['load_test.fastq']})
+    if not closed.wait(timeout):
+        with statistics.lock:
+            statistics.errors.append(f'socket client did not finish within {timeout} seconds')
+    client.disconnect()
+
+
+def run_clients(mode: str, api_url: str, records: list[list[str]], clients: int, timeout: float) -> dict[str, Any]:
+    statistics = Statistics()
+    if mode == 'http':
+        target, arguments = run_http_client, (api_url, records, statistics)
+    else:
+        target, arguments = run_socket_client, (api_url, records, statistics, timeout)
+
+    threads = [threading.Thread(target=target, args=arguments) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = statistics.report(time.perf_counter() - start)
+    report['clients'] = clients
+    return report
+
+
+def get_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Offline load test of the api and filter with a local redis.')
+    parser.add_argument('--clients', type=int, default=4, help='Number of concurrently uploading clients.')
+    parser.add_argument('--mode', choices=['http', 'socket', 'both'], default='both')
+    parser.add_argument('--reads', type=str, default=DEFAULT_READS, help='Uncompressed FASTQ file every client uploads.')
+    parser.add_argument('--filter-mode', choices=['NONE', 'COMBINED'], default='NONE',
+                        help='NONE accepts everything, COMBINED maps against the bundled pathogen genome.')
+    parser.add_argument('--maximum-pending-bytes', type=int, default=300000)
+    parser.add_argument('--request-size-factor', type=int, default=8)
+    parser.add_argument('--worker-threads', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--timeout', type=float, default=600, help='Seconds a socket.io client may take.')
+    parser.add_argument('--api', type=str, help='Use an already running api instead of starting a local stack.')
+    parser.add_argument('--output', type=str, default='load_test_results.json')
+    return parser
+
+
+def main() -> None:
+    arguments = get_argument_parser().parse_args()
+    records = read_records(arguments.reads)
+    modes = ['http', 'socket'] if arguments.mode == 'both' else [arguments.mode]
+
+    stack: Optional[Stack] = None
+    api_url = arguments.api
+    if api_url is None:
+        stack = Stack(arguments.filter_mode, arguments.maximum_pending_bytes, arguments.request_size_factor,
+                      arguments.worker_threads)
+        stack.start()
+        api_url = stack.api_url
+
+    results: dict[str, Any] = {'clients': arguments.clients, 'reads_per_client': len(records),
+                               'filter_mode': arguments.filter_mode, 'results': {}}
+    try:
+        for mode in modes:
+            print(f'Running {arguments.clients} {mode} clients ...')
+            results['results'][mode] = run_clients(mode, api_url, records, arguments.clients, arguments.timeout)
+            report = results['results'][mode]
+            print(f"{mode}: {report['bases_per_second']:.0f} bases/s, latency {report['latency_seconds']}, "
+                  f"close {report['time_to_close_seconds']}, status codes {report['status_codes']}")
+    finally:
+        if stack is not None:
+            stack.stop()
+
+    with open(arguments.output, 'w') as handle:
+        json.dump(results, handle, indent=2)
+    print(f'Wrote results to {arguments.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,70 @@
 # coding=utf-8
-from typing import Union
+from typing import Any, Optional, Union
 
 from flask import Flask, request, make_response, Response
 from flask_cors import CORS
 from flask_socketio import SocketIO, join_room
 
 from .context_manager import *
+from .finaliser import ContextFinaliser
+from .ingestion import FastqStreamParser, drop_ingestion_session, get_ingestion_session, ingest_stream
+from .logs import setup_logging
+from .validation import UPLOAD_MODES, UPLOAD_MODE_FASTQ, UPLOAD_MODE_SEQUENCES, ChunkError, LongReadSegmenter, \
+    ValidatedChunk, validate_chunk, validate_sequence_chunk
 from .version import VERSION_INFORMATION
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True)
 socketio = SocketIO(app, cors_allowed_origins="*", path='/api/socket.io', max_http_buffer_size=10_000_000)
 
+# Seconds clients should wait before creating a context again while no filter server is ready
+FILTER_NOT_READY_RETRY_AFTER: float = 5
+
+# Segments single-end reads that are longer than the buffer, None if they are discarded (see LONG_READ_SEGMENTS)
+long_read_segmenter: Optional[LongReadSegmenter] = None
+
 
 def request_data(request_size, context_id):
     """Request data from client"""
-    app.logger.info(f"({context_id}): Requesting {request_size} bytes from client.")
+    app.logger.info(f"({context_id}): Requesting {request_size} bytes from client.",
+                    extra={'event': 'request_data', 'context': context_id})
     socketio.emit("dataRequest", {"bytes": request_size, "contextId": str(context_id),
                                   "bufferFill": get_pending_bytes_count(context_id),
                                   "processedReads": get_processed_read_count(context_id)}, to=str(context_id))
 
 
+def is_known_mapping_preset(mapping_preset: Any) -> bool:
+    """None (the preset of the reference), 'auto' or a preset the filter servers can map with."""
+    return mapping_preset is None or mapping_preset == MAPPING_PRESET_AUTO or \
+        (isinstance(mapping_preset, str) and mapping_preset in get_available_mapping_presets())
+
+
+def validate_context_chunk(chunk: Any, context_id: UUID) -> ValidatedChunk:
+    """Validate a chunk in the upload mode of the context, raises ChunkError."""
+    # We expect as many reads to be paired as we have open file streams. (Support for strobe reads in theory)
+    pair_count, upload_mode = get_upload_format(context_id)
+    if upload_mode == UPLOAD_MODE_SEQUENCES:
+        return validate_sequence_chunk(chunk, pair_count, app.config['MAXIMUM_PENDING_BYTES'], long_read_segmenter)
+    return validate_chunk(chunk, pair_count, app.config['MAXIMUM_PENDING_BYTES'], long_read_segmenter)
+
+
+def accept_validated_chunk(validated: ValidatedChunk, context_id: UUID, request_reception_time: float) -> None:
+    """Count the dropped pairs of an accepted chunk as processed and enqueue the others for filtering."""
+    if validated.dropped_pairs > 0:
+        # The reads will be discarded anyway and don't matter for buffer calculation
+        increment_processed_bases(validated.dropped_bases)
+        increase_processed_read_count(context_id, validated.dropped_pairs)
+    if validated.unfiltered_bases > 0:
+        # The bases of segmented reads outside their windows
+        increment_processed_bases(validated.unfiltered_bases)
+
+    # Enqueue valid read pairs for processing
+    if len(validated.pairs) > 0:
+        # In hands-off mode the filter only needs the ids of the kept reads, so segmented reads aren't parked
+        enqueue_chunks(validated.pairs, context_id, validated.size, request_reception_time, validated.encoded,
+                       None if app.config['HANDS_OFF'] else validated.parked)
+
+
 # SocketIO listeners
 @socketio.on("connect")
 def handle_connect():
@@ -51,8 +95,26 @@ def handle_create_context(payload):
     if not isinstance(filenames, list):
         socketio.emit('contextCreationError', {'message': 'filenames is not a list.'}, to=session_id)
         return
+    reference = payload.get("reference")
+    if reference is not None and (not isinstance(reference, str) or reference not in get_available_references()):
+        socketio.emit('contextCreationError', {'message': f'Unknown reference {reference}.'}, to=session_id)
+        return
+    upload_mode = payload.get("uploadMode", UPLOAD_MODE_FASTQ)
+    if upload_mode not in UPLOAD_MODES:
+        socketio.emit('contextCreationError', {'message': f'Unknown upload mode {upload_mode}.'}, to=session_id)
+        return
+    mapping_preset = payload.get("mappingPreset", app.config['DEFAULT_MAPPING_PRESET'])
+    if not is_known_mapping_preset(mapping_preset):
+        socketio.emit('contextCreationError', {'message': f'Unknown mapping preset {mapping_preset}.'},
+                      to=session_id)
+        return
+    if app.config['REQUIRE_READY_FILTER'] and not filter_server_ready():
+        socketio.emit('contextCreationError', {'message': 'No filter server is ready, try again later.',
+                                               'retryAfter': FILTER_NOT_READY_RETRY_AFTER}, to=session_id)
+        return
 
-    context_id = create_context(filenames=filenames)
+    context_id = create_context(filenames=filenames, reference=reference, upload_mode=upload_mode,
+                                mapping_preset=mapping_preset)
     if context_id is None:
         app.logger.error('Could not create context.')
         socketio.emit('contextCreationError', {'message': 'Could not create context.'}, to=session_id)
@@ -69,124 +131,127 @@ def handle_create_context(payload):
 
 @socketio.on("closeContext")
 def handle_close_context(payload):
-    """Handle context closing request from client"""
+    """Handle context closing request from client. The context is sealed and written by the finaliser once all reads
+    are filtered, contextClosed (or contextCloseError) is sent to the context's room when that is done. Requests after
+    that are answered with the stored outcome."""
     context_id = payload.get("contextId")
-    if not context_exists(context_id):
-        socketio.emit("contextCloseError", {'message': f'Tried to close non-existent context {context_id}.'},
-                      to=str(context_id))
+    status = get_close_status(context_id)
+    if status is None and not context_exists(context_id):
+        socketio.emit("contextCloseError", {'message': f'Tried to close non-existent context {context_id}.',
+                                            'code': 'context_not_found'}, to=request.sid)
         return
 
-    app.logger.info(f"({context_id}): Received context closing request from client.")
-
-    # We test if the context still has pending bytes and only delete it if no more bytes are pending (everything is filtered)
-    pending_bytes: int = get_pending_bytes_count(context_id)
-    if pending_bytes != 0:
-        app.logger.info(f"({context_id}): Can not close context. Still pending bytes.")
-        socketio.emit("contextCloseError", {'message': 'There are still reads pending, try again later!'},
-                      to=str(context_id))
+    if seal_context(context_id):
+        app.logger.info(f"({context_id}): Received context closing request from client, sealed context.")
+        finaliser.submit(context_id)
+        socketio.emit("contextSealed", {'contextId': context_id}, to=str(context_id))
+        socketio.start_background_task(watch_close, context_id)
         return
+    # Repeated requests (e.g. on every dataRequest after the last chunk) are answered by the running watch_close, once
+    # that is done the requesting client gets the stored outcome
+    emit_close_outcome(context_id, get_close_status(context_id), request.sid)
+
 
-    result = close_context(context_id, app.config['HANDS_OFF'])
+def emit_close_outcome(context_id: str, status: Optional[str], to: str) -> bool:
+    """Send contextClosed or contextCloseError to the room or session if the close finished (status closed or failed),
+    False while the context is still being closed."""
+    if status in (CLOSE_STATUS_SEALED, CLOSE_STATUS_FINALISING):
+        return False
+    result = get_close_result(context_id)
     if result is None:
-        socketio.emit("contextCloseError", {'message': 'Could not close context'}, to=str(context_id))
-        return
+        # The result (and maybe the status) expired
+        socketio.emit("contextCloseError", {'message': f'The context {context_id} is already closed.',
+                                            'code': 'context_closed'}, to=to)
+    elif status == CLOSE_STATUS_CLOSED:
+        socketio.emit("contextClosed", {'contextId': context_id, 'savedReads': result['readsSaved'],
+                                        'processedReads': result['readsProcessed']}, to=to)
+        app.logger.info(
+            f'({context_id}): Closed context, saved {len(result["readsSaved"])} of {result["readsProcessed"]}.')
     else:
-        socketio.emit("contextClosed", {'contextId': context_id, 'savedReads': result[1], 'processedReads': result[0]},
-                      to=str(context_id))
-        app.logger.info(f'({context_id}): Closed context, saved {len(result[1])} of {result[0]}.')
-        return
+        socketio.emit("contextCloseError", {'message': result.get('message', 'Could not close context'),
+                                            'code': 'close_failed'}, to=to)
+    return True
+
+
+def watch_close(context_id: str) -> None:
+    """Wait for the finaliser and send the outcome of the close to the context's room."""
+    while True:
+        socketio.sleep(app.config['FINALISER_POLL_INTERVAL'])
+        if emit_close_outcome(context_id, get_close_status(context_id), str(context_id)):
+            return
+
+
+def reject_upload(code: str, message: str, context_id: Optional[UUID] = None, chunk_id: Any = None,
+                  **details) -> None:
+    """Tell the uploading client that its chunk was discarded as a whole. code is stable and meant for the client to
+    act on, chunk_id is echoed from the upload so the client knows which chunk was discarded."""
+    app.logger.info(f"({context_id}): Rejected uploaded chunk: {message}",
+                    extra={'event': 'upload_rejected', 'context': context_id})
+    socketio.emit("dataUploadError", {'code': code, 'message': message, 'contextId': context_id,
+                                      'chunkId': chunk_id, **details}, to=request.sid)
 
 
 @socketio.on("dataUpload")
 def handle_data_upload(payload):
-    """Handle data uploaded from client"""
+    """Handle data uploaded from client. A chunk is either rejected as a whole by reject_upload before anything is
+    changed in redis or accepted as a whole."""
     request_reception_time = time()
 
+    if not isinstance(payload, dict):
+        reject_upload('invalid_payload', 'Expected an object with data, bytes and contextId.')
+        return
     chunk: list[list[list[str]]] = payload.get("data")
     bytes: int = payload.get("bytes")
     context_id: UUID = payload.get("contextId")
-    app.logger.info(f"({context_id}): Received {bytes} bytes from client.")
+    chunk_id = payload.get("chunkId")
+    app.logger.info(f"({context_id}): Received {bytes} bytes from client.",
+                    extra={'event': 'data_upload', 'context': context_id})
 
-    if not context_exists(context_id):
-        socketio.emit("dataUploadError", {'message': f'No context with id {context_id} found.'}, to=str(context_id))
-
-    if not isinstance(chunk, list):
-        socketio.emit("dataUploadError", {'message': 'Passed read chunks are not in list format.'},
-                      to=str(context_id))
-
-    effective_cumulated_chunk_size: int = 0
-    pair_count: int = get_pair_count(
-        context_id)  # We expect as many reads to be paired as we have open file streams. (Support for strobe reads in theory)
-
-    pairs_short_enough = []
-    for pair in chunk:
-        if not isinstance(pair, list):
-            socketio.emit("dataUploadError", {'message': 'There is a pair which is not a list.'},
-                          to=str(context_id))
-
-        if len(pair) != pair_count:
-            socketio.emit("dataUploadError",
-                          {'message': f'Expected {pair_count}-paired reads but found pair with {len(pair)} reads.'},
-                          to=str(context_id))
-
-        filtered_pair = []
-        for read in pair:
-            if not isinstance(read, list):
-                socketio.emit("dataUploadError", {'message': 'There is a read which is not a list.'},
-                              to=str(context_id))
-            if len(read) != 4:
-                socketio.emit("dataUploadError", {'message': 'There is a read with a length != 4.'},
-                              to=str(context_id))
-            # Here would be the place to perform additional sanity checks
-
-            # Check if the read length is within the allowed buffer size
-            if len(read[1]) <= app.config['MAXIMUM_PENDING_BYTES']:
-                # Only count the length of the actual sequence
-                effective_cumulated_chunk_size += len(read[1])
-                filtered_pair.append(read)
-            else:
-                increment_processed_bases(len(read[1]))
-                # The read will be discarded anyway and doesn't matter for buffer calculation
-                break
-        else:
-            # All reads fit the size and can be enqueued for filtering
-            pairs_short_enough.append(filtered_pair)
+    if not isinstance(context_id, str) or not context_exists(context_id):
+        reject_upload('context_not_found', f'No context with id {context_id} found.', context_id, chunk_id)
+        return
+
+    try:
+        validated = validate_context_chunk(chunk, context_id)
+    except ChunkError as e:
+        reject_upload(e.code, e.message, context_id, chunk_id)
+        return
+    effective_cumulated_chunk_size: int = validated.size
 
     current_pending: int = get_pending_bytes_count(context_id)
     request_size_factor, request_size = get_socket_request_info()
     excess: int = current_pending + effective_cumulated_chunk_size - app.config['MAXIMUM_PENDING_BYTES']
 
     if effective_cumulated_chunk_size > request_size:
-        app.logger.info(f"({context_id}): You sent more data than requested.")
         app.logger.info(
-            f"Effective cumulated chunk size: {effective_cumulated_chunk_size}. Request size: {request_size}.")
-
-        socketio.emit("dataUploadError",
-                      {'message': 'You sent more bytes than requested. Sent data will be discarded.'},
-                      to=str(context_id))
+            f"Effective cumulated chunk size: {effective_cumulated_chunk_size}. Request size: {request_size}.",
+            extra={'event': 'upload_rejected', 'context': context_id})
+        reject_upload('more_than_requested', 'You sent more bytes than requested. Sent data will be discarded.',
+                      context_id, chunk_id, requestSize=request_size)
         return
 
     elif excess > 0:
-        socketio.emit("dataUploadError", {'message': 'You sent too much data.'}, to=str(context_id))
+        reject_upload('buffer_full', 'You sent too much data.', context_id, chunk_id, pendingBytes=current_pending,
+                      retryAfter=excess * get_queue_speed(context_id))
         return
 
     # Execution from here on means accepting the chunk and processing the reads
     # Adjust pending bytes stat in redis
-    change_pending_bytes_count(context_id, effective_cumulated_chunk_size)
-    increase_processed_read_count(context_id, len(chunk) - len(pairs_short_enough))
+    if reserve_pending_bytes(context_id, effective_cumulated_chunk_size) is None:
+        reject_upload('context_closed', 'The context is already being closed.', context_id, chunk_id)
+        return
 
-    # Enqueue valid read pairs for processing
-    if len(pairs_short_enough) > 0:
-        enqueue_chunks(pairs_short_enough, context_id, effective_cumulated_chunk_size, request_reception_time)
+    accept_validated_chunk(validated, context_id, request_reception_time)
 
 
 # Http routes
 @app.route('/api/context/<uuid:context_id>/request-data', methods=['POST'])
 def post_request_data(context_id: UUID) -> Response:
-    app.logger.info('Requesting data from client.')
+    app.logger.info('Requesting data from client.', extra={'event': 'filter_request_data', 'context': context_id})
     """Called by filters to requests data from client once data in buffer has been processed"""
     if not context_exists(context_id):
-        app.logger.warning(f'Tried to request data from non-existent context {context_id}.')
+        app.logger.warning(f'Tried to request data from non-existent context {context_id}.',
+                           extra={'context': context_id})
         return make_response({'message': 'No such context.'}, 404)
 
     json_body: dict[str, Any]
@@ -203,6 +268,17 @@ def post_request_data(context_id: UUID) -> Response:
     return make_response({'message': 'Data requested.'}, 200)
 
 
+@app.route('/api/context/<uuid:context_id>/heartbeat', methods=['POST'])
+def post_context_heartbeat(context_id: UUID) -> Response:
+    """Keep an idle context from expiring, e.g. while a watching client waits for the sequencer's next batch."""
+    if not context_exists(context_id) or get_close_status(context_id) is not None:
+        return make_response({'message': f'No open context with id {context_id} found.'}, 404)
+    refresh_context(context_id)
+    return make_response({'processedReads': get_processed_read_count(context_id),
+                          'pendingBytes': get_pending_bytes_count(context_id),
+                          'timeout': app.config['CONTEXT_TIMEOUT']}, 200)
+
+
 @app.route('/api/server-status', methods=['GET'])
 def server_status() -> dict[str, Union[str, float]]:
     """Returns information about the server. Unfortunately, proper version discovery only works if the package is
@@ -212,6 +288,14 @@ def server_status() -> dict[str, Union[str, float]]:
     answer['uptime'] = time() - SERVER_LAUNCH_TIME
     answer['bufferSize'] = app.config['MAXIMUM_PENDING_BYTES']
     answer['requestSize'] = app.config['MAXIMUM_PENDING_BYTES'] // app.config['REQUEST_SIZE_FACTOR']
+    answer['references'] = sorted(get_available_references())
+    answer['uploadModes'] = list(UPLOAD_MODES)
+    # Reads longer than the buffer are filtered from this many windows of longReadWindow bases, 0 if they are dropped
+    answer['longReadSegments'] = app.config['LONG_READ_SEGMENTS']
+    answer['longReadWindow'] = app.config['LONG_READ_WINDOW']
+    answer['mappingPresets'] = sorted(get_available_mapping_presets()) + [MAPPING_PRESET_AUTO]
+    # Contexts expire after this many seconds without contact
+    answer['contextTimeout'] = app.config['CONTEXT_TIMEOUT']
     return make_response(answer, 200)
 
 
@@ -224,39 +308,71 @@ def context_create() -> dict[str, UUID]:
             return make_response({'message': 'filenames missing in request.'}, 400)
         if not isinstance(json_body['filenames'], list):
             return make_response({'message': 'filenames is not a list.'}, 400)
+        reference = json_body.get('reference')
+        if reference is not None and (not isinstance(reference, str) or reference not in get_available_references()):
+            return make_response({'message': f'Unknown reference {reference}.'}, 400)
+        # In the sequence-only mode clients send [index, sequence, ...] per pair and get the kept indices back
+        upload_mode = json_body.get('uploadMode', UPLOAD_MODE_FASTQ)
+        if upload_mode not in UPLOAD_MODES:
+            return make_response({'message': f'Unknown upload mode {upload_mode}.'}, 400)
+        mapping_preset = json_body.get('mappingPreset', app.config['DEFAULT_MAPPING_PRESET'])
+        if not is_known_mapping_preset(mapping_preset):
+            return make_response({'message': f'Unknown mapping preset {mapping_preset}.'}, 400)
     except TypeError:
         return make_response({'message': 'expected json body.'}, 400)
+    if app.config['REQUIRE_READY_FILTER'] and not filter_server_ready():
+        return make_response({'message': 'No filter server is ready, try again later.',
+                              'retryAfter': FILTER_NOT_READY_RETRY_AFTER}, 503)
 
-    context = create_context(filenames=json_body['filenames'])
+    context = create_context(filenames=json_body['filenames'], reference=reference, upload_mode=upload_mode,
+                             mapping_preset=mapping_preset)
     if context is None:
         app.logger.error('Could not create context.')
 
     return {'context': context}
 
 
-@app.route('/api/context/<uuid:context_id>/close',
-           methods=['POST'])  # TODO: Avoid race condition (close before last reads)
-def post_close_context(context_id: UUID) -> dict[str, Union[int, str, list[str]]]:
-    if not context_exists(context_id):
-        app.logger.warning(f'Tried to close non-existent context {context_id}.')
-        return make_response({'message': 'No such context.'}, 404)
-
-    # We test if the context still has pending bytes and only delete it if no more bytes are pending (everything is filtered)
-    pending_bytes: int = get_pending_bytes_count(context_id)
-    if pending_bytes != 0:
+@app.route('/api/context/<uuid:context_id>/close', methods=['POST'])
+def post_close_context(context_id: UUID) -> Response:
+    """Seal the context, it is written in the background once all its reads are filtered. Reads that are still in
+    flight are accepted until then. Answers like get_close_context, repeating the request is harmless."""
+    if get_close_status(context_id) is None:
+        if not context_exists(context_id):
+            app.logger.warning(f'Tried to close non-existent context {context_id}.')
+            return make_response({'message': 'No such context.'}, 404)
+        if seal_context(context_id):
+            app.logger.info(f'Sealed context {context_id}.')
+            finaliser.submit(context_id)
+    return close_status_response(context_id)
+
+
+@app.route('/api/context/<uuid:context_id>/close', methods=['GET'])
+def get_close_context(context_id: UUID) -> Response:
+    """The close status: 202 while the context waits for the filter or is written, 200 with the result once done."""
+    if get_close_status(context_id) is None:
+        return make_response({'message': 'No such closed context.'}, 404)
+    return close_status_response(context_id)
+
+
+def close_status_response(context_id: UUID) -> Response:
+    status = get_close_status(context_id)
+    if status == CLOSE_STATUS_CLOSED:
+        return make_response({'status': status, **get_close_result(context_id)}, 200)
+    if status == CLOSE_STATUS_SEALED and context_exists(context_id):
+        pending_bytes: int = get_pending_bytes_count(context_id)
         return make_response({
-            'message': 'There are still reads pending, try again later!',
-            'retryAfter': pending_bytes * get_queue_speed(context_id),
+            'message': 'There are still reads pending, check back later!',
+            'status': status,
+            'retryAfter': max(pending_bytes * get_queue_speed(context_id), app.config['FINALISER_POLL_INTERVAL']),
             'processedReads': get_processed_read_count(context_id),
             'pendingBytes': pending_bytes
-        }, 503)
-
-    result = close_context(context_id, app.config['HANDS_OFF'])
-    if result is None:
-        return make_response({'message': 'Could not close context.'}, 500)
-    else:
-        app.logger.info(f'Closed context {context_id}, saved {len(result[1])} of {result[0]}.')
-        return make_response({'readsSaved': result[1], 'readsProcessed': result[0]}, 200)
+        }, 202)
+    if status == CLOSE_STATUS_FINALISING:
+        return make_response({'message': 'The filtered reads are being written, check back later!',
+                              'status': status, 'retryAfter': app.config['FINALISER_POLL_INTERVAL']}, 202)
+    result = get_close_result(context_id) or {}
+    return make_response({'message': result.get('message', 'Could not close context.'), 'status': CLOSE_STATUS_FAILED},
+                         500)
 
 
 @app.route('/api/context/<uuid:context_id>/reads', methods=['POST'])
@@ -276,42 +392,11 @@ def post_context_reads(context_id: UUID) -> dict[str, Union[int, str]]:
         return make_response({'message': 'The connection was interrupted.'}, 400)
 
     # Validate chunk format
-    if not isinstance(chunk, list):
-        return make_response({'message': 'Passed read chunks are not in list format.'}, 400)
-
-    effective_cumulated_chunk_size: int = 0
-    pair_count: int = get_pair_count(
-        context_id)  # We expect as much reads to be paired as we have open file streams. (Support for strobe reads in theory)
-
-    pairs_short_enough = []
-    for pair in chunk:
-        if not isinstance(pair, list):
-            return make_response({'message': 'There is a pair which is not a list.'}, 400)
-
-        if len(pair) != pair_count:
-            return make_response(
-                {'message': f'Expected {pair_count}-paired reads but found pair with {len(pair)} reads.'}, 400)
-
-        filtered_pair = []
-        for read in pair:
-            if not isinstance(read, list):
-                return make_response({'message': 'There is a read which is not a list.'}, 400)
-            if len(read) != 4:
-                return make_response({'message': 'There is a read with a length != 4.'}, 400)
-            # Here would be the place to perform additional sanity checks
-
-            # Check if the read length is within the allowed buffer size
-            if len(read[1]) <= app.config['MAXIMUM_PENDING_BYTES']:
-                # Only count the length of the actual sequence
-                effective_cumulated_chunk_size += len(read[1])
-                filtered_pair.append(read)
-            else:
-                increment_processed_bases(len(read[1]))
-                # The read will be discarded anyways and doesn't matter for buffer calculation
-                break
-        else:
-            # All reads fit the size and can be enqueued for filtering
-            pairs_short_enough.append(filtered_pair)
+    try:
+        validated = validate_context_chunk(chunk, context_id)
+    except ChunkError as e:
+        return make_response({'message': e.message, 'code': e.code}, 400)
+    effective_cumulated_chunk_size: int = validated.size
 
     current_pending: int = get_pending_bytes_count(context_id)
     excess: int = current_pending + effective_cumulated_chunk_size - app.config['MAXIMUM_PENDING_BYTES']
@@ -335,13 +420,11 @@ def post_context_reads(context_id: UUID) -> dict[str, Union[int, str]]:
 
     # Execution from here on means accepting the chunk and processing the reads
     # Adjust pending bytes stat in redis
-    current_pending = change_pending_bytes_count(context_id, effective_cumulated_chunk_size)
+    current_pending = reserve_pending_bytes(context_id, effective_cumulated_chunk_size)
+    if current_pending is None:
+        return make_response({'message': 'The context is already being closed.', 'code': 'context_closed'}, 409)
 
-    increase_processed_read_count(context_id, len(chunk) - len(pairs_short_enough))
-
-    # Enqueue valid read pairs for processing
-    if len(pairs_short_enough) > 0:
-        enqueue_chunks(pairs_short_enough, context_id, effective_cumulated_chunk_size, request_reception_time)
+    accept_validated_chunk(validated, context_id, request_reception_time)
 
     return make_response({
         'processedReads': get_processed_read_count(context_id),
@@ -349,6 +432,70 @@ def post_context_reads(context_id: UUID) -> dict[str, Union[int, str]]:
         200)
 
 
+@app.route('/api/context/<uuid:context_id>/ingest', methods=['POST', 'PUT'])
+def ingest_context_reads(context_id: UUID) -> Response:
+    """Stream a raw FASTQ or FASTQ.gz file into the context, one request per mate (?mate=0, 1, ...), e.g.
+    curl -T reads.fq.gz https://host/api/context/<id>/ingest. The api parses, sizes and enqueues the reads itself and
+    stops reading from the request while the buffer of the context is full. Answers once the whole stream is
+    enqueued."""
+    if not context_exists(context_id):
+        return make_response({'message': f'No context with id {context_id} found.'}, 404)
+    mate = request.args.get('mate', 0, type=int)
+    pair_count, upload_mode = get_upload_format(context_id)
+    if upload_mode != UPLOAD_MODE_FASTQ:
+        return make_response({'message': f'Streams need a context in the {UPLOAD_MODE_FASTQ} upload mode.',
+                              'code': 'wrong_upload_mode'}, 409)
+    if not 0 <= mate < pair_count:
+        return make_response({'message': f'The context has {pair_count} mates, there is no mate {mate}.',
+                              'code': 'invalid_mate'}, 400)
+    session = get_ingestion_session(context_id, pair_count)
+    if not session.attach(mate):
+        return make_response({'message': f'Mate {mate} is already being streamed.', 'code': 'mate_already_streaming'},
+                             409)
+
+    parser = FastqStreamParser(request.stream, app.config['INGESTION_BLOCK_SIZE'])
+    try:
+        ingest_stream(session, mate, parser, get_socket_request_info()[1], app.config['MAXIMUM_PENDING_BYTES'],
+                      lambda chunk, reception_time: enqueue_ingested_chunk(context_id, chunk, reception_time),
+                      app.config['MAXIMUM_PENDING_BYTES'], app.config['INGESTION_MATE_TIMEOUT'], socketio.sleep,
+                      app.config['INGESTION_POLL_INTERVAL'], long_read_segmenter)
+    except ChunkError as e:
+        # The streams of the context can't be paired reliably anymore
+        drop_ingestion_session(context_id)
+        status = {'context_closed': 409, 'context_not_found': 404, 'mate_stream_missing': 408}.get(e.code, 400)
+        return make_response({'message': e.message, 'code': e.code, 'records': parser.records}, status)
+    except OSError:
+        drop_ingestion_session(context_id)
+        return make_response({'message': 'The connection was interrupted.', 'records': parser.records}, 400)
+    if session.done():
+        drop_ingestion_session(context_id)
+
+    app.logger.info(f'({context_id}): Ingested {parser.records} records of mate {mate}.')
+    return make_response({
+        'records': parser.records,
+        'processedReads': get_processed_read_count(context_id),
+        'pendingBytes': get_pending_bytes_count(context_id)},
+        200)
+
+
+def enqueue_ingested_chunk(context_id: UUID, chunk: ValidatedChunk, reception_time: float) -> bool:
+    """Wait until the chunk fits into the buffer of the context and enqueue it, False if the context is closing. A
+    pair whose mates fit into the buffer on their own but not together is enqueued once the buffer is empty."""
+    while True:
+        if not context_exists(context_id):
+            raise ChunkError('context_not_found', f'No context with id {context_id} found.')
+        pending = get_pending_bytes_count(context_id)
+        excess = pending + chunk.size - app.config['MAXIMUM_PENDING_BYTES']
+        if excess <= 0 or pending == 0:
+            break
+        # Not reading the request meanwhile is what slows the client down
+        socketio.sleep(max(excess * get_queue_speed(context_id), app.config['INGESTION_POLL_INTERVAL']))
+    if reserve_pending_bytes(context_id, chunk.size) is None:
+        return False
+    accept_validated_chunk(chunk, context_id, reception_time)
+    return True
+
+
 # Load the default configuration from 'config.py'
 app.config.from_pyfile('config.py')
 
@@ -357,20 +504,21 @@ if os.path.exists(app.config['CONFIG_FILE']):
     print('found additional config file, overwriting defaults ...')
     app.config.from_pyfile(app.config['CONFIG_FILE'])
 
-# Set up logging configuration
-logging.basicConfig(
-    filename=app.config['LOG_FILE'],  # Log file path
-    level='INFO',  # Log level
-    format='%(asctime)s:%(levelname)s:%(name)s:%(message)s'  # Log message format
-)
-
-# Add a stream handler to also output logs to the console
-logging.getLogger().addHandler(logging.StreamHandler())
+# Set up logging to the log file and the console
+setup_logging(app.config['LOG_FILE'], app.config['LOG_LEVEL'], app.config['LOG_QUEUED'], app.config['LOG_JSON'],
+              app.config['LOG_EVENT_RATE'], app.config['LOG_EVENT_BURST'])
 
 # Log all configuration settings for debugging purposes
 for k in app.config:
     app.logger.info(f'Configuration {k} -> {app.config[k]}')
 
+if app.config['LONG_READ_SEGMENTS'] > 0:
+    long_read_segmenter = LongReadSegmenter(app.config['LONG_READ_WINDOW'], app.config['LONG_READ_SEGMENTS'])
+    if long_read_segmenter.size() > app.config['MAXIMUM_PENDING_BYTES']:
+        app.logger.fatal(f'{long_read_segmenter.segments} windows of {long_read_segmenter.window} bases do not fit '
+                         f'into the buffer of {app.config["MAXIMUM_PENDING_BYTES"]} bases. Goodbye.')
+        sys.exit(1)
+
 # Log the attempt to connect to the stateful backend
 app.logger.info('Connecting to stateful backend.')
 
@@ -389,6 +537,11 @@ write_config_value_to_redis("REQUEST_SIZE_FACTOR", "request_size_factor", app.co
 write_config_value_to_redis("REQUEST_SIZE", "request_size",
                             app.config['MAXIMUM_PENDING_BYTES'] // app.config['REQUEST_SIZE_FACTOR'])
 
+# Closed contexts are written in the background
+finaliser = ContextFinaliser(app.config['FINALISER_THREADS'], app.config['FINALISER_POLL_INTERVAL'],
+                             app.config['HANDS_OFF'])
+finaliser.start()
+
 # Record the server launch time
 SERVER_LAUNCH_TIME = time()
 
@@ -1,5 +1,6 @@
 # coding=utf-8
 from os import getcwd, path
+from typing import Optional
 
 INPUT_DIRECTORY: str = path.join(getcwd(), 'input')
 
@@ -11,20 +12,61 @@ CONFIG_FILE: str = path.join(INPUT_DIRECTORY, 'config_api.py')
 
 # The log file
 LOG_FILE: str = path.join(OUTPUT_DIRECTORY, 'server.log')
+LOG_LEVEL: str = 'INFO'
+# Hand log records to a background thread that writes them, so that request handlers don't wait for the log I/O
+LOG_QUEUED: bool = False
+# Write one JSON object per line, with the ids of contexts and jobs as separate fields
+LOG_JSON: bool = False
+# Messages logged per chunk (e.g. received uploads, data requests) are limited to LOG_EVENT_RATE per second and kind
+# of message, with bursts of up to LOG_EVENT_BURST. 0 logs all of them.
+LOG_EVENT_RATE: float = 0
+LOG_EVENT_BURST: int = 20
 # The per-context directories are created under the UPLOAD_DIRECTORY
 UPLOAD_DIRECTORY: str = path.join(OUTPUT_DIRECTORY, 'uploads')
-# In hands-off mode filtered read ids are returned but no reads are saved to disk
+# In hands-off mode filtered read ids are returned but no reads are saved to disk. The filter then keeps only the ids
+# of the kept reads in redis, not the whole records.
 HANDS_OFF: bool = False
 
 # The count of base pairs aka bytes per context that are allowed to be in RAM at a time
 MAXIMUM_PENDING_BYTES: int = 300000
 
+# Single-end reads longer than MAXIMUM_PENDING_BYTES never fit into the buffer and are discarded, unless
+# LONG_READ_SEGMENTS > 0. Then only LONG_READ_SEGMENTS windows of LONG_READ_WINDOW bases, evenly spread over the read
+# (the first one at its start), are filtered and the filter decides on the read from them. The whole read waits in
+# redis meanwhile. LONG_READ_SEGMENTS * LONG_READ_WINDOW has to fit into MAXIMUM_PENDING_BYTES.
+LONG_READ_SEGMENTS: int = 0
+LONG_READ_WINDOW: int = 10000
+
 # The factor which is used to calculate the chunk size of each request done through the socket to the client.
 # request size = MAXIMUM_PENDING_BYTES / REQUEST_SIZE_FACTOR
 REQUEST_SIZE_FACTOR: int = 8
 
+# Raw FASTQ streams (the ingest endpoint) are read in blocks of this many bytes
+INGESTION_BLOCK_SIZE: int = 1 << 20
+# Seconds between checks whether a full buffer has room again while a stream is paused
+INGESTION_POLL_INTERVAL: float = 0.1
+# How long the stream of one mate waits for the streams of the other mates when it is a buffer size ahead of them
+INGESTION_MATE_TIMEOUT: float = 60
+
+# The minimap2 preset of contexts that don't choose one, None uses the preset of their reference and 'auto' lets the
+# filter choose from the read lengths (e.g. short read settings for Illumina uploads), see MAPPING_PRESETS of the filter
+DEFAULT_MAPPING_PRESET: Optional[str] = None
+
+# Refuse to create contexts while no filter server is ready (e.g. all of them are restarting), uploads to existing
+# contexts are still accepted and filtered once a server is back
+REQUIRE_READY_FILTER: bool = True
+
 # How long after the last contact should a context be deleted?
 CONTEXT_TIMEOUT: int = 60
 
+# Closed contexts are written to disk by a pool of background threads once all their reads are filtered, clients poll
+# the close status or get a socket.io event
+FINALISER_THREADS: int = 2
+# Seconds between checks of the sealed contexts for remaining pending bytes
+FINALISER_POLL_INTERVAL: float = 0.5
+# How long the result of a close stays available to clients
+CLOSE_RESULT_TIMEOUT: int = 600
+
 # docker name or hostname of the redis service
 REDIS_SERVER: str = 'redis'
+REDIS_PORT: int = 6379
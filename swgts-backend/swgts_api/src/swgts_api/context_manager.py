@@ -1,12 +1,15 @@
+import json
 import logging
 import os
 import sys
 from os import path
 from time import time
-from typing import Tuple, Optional, Any
+from typing import Tuple, Optional, Any, Union
 from uuid import UUID, uuid4
 
-from redis import Redis
+from redis import Redis, WatchError
+
+from .validation import UPLOAD_MODE_FASTQ, UPLOAD_MODE_SEQUENCES
 
 lo = logging.getLogger('Context Manager')
 lo.setLevel('INFO')
@@ -18,7 +21,7 @@ CONFIG: Optional[dict[str, Any]] = None
 def setup_state_server(config: dict[str, Any]):
     global CONFIG, redis_server
     CONFIG = config
-    redis_server = Redis(host=config.get('REDIS_SERVER'))
+    redis_server = Redis(host=config.get('REDIS_SERVER'), port=config.get('REDIS_PORT', 6379))
 
 
 def redis_ping() -> bool:
@@ -45,7 +48,35 @@ def increase_processed_read_count(context: UUID, amount: int) -> int:
     return int(redis_server.incrby(f'context:{context}:processed_reads', amount))
 
 
-def create_context(filenames: list[str]) -> UUID:
+def get_available_references() -> set[str]:
+    """The references the filter servers have loaded, a context can choose one of them at creation."""
+    return {reference.decode() for reference in redis_server.smembers('config:references')}
+
+
+# Contexts created with this preset get theirs chosen by the filter from the length of their reads
+MAPPING_PRESET_AUTO = 'auto'
+
+
+def get_available_mapping_presets() -> set[str]:
+    """The minimap2 presets the filter servers can map with, a context can choose one of them (or 'auto') at
+    creation."""
+    return {preset.decode() for preset in redis_server.smembers('config:mapping_presets')}
+
+
+def filter_server_ready() -> bool:
+    """True if at least one filter server announced within its readiness ttl that it takes jobs. Servers that drain
+    for a restart withdraw their announcement."""
+    return redis_server.zcount('filter:ready', time(), '+inf') > 0
+
+
+def get_upload_format(context: UUID) -> Tuple[int, str]:
+    """The pair count and the upload mode of the context in one round trip."""
+    pair_count, upload_mode = redis_server.mget(f'context:{context}:pair_count', f'context:{context}:upload_mode')
+    return int(pair_count), UPLOAD_MODE_FASTQ if upload_mode is None else upload_mode.decode()
+
+
+def create_context(filenames: list[str], reference: Optional[str] = None,
+                   upload_mode: str = UPLOAD_MODE_FASTQ, mapping_preset: Optional[str] = None) -> UUID:
     new_context_id = uuid4()
     pipeline = redis_server.pipeline()
 
@@ -53,6 +84,18 @@ def create_context(filenames: list[str]) -> UUID:
     pipeline.setex(f'context:{new_context_id}:pending_bytes', CONFIG['CONTEXT_TIMEOUT'], 0)
     pipeline.setex(f'context:{new_context_id}:pair_count', CONFIG['CONTEXT_TIMEOUT'], len(filenames))
     pipeline.setex(f'context:{new_context_id}:processed_reads', CONFIG['CONTEXT_TIMEOUT'], 0)
+    if reference is not None:
+        # Without a reference the filter uses its default one
+        pipeline.setex(f'context:{new_context_id}:reference', CONFIG['CONTEXT_TIMEOUT'], reference)
+    if mapping_preset is not None:
+        # Without a preset the filter uses the one of the reference, 'auto' lets it choose from the read lengths
+        pipeline.setex(f'context:{new_context_id}:mapping_preset', CONFIG['CONTEXT_TIMEOUT'], mapping_preset)
+    if upload_mode != UPLOAD_MODE_FASTQ:
+        pipeline.setex(f'context:{new_context_id}:upload_mode', CONFIG['CONTEXT_TIMEOUT'], upload_mode)
+    if CONFIG['HANDS_OFF'] or upload_mode == UPLOAD_MODE_SEQUENCES:
+        # The filter stores only the ids of the kept reads instead of the whole records. Sequence-only uploads have
+        # nothing worth saving, the client reconstructs the reads.
+        pipeline.setex(f'context:{new_context_id}:hands_off', CONFIG['CONTEXT_TIMEOUT'], 1)
 
     # Store each filename in Redis with expiration time (seconds)
     for pair_index, filename in enumerate(filenames):
@@ -64,22 +107,52 @@ def create_context(filenames: list[str]) -> UUID:
     return new_context_id
 
 
-def change_pending_bytes_count(context: UUID, diff: int) -> int:
-    now_pending = redis_server.incrby(f'context:{context}:pending_bytes', diff)
-    redis_server.expire(f'context:{context}:pending_bytes', CONFIG['CONTEXT_TIMEOUT'])
-    return int(now_pending)
+def refresh_context(context: UUID) -> None:
+    """Reset the expiry of all keys of the context, for clients that keep a context open between uploads."""
+    pair_count = get_pair_count(context)
+    timeout = CONFIG['CONTEXT_TIMEOUT']
+    pipeline = redis_server.pipeline(transaction=False)
+    for key in ('pair_count', 'pending_bytes', 'processed_reads', 'reference', 'hands_off', 'upload_mode', 'speed',
+                'read_ids', 'mapping_preset', 'detected_preset'):
+        pipeline.expire(f'context:{context}:{key}', timeout)
+    for pair_index in range(pair_count):
+        pipeline.expire(f'context:{context}:pair:{pair_index}:filename', timeout)
+        pipeline.expire(f'context:{context}:pair:{pair_index}:reads', timeout)
+    pipeline.execute()
+
+
+def reserve_pending_bytes(context: UUID, diff: int) -> Optional[int]:
+    """Add diff to the pending bytes of the context and return the new count, or None (and change nothing) if the
+    finaliser already started to write the context. Chunks that arrive after the close request but before that are
+    still accepted, the finaliser waits for them."""
+    with redis_server.pipeline(transaction=True) as transaction:
+        while True:
+            try:
+                # Optimistic locking against begin_finalising, which watches the pending bytes
+                transaction.watch(f'context:{context}:close_status')
+                status = transaction.get(f'context:{context}:close_status')
+                if status is not None and status.decode() != CLOSE_STATUS_SEALED:
+                    return None
+                transaction.multi()
+                transaction.incrby(f'context:{context}:pending_bytes', diff)
+                transaction.expire(f'context:{context}:pending_bytes', CONFIG['CONTEXT_TIMEOUT'])
+                return int(transaction.execute()[0])
+            except WatchError:
+                continue
 
 
 def enqueue_chunks(chunks: list[list[list[str]]], context_id: UUID, effective_cumulated_chunk_size: int,
-                   request_reception_time: float):
+                   request_reception_time: float, encoded: Optional[str] = None,
+                   parked: Optional[dict[str, Union[str, bytes]]] = None):
     job_id = uuid4()
     read_count: int = len(chunks)
     if read_count == 0:
         # Nothing to enqueue
-        lo.error(f'I won\'t enqueue an empty job.')
+        lo.error(f'I won\'t enqueue an empty job.', extra={'context': context_id})
         return
     else:
-        lo.info(f'Enqueueing {read_count} reads as job {job_id}.')
+        lo.info(f'Enqueueing {read_count} reads as job {job_id}.',
+                extra={'event': 'enqueue', 'context': context_id, 'job': job_id})
     pair_count: int = len(chunks[0])
 
     # TODO: Implement cleanup strategy for orphaned jobs
@@ -89,11 +162,14 @@ def enqueue_chunks(chunks: list[list[list[str]]], context_id: UUID, effective_cu
     transaction.lpush(f'work:{job_id}', read_count)  # Number of paired reads
     transaction.lpush(f'work:{job_id}', pair_count)  # Pair Count
     transaction.lpush(f'work:{job_id}', request_reception_time)  # Time Enqueue
-
-    for read_idx, reads in enumerate(chunks):
-        for pair_idx, read in enumerate(chunks[read_idx]):
-            for line in chunks[read_idx][pair_idx]:
-                transaction.lpush(f'work:{job_id}', line)
+    # All lines of all reads (mates consecutively) in one element, which the filter parses without decoding it.
+    # encoded is that element if the caller already built it.
+    if encoded is None:
+        encoded = '\n'.join(line for reads in chunks for read in reads for line in read)
+    transaction.lpush(f'work:{job_id}', encoded)
+    for park_id, record in (parked or {}).items():
+        # The whole records of segmented reads, the filter saves them if it keeps the read
+        transaction.setex(f'context:{context_id}:parked:{park_id}', CONFIG['CONTEXT_TIMEOUT'], record)
     transaction.lpush(f'work:queue', f"{job_id}")  # Implicit conversion to string
     transaction.execute()
 
@@ -106,20 +182,102 @@ def get_queue_speed(context: UUID) -> float:
         return sum(last_speed_measurements) / len(last_speed_measurements)
 
 
-def close_context(context: UUID, hands_off: bool) -> Tuple[int, list[str]]:
+# Close states of a context: sealed by the client, being written by the finaliser, then closed or failed
+CLOSE_STATUS_SEALED = 'sealed'
+CLOSE_STATUS_FINALISING = 'finalising'
+CLOSE_STATUS_CLOSED = 'closed'
+CLOSE_STATUS_FAILED = 'failed'
+
+
+def seal_context(context: UUID) -> bool:
+    """Mark the context as completely uploaded, True if it was not sealed before."""
+    return bool(redis_server.set(f'context:{context}:close_status', CLOSE_STATUS_SEALED, nx=True,
+                                 ex=CONFIG['CLOSE_RESULT_TIMEOUT']))
+
+
+def get_close_status(context: UUID) -> Optional[str]:
+    status = redis_server.get(f'context:{context}:close_status')
+    return None if status is None else status.decode()
+
+
+def get_sealed_contexts() -> list[str]:
+    return [key.decode().split(':')[1] for key in redis_server.scan_iter('context:*:close_status')
+            if redis_server.get(key) == CLOSE_STATUS_SEALED.encode()]
+
+
+def begin_finalising(context: UUID) -> bool:
+    """Move a sealed context without pending bytes to finalising, atomically with respect to reserve_pending_bytes."""
+    with redis_server.pipeline(transaction=True) as transaction:
+        try:
+            transaction.watch(f'context:{context}:pending_bytes', f'context:{context}:close_status')
+            pending_bytes = transaction.get(f'context:{context}:pending_bytes')
+            status = transaction.get(f'context:{context}:close_status')
+            if pending_bytes is None or int(pending_bytes) != 0 or status is None or \
+                    status.decode() != CLOSE_STATUS_SEALED:
+                return False
+            transaction.multi()
+            transaction.set(f'context:{context}:close_status', CLOSE_STATUS_FINALISING,
+                            ex=CONFIG['CLOSE_RESULT_TIMEOUT'])
+            transaction.execute()
+            return True
+        except WatchError:
+            # A chunk was accepted in the meantime
+            return False
+
+
+def store_close_result(context: UUID, status: str, result: dict[str, Any]) -> None:
+    """Keep the outcome of finalising a context for CLOSE_RESULT_TIMEOUT seconds, for clients polling the status."""
+    transaction = redis_server.pipeline(transaction=True)
+    transaction.set(f'context:{context}:close_result', json.dumps(result), ex=CONFIG['CLOSE_RESULT_TIMEOUT'])
+    transaction.set(f'context:{context}:close_status', status, ex=CONFIG['CLOSE_RESULT_TIMEOUT'])
+    transaction.execute()
+
+
+def fail_sealed_context(context: UUID, message: str) -> bool:
+    """Store FAILED as outcome of a context that is still sealed, e.g. because it expired while waiting for the
+    filter. A context another api process is finalising (or already closed) is left to that process. True if the
+    failure was stored."""
+    with redis_server.pipeline(transaction=True) as transaction:
+        try:
+            transaction.watch(f'context:{context}:close_status')
+            status = transaction.get(f'context:{context}:close_status')
+            if status is None or status.decode() != CLOSE_STATUS_SEALED:
+                return False
+            transaction.multi()
+            transaction.set(f'context:{context}:close_result', json.dumps({'message': message}),
+                            ex=CONFIG['CLOSE_RESULT_TIMEOUT'])
+            transaction.set(f'context:{context}:close_status', CLOSE_STATUS_FAILED, ex=CONFIG['CLOSE_RESULT_TIMEOUT'])
+            transaction.execute()
+            return True
+        except WatchError:
+            # Another api process began finalising the context in the meantime
+            return False
+
+
+def get_close_result(context: UUID) -> Optional[dict[str, Any]]:
+    result = redis_server.get(f'context:{context}:close_result')
+    return None if result is None else json.loads(result)
+
+
+def close_context(context: UUID, hands_off: bool) -> Tuple[int, Union[list[str], list[int]]]:
+    """Write the kept reads of the context to disk (unless hands_off) and delete it. Returns the processed read count
+    and the ids of the kept reads, or their indices for contexts in the sequence-only upload mode."""
     # FIXME sanity check redis response
     # FIXME redis-server-side CONTEXT_TIMEOUT may happen while writing
     lo.info(f'({context}): Closing Context ...')
     starting_time = time()
 
     context_output_folder = path.join(CONFIG['UPLOAD_DIRECTORY'], str(context))
-    if not hands_off:
-        os.makedirs(context_output_folder)
 
-    pair_count = int(redis_server.get(f'context:{context}:pair_count'))
+    pair_count, upload_mode = get_upload_format(context)
     redis_server.delete(f'context:{context}:pair_count')
+    hands_off = hands_off or upload_mode == UPLOAD_MODE_SEQUENCES
+    if not hands_off:
+        os.makedirs(context_output_folder)
 
-    saved_reads_ids = list(
+    # Hands-off contexts only have the ids of the kept reads, the others the whole records
+    saved_reads_ids = [read_id.decode('ascii') for read_id in redis_server.smembers(f'context:{context}:read_ids')]
+    saved_reads_ids.extend(
         read.split(b'\n', 1)[0].decode('ascii') for read in redis_server.smembers(f'context:{context}:pair:{0}:reads'))
 
     for pair_index in range(pair_count):
@@ -146,6 +304,16 @@ def close_context(context: UUID, hands_off: bool) -> Tuple[int, list[str]]:
     redis_server.delete(f'context:{context}:processed_reads')
     redis_server.delete(f'context:{context}:pending_bytes')
     redis_server.delete(f'context:{context}:speed')
+    redis_server.delete(f'context:{context}:reference')
+    redis_server.delete(f'context:{context}:hands_off')
+    redis_server.delete(f'context:{context}:upload_mode')
+    redis_server.delete(f'context:{context}:read_ids')
+    redis_server.delete(f'context:{context}:mapping_preset')
+    redis_server.delete(f'context:{context}:detected_preset')
+
+    if upload_mode == UPLOAD_MODE_SEQUENCES:
+        # The ids are the indices the client sent
+        saved_reads_ids = sorted(map(int, saved_reads_ids))
 
     finishing_time = time()
     lo.info(f'({context}): Closed Context in {finishing_time - starting_time} seconds')
@@ -155,7 +323,8 @@ def close_context(context: UUID, hands_off: bool) -> Tuple[int, list[str]]:
 
 def get_saved_read_count(context: UUID) -> int:
     # We assume that this context has at least 1 file.
-    return int(redis_server.scard(f'context:{context}:pair:0:reads'))
+    return int(redis_server.scard(f'context:{context}:pair:0:reads')) + \
+        int(redis_server.scard(f'context:{context}:read_ids'))
 
 
 def get_socket_request_info() -> Tuple[int, int]:
@@ -0,0 +1,79 @@
+# coding=utf-8
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Event, Lock, Thread
+from uuid import UUID
+
+from .context_manager import CLOSE_STATUS_CLOSED, CLOSE_STATUS_FAILED, begin_finalising, close_context, \
+    context_exists, fail_sealed_context, get_sealed_contexts, store_close_result
+
+ALL = ['ContextFinaliser']
+
+lo = getLogger('Context Finaliser')
+
+
+class ContextFinaliser:
+    """Writes sealed contexts to disk once the filter processed all their reads. A single scheduler thread checks the
+    sealed contexts every poll_interval seconds and hands those without pending bytes to a pool of threads, so neither
+    the request that closed a context nor the contexts waiting for the filter block anything else. The threads are
+    real OS threads (the api does not monkey patch), file writes and redis round trips in them don't stall the
+    socket.io server. The outcome of every close is stored in redis, see store_close_result."""
+
+    def __init__(self, threads: int, poll_interval: float, hands_off: bool):
+        self.poll_interval = poll_interval
+        self.hands_off = hands_off
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='finaliser')
+        self._sealed: set[str] = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._scheduler = Thread(target=self._schedule, name='finaliser-scheduler', daemon=True)
+
+    def start(self) -> None:
+        # Contexts sealed before a restart of the api
+        for context_id in get_sealed_contexts():
+            self.submit(context_id)
+        self._scheduler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._scheduler.join()
+        self._executor.shutdown(wait=True)
+
+    def submit(self, context_id: UUID) -> None:
+        """Finalise the (already sealed) context as soon as it has no pending bytes left."""
+        with self._lock:
+            self._sealed.add(str(context_id))
+
+    def _schedule(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            with self._lock:
+                sealed = list(self._sealed)
+            for context_id in sealed:
+                try:
+                    if not context_exists(context_id):
+                        # Expired while waiting for the filter, or finalised by another api process, which deleted
+                        # the context and stores the outcome itself
+                        fail_sealed_context(context_id, 'The context expired before all reads were filtered.')
+                        ready = False
+                    else:
+                        ready = begin_finalising(context_id)
+                        if not ready:
+                            continue
+                except Exception as e:
+                    lo.error(f'({context_id}): Could not check the context for finalising: {e}')
+                    continue
+                with self._lock:
+                    self._sealed.discard(context_id)
+                if ready:
+                    self._executor.submit(self._finalise, context_id)
+
+    def _finalise(self, context_id: str) -> None:
+        try:
+            processed_reads, saved_reads = close_context(UUID(context_id), self.hands_off)
+        except Exception as e:
+            lo.error(f'({context_id}): Could not close context: {e}')
+            store_close_result(context_id, CLOSE_STATUS_FAILED, {'message': 'Could not close context.'})
+            return
+        store_close_result(context_id, CLOSE_STATUS_CLOSED,
+                           {'readsSaved': saved_reads, 'readsProcessed': processed_reads})
+        lo.info(f'({context_id}): Finalised context, saved {len(saved_reads)} of {processed_reads}.')
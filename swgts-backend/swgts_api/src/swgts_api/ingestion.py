@@ -0,0 +1,247 @@
+# coding=utf-8
+"""Server-side ingestion of raw FASTQ (optionally gzipped) streams.
+
+Instead of JSON chunks a client streams the plain file, one request per mate (e.g. with chunked transfer encoding,
+curl -T). The api parses the records incrementally, pairs the mates of concurrently streamed files, sizes the pairs
+into jobs of at most the request size and enqueues them. Backpressure is applied by not reading from the request body
+while the context's buffer is full, so TCP flow control slows the client down instead of rejecting data.
+
+The mates of a paired context are matched in the process that receives the streams, so all streams of one context have
+to reach the same api process.
+"""
+import zlib
+from collections import deque
+from logging import getLogger
+from threading import Lock
+from time import time
+from typing import BinaryIO, Callable, Iterator, Optional
+from uuid import UUID
+
+from .validation import SEGMENTS_MARKER, ChunkError, LongReadSegmenter, ValidatedChunk
+
+ALL = ['FastqStreamParser', 'IngestionSession', 'get_ingestion_session']
+
+lo = getLogger('Ingestion')
+
+Record = tuple[bytes, bytes, bytes, bytes]
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_SEGMENTS_MARKER_BYTES = SEGMENTS_MARKER.encode()
+
+
+class FastqStreamParser:
+    """Reads FASTQ records from a binary stream block by block, decompressing gzip (also multi-member files such as
+    bgzip output) on the fly. Every iteration step yields the complete records of one block."""
+
+    def __init__(self, stream: BinaryIO, block_size: int):
+        self.stream = stream
+        self.block_size = block_size
+        self.records = 0
+        self._decompressor = None
+        self._gzipped: Optional[bool] = None
+        self._rest = b''
+
+    def _decompress(self, block: bytes) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = block.startswith(_GZIP_MAGIC)
+        if not self._gzipped:
+            return block
+        output = []
+        while block:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            try:
+                output.append(self._decompressor.decompress(block))
+            except zlib.error as e:
+                raise ChunkError('malformed_fastq', f'The gzip stream is broken: {e}')
+            if not self._decompressor.eof:
+                break
+            # The next gzip member starts in the unused data
+            block = self._decompressor.unused_data
+            self._decompressor = None
+        return b''.join(output)
+
+    def __iter__(self) -> Iterator[list[Record]]:
+        while True:
+            block = self.stream.read(self.block_size)
+            if not block:
+                break
+            data = self._rest + self._decompress(block)
+            lines = data.split(b'\n')
+            # Only complete records, the rest waits for the next block
+            complete = (len(lines) - 1) // 4 * 4
+            self._rest = b'\n'.join(lines[complete:])
+            if complete > 0:
+                yield self._records(lines[:complete])
+        if self._decompressor is not None and not self._decompressor.eof:
+            raise ChunkError('malformed_fastq', 'The gzip stream ended early.')
+        # The last record may lack the final line break, an empty rest is just the final line break
+        lines = self._rest.split(b'\n')
+        while lines and lines[-1] == b'':
+            lines.pop()
+        if len(lines) % 4 != 0:
+            raise ChunkError('malformed_fastq', f'The stream ended within a record after {self.records} records.')
+        if lines:
+            yield self._records(lines)
+
+    def _records(self, lines: list[bytes]) -> list[Record]:
+        if lines[0].endswith(b'\r'):
+            # Windows line endings, rare enough to strip them line by line
+            lines = [line.rstrip(b'\r') for line in lines]
+        headers, sequences, separators, qualities = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+        if not all(header.startswith(b'@') for header in headers) or \
+                not all(separator.startswith(b'+') for separator in separators):
+            raise ChunkError('malformed_fastq', f'The record after record {self.records} is not valid FASTQ.')
+        if any(separator.startswith(_SEGMENTS_MARKER_BYTES) for separator in separators):
+            raise ChunkError('reserved_separator', f'A record after record {self.records} has a separator line '
+                                                   f'starting with {SEGMENTS_MARKER}.')
+        self.records += len(headers)
+        return list(zip(headers, sequences, separators, qualities))
+
+
+class IngestionSession:
+    """Pairs the records of the pair_count streams of one context and turns them into jobs. Every stream is handled
+    by its own request, each of them feeds its records and enqueues the pairs that are complete at that point, so
+    no request waits for another one except when its own mate is too far ahead."""
+
+    def __init__(self, context_id: UUID, pair_count: int):
+        self.context_id = context_id
+        self.pair_count = pair_count
+        self.backlogs: list[deque[Record]] = [deque() for _ in range(pair_count)]
+        self.backlog_bases = [0] * pair_count
+        self.attached = [False] * pair_count
+        self.finished = [False] * pair_count
+        self.counts = [0] * pair_count
+        self._lock = Lock()
+
+    def attach(self, mate: int) -> bool:
+        with self._lock:
+            if self.attached[mate]:
+                return False
+            self.attached[mate] = True
+            return True
+
+    def feed(self, mate: int, records: list[Record]) -> list[list[Record]]:
+        """Add the records of one stream and return the pairs that are complete now."""
+        with self._lock:
+            self.backlogs[mate].extend(records)
+            self.backlog_bases[mate] += sum(len(record[1]) for record in records)
+            self.counts[mate] += len(records)
+            return self._take_pairs()
+
+    def finish(self, mate: int) -> list[list[Record]]:
+        with self._lock:
+            self.finished[mate] = True
+            return self._take_pairs()
+
+    def _take_pairs(self) -> list[list[Record]]:
+        available = min(len(backlog) for backlog in self.backlogs)
+        pairs = [[] for _ in range(available)]
+        for mate, backlog in enumerate(self.backlogs):
+            for pair in pairs:
+                record = backlog.popleft()
+                self.backlog_bases[mate] -= len(record[1])
+                pair.append(record)
+        return pairs
+
+    def has_unpaired(self, mate: int) -> bool:
+        return len(self.backlogs[mate]) > 0
+
+    def is_ahead(self, mate: int, limit: int) -> bool:
+        """True if this stream buffered more than limit bases its mates didn't catch up with yet."""
+        return self.backlog_bases[mate] > limit
+
+    def mismatch(self) -> bool:
+        """True once a stream has records an ended (and completely paired) stream has no mates for."""
+        ended = any(finished and len(backlog) == 0 for finished, backlog in zip(self.finished, self.backlogs))
+        return ended and any(len(backlog) > 0 for backlog in self.backlogs)
+
+    def done(self) -> bool:
+        return all(self.finished)
+
+
+_sessions: dict[str, IngestionSession] = {}
+_sessions_lock = Lock()
+
+
+def get_ingestion_session(context_id: UUID, pair_count: int) -> IngestionSession:
+    with _sessions_lock:
+        session = _sessions.get(str(context_id))
+        if session is None:
+            session = _sessions[str(context_id)] = IngestionSession(context_id, pair_count)
+        return session
+
+
+def drop_ingestion_session(context_id: UUID) -> None:
+    with _sessions_lock:
+        _sessions.pop(str(context_id), None)
+
+
+def split_into_chunks(pairs: list[list[Record]], request_size: int, maximum_read_length: int,
+                      segmenter: Optional[LongReadSegmenter] = None) -> Iterator[ValidatedChunk]:
+    """Size the pairs into chunks of at most request_size bases (a single larger pair forms its own chunk). Pairs
+    with a mate longer than maximum_read_length are segmented (single-end) or dropped, the same rule validate_chunk
+    applies to uploaded chunks."""
+    chunk, size, dropped_pairs, dropped_bases, parked, unfiltered_bases = [], 0, 0, 0, {}, 0
+    for pair in pairs:
+        pair_size = sum(len(record[1]) for record in pair)
+        if max(len(record[1]) for record in pair) > maximum_read_length:
+            if segmenter is None or len(pair) != 1:
+                dropped_pairs += 1
+                dropped_bases += pair_size
+                continue
+            segmented, park_id = segmenter.segment(list(pair[0]))
+            parked[park_id] = b'\n'.join(pair[0])
+            unfiltered_bases += pair_size - segmenter.size()
+            pair, pair_size = [tuple(segmented)], segmenter.size()
+        if chunk and size + pair_size > request_size:
+            yield _validated(chunk, size, dropped_pairs, dropped_bases, parked, unfiltered_bases)
+            chunk, size, dropped_pairs, dropped_bases, parked, unfiltered_bases = [], 0, 0, 0, {}, 0
+        chunk.append(pair)
+        size += pair_size
+    if chunk or dropped_pairs:
+        yield _validated(chunk, size, dropped_pairs, dropped_bases, parked, unfiltered_bases)
+
+
+def _validated(chunk: list[list[Record]], size: int, dropped_pairs: int, dropped_bases: int,
+               parked: dict[str, bytes], unfiltered_bases: int) -> ValidatedChunk:
+    return ValidatedChunk(chunk, size, dropped_pairs, dropped_bases,
+                          b'\n'.join(line for pair in chunk for record in pair for line in record), parked,
+                          unfiltered_bases)
+
+
+def ingest_stream(session: IngestionSession, mate: int, parser: FastqStreamParser, request_size: int,
+                  maximum_read_length: int, enqueue: Callable[[ValidatedChunk, float], bool], mate_backlog_limit: int,
+                  mate_timeout: float, sleep: Callable[[float], None], poll_interval: float,
+                  segmenter: Optional[LongReadSegmenter] = None) -> None:
+    """Read one stream to its end. enqueue(chunk, reception_time) has to apply the backpressure itself (block until
+    the chunk fits into the buffer) and return False if the context can't take data anymore. Raises ChunkError."""
+
+    def enqueue_pairs(pairs: list[list[Record]], reception_time: float) -> None:
+        for chunk in split_into_chunks(pairs, request_size, maximum_read_length, segmenter):
+            if not enqueue(chunk, reception_time):
+                raise ChunkError('context_closed', 'The context is already being closed.')
+        if session.mismatch():
+            raise ChunkError('mate_count_mismatch', f'The streams of the pair have different numbers of records: '
+                                                    f'{session.counts}.')
+
+    for records in parser:
+        enqueue_pairs(session.feed(mate, records), time())
+        waiting_since = time()
+        while session.is_ahead(mate, mate_backlog_limit):
+            # Pause reading until the other streams of the pair caught up
+            if time() - waiting_since > mate_timeout:
+                raise ChunkError('mate_stream_missing', f'The other streams of the pair fell behind by more than '
+                                                        f'{mate_backlog_limit} bases for {mate_timeout} seconds.')
+            sleep(poll_interval)
+    enqueue_pairs(session.finish(mate), time())
+    waiting_since = time()
+    while session.has_unpaired(mate):
+        # The other streams still have to deliver the mates of our last records
+        if session.mismatch():
+            raise ChunkError('mate_count_mismatch', f'The streams of the pair have different numbers of records: '
+                                                    f'{session.counts}.')
+        if time() - waiting_since > mate_timeout:
+            raise ChunkError('mate_stream_missing', f'The other streams of the pair did not deliver the mates of the '
+                                                    f'last records within {mate_timeout} seconds.')
+        sleep(poll_interval)
@@ -0,0 +1,170 @@
+# coding=utf-8
+"""Validation and size accounting of uploaded read chunks, shared by the HTTP and the socket.io upload paths.
+
+A chunk is a list of pairs, every pair a list of pair_count reads, every read a list of four strings (the FASTQ
+lines). In the sequence-only upload mode every pair is the read's index followed by the pair_count sequences instead,
+the client reconstructs the output from its own files with the kept indices.
+"""
+from typing import Any, AnyStr, Optional
+from uuid import uuid4
+
+ALL = ['ChunkError', 'LongReadSegmenter', 'ValidatedChunk', 'validate_chunk', 'validate_sequence_chunk',
+       'UPLOAD_MODE_FASTQ', 'UPLOAD_MODE_SEQUENCES', 'UPLOAD_MODES']
+
+# Negotiated at context creation
+UPLOAD_MODE_FASTQ = 'fastq'
+UPLOAD_MODE_SEQUENCES = 'sequences'
+UPLOAD_MODES = (UPLOAD_MODE_FASTQ, UPLOAD_MODE_SEQUENCES)
+
+# Starts the separator line of a segmented read, followed by the window length and the id of the parked record. Chunks
+# with separators starting with it are rejected.
+SEGMENTS_MARKER = '+SWGTS_SEGMENTS'
+
+
+class ChunkError(ValueError):
+    """A malformed chunk. code is stable and meant for clients, message for humans."""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class ValidatedChunk:
+    """The pairs of a valid chunk that are enqueued and their size in bases (the effective cumulated chunk size).
+    Pairs with a mate longer than the maximum read length are dropped as a whole, their bases are only counted as
+    processed, unless a LongReadSegmenter turned them into segmented reads."""
+
+    def __init__(self, pairs: list[list[list[str]]], size: int, dropped_pairs: int, dropped_bases: int,
+                 encoded: Optional[str], parked: Optional[dict[str, AnyStr]] = None, unfiltered_bases: int = 0):
+        self.pairs = pairs
+        self.size = size
+        self.dropped_pairs = dropped_pairs
+        self.dropped_bases = dropped_bases
+        # The lines of all pairs joined by line breaks (the job format of the filter), if the producer built it anyway
+        self.encoded = encoded
+        # The whole records of the segmented reads by their park id, stored until the filter decided on them
+        self.parked = parked if parked is not None else {}
+        # Bases of segmented reads outside their windows, they are processed without being filtered
+        self.unfiltered_bases = unfiltered_bases
+
+
+class LongReadSegmenter:
+    """Replaces a single-end read that is too long for the buffer by a segmented read: the windows of window bases
+    (and qualities) at segments evenly spread positions, starting with the first window, concatenated. The separator
+    line carries SEGMENTS_MARKER, the window length and a park id, under which the whole record is stored until the
+    filter decided on the read from its windows. Works on str and on bytes lines."""
+
+    def __init__(self, window: int, segments: int):
+        if window <= 0 or segments <= 0:
+            raise ValueError(f'Invalid long read segmentation: {segments} windows of {window} bases')
+        self.window = window
+        self.segments = segments
+
+    def size(self) -> int:
+        """The bases of a segmented read."""
+        return self.window * self.segments
+
+    def segment(self, read: list[AnyStr]) -> tuple[list[AnyStr], str]:
+        """Return the segmented read and its park id."""
+        header, sequence, _, quality = read
+        park_id = uuid4().hex
+        last = len(sequence) - self.window
+        starts = [last * index // (self.segments - 1) for index in range(self.segments)] if self.segments > 1 else [0]
+        separator = f'{SEGMENTS_MARKER} {self.window} {park_id}'
+        empty = sequence[:0]
+        return [header,
+                empty.join(sequence[start:start + self.window] for start in starts),
+                separator if isinstance(sequence, str) else separator.encode(),
+                # Empty in the sequence-only upload mode
+                empty.join(quality[start:start + self.window] for start in starts) if quality else quality], park_id
+
+
+def validate_chunk(chunk: Any, pair_count: int, maximum_read_length: int,
+                   segmenter: Optional[LongReadSegmenter] = None) -> ValidatedChunk:
+    """Validate the structure of a chunk and size it, raises ChunkError on the first problem found. With a segmenter
+    single-end reads longer than maximum_read_length are segmented instead of dropped."""
+    if not isinstance(chunk, list):
+        raise ChunkError('chunk_not_a_list', 'Passed read chunks are not in list format.')
+    lengths = []
+    for pair in chunk:
+        if not isinstance(pair, list):
+            raise ChunkError('pair_not_a_list', 'There is a pair which is not a list.')
+        if len(pair) != pair_count:
+            raise ChunkError('wrong_pair_size', f'Expected {pair_count}-paired reads but found pair with {len(pair)} '
+                                                f'reads.')
+        for read in pair:
+            if not isinstance(read, list):
+                raise ChunkError('read_not_a_list', 'There is a read which is not a list.')
+            if len(read) != 4:
+                raise ChunkError('wrong_read_size', 'There is a read with a length != 4.')
+            for line in read:
+                if not isinstance(line, str):
+                    raise ChunkError('line_not_a_string', 'There is a FASTQ line which is not a string.')
+                # The filter splits jobs at line breaks
+                if '\n' in line:
+                    raise ChunkError('line_break_in_line', 'There is a FASTQ line containing a line break.')
+            # Only a LongReadSegmenter may mark a read as segmented, the filter would look for its windows
+            if read[2].startswith(SEGMENTS_MARKER):
+                raise ChunkError('reserved_separator', f'There is a separator line starting with {SEGMENTS_MARKER}.')
+            lengths.append(len(read[1]))
+    return _size_chunk(chunk, lengths, pair_count, maximum_read_length, segmenter, park=True)
+
+
+def validate_sequence_chunk(chunk: Any, pair_count: int, maximum_read_length: int,
+                            segmenter: Optional[LongReadSegmenter] = None) -> ValidatedChunk:
+    """Validate and size a chunk of the sequence-only upload mode. The pairs are converted to the regular format, with
+    the index as header line and an empty quality line (which the pre-filter ignores). Segmented reads are not parked,
+    the client reconstructs them itself."""
+    if not isinstance(chunk, list):
+        raise ChunkError('chunk_not_a_list', 'Passed read chunks are not in list format.')
+    pairs, lengths, indices = [], [], set()
+    for pair in chunk:
+        if not isinstance(pair, list):
+            raise ChunkError('pair_not_a_list', 'There is a pair which is not a list.')
+        if len(pair) != pair_count + 1:
+            raise ChunkError('wrong_pair_size', f'Expected a read index and {pair_count} sequences per pair but found '
+                                                f'a pair with {len(pair)} elements.')
+        index = pair[0]
+        # bool is a subclass of int, but not a valid index
+        if type(index) is not int or index < 0:
+            raise ChunkError('index_not_an_integer', 'There is a read index which is not a non-negative integer.')
+        # A read sent twice would be counted twice as pending and as processed
+        if index in indices:
+            raise ChunkError('duplicate_index', 'There is a read index that occurs more than once in the chunk.')
+        indices.add(index)
+        for sequence in pair[1:]:
+            if not isinstance(sequence, str):
+                raise ChunkError('line_not_a_string', 'There is a sequence which is not a string.')
+            if '\n' in sequence:
+                raise ChunkError('line_break_in_line', 'There is a sequence containing a line break.')
+            lengths.append(len(sequence))
+        # Four lines per mate, the last (quality) line is empty
+        pairs.append([[str(index), sequence, '+', ''] for sequence in pair[1:]])
+    return _size_chunk(pairs, lengths, pair_count, maximum_read_length, segmenter, park=False)
+
+
+def _size_chunk(chunk: list[list[list[str]]], lengths: list[int], pair_count: int, maximum_read_length: int,
+                segmenter: Optional[LongReadSegmenter], park: bool) -> ValidatedChunk:
+    size = sum(lengths)
+    if len(lengths) == 0 or max(lengths) <= maximum_read_length:
+        return ValidatedChunk(chunk, size, 0, 0, None)
+
+    # Rare: Segment (single-end) or drop every pair with a mate that could never fit into the buffer
+    pairs, kept_size, dropped_pairs, dropped_bases, parked, unfiltered_bases = [], 0, 0, 0, {}, 0
+    for index, pair in enumerate(chunk):
+        pair_lengths = lengths[index * pair_count:(index + 1) * pair_count]
+        if max(pair_lengths) <= maximum_read_length:
+            pairs.append(pair)
+            kept_size += sum(pair_lengths)
+        elif segmenter is not None and pair_count == 1:
+            segmented, park_id = segmenter.segment(pair[0])
+            if park:
+                parked[park_id] = '\n'.join(pair[0])
+            pairs.append([segmented])
+            kept_size += segmenter.size()
+            unfiltered_bases += pair_lengths[0] - segmenter.size()
+        else:
+            dropped_pairs += 1
+            dropped_bases += sum(pair_lengths)
+    return ValidatedChunk(pairs, kept_size, dropped_pairs, dropped_bases, None, parked, unfiltered_bases)
@@ -0,0 +1,62 @@
+# coding=utf-8
+import importlib
+import os
+import sys
+from typing import Optional
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+@pytest.fixture(scope='session')
+def api(tmp_path_factory):
+    """The api module, imported against a mocked redis. The configuration resolves its directories against the working
+    directory, so the import runs in a temporary one."""
+    working_directory = tmp_path_factory.mktemp('api')
+    (working_directory / 'output').mkdir()
+    previous_directory = os.getcwd()
+    os.chdir(working_directory)
+    try:
+        with mock.patch('redis.Redis'):
+            api_module = importlib.import_module('swgts_api.app')
+    finally:
+        os.chdir(previous_directory)
+    yield api_module
+    api_module.finaliser.stop()
+
+
+@pytest.fixture
+def redis_server(api):
+    """The mocked redis of the api, backed by a plain dict for the plain GET/MGET/EXISTS/SET calls of the upload and
+    close paths and the transaction of reserve_pending_bytes."""
+    context_manager = importlib.import_module('swgts_api.context_manager')
+    store: dict[str, bytes] = {}
+    server = context_manager.redis_server
+    server.reset_mock()
+    server.get.side_effect = lambda key: store.get(key)
+    server.mget.side_effect = lambda *keys: [store.get(key) for key in keys]
+    server.exists.side_effect = lambda *keys: sum(key in store for key in keys)
+    server.lrange.side_effect = lambda key, start, end: []
+
+    def set_(key: str, value, nx: bool = False, ex=None) -> Optional[bool]:
+        if nx and key in store:
+            return None
+        store[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    server.set.side_effect = set_
+    transaction = server.pipeline.return_value.__enter__.return_value
+    transaction.get.side_effect = server.get.side_effect
+    results: list[int] = []
+
+    def incrby(key: str, amount: int) -> None:
+        store[key] = str(int(store.get(key, b'0')) + amount).encode()
+        results.append(int(store[key]))
+
+    transaction.multi.side_effect = results.clear
+    transaction.incrby.side_effect = incrby
+    transaction.execute.side_effect = lambda: list(results)
+    server.store = store
+    return server
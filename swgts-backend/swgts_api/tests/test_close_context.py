@@ -0,0 +1,51 @@
+# coding=utf-8
+"""A closeContext request for a context that is already sealed: the running watch_close answers while it is closed,
+afterwards the requesting client gets the stored outcome."""
+import json
+from typing import Optional
+from unittest import mock
+
+import pytest
+
+CONTEXT_ID = '5d1c7f0e-2b8a-4f3e-9c61-0a7d4e2b9f35'
+
+
+@pytest.fixture
+def close(api, redis_server):
+    """Send closeContext for a context with the given close status and result and return the events the client
+    received."""
+    client = api.socketio.test_client(api.app)
+
+    def send(status: str, result: Optional[dict] = None):
+        redis_server.store[f'context:{CONTEXT_ID}:close_status'] = status.encode()
+        if result is not None:
+            redis_server.store[f'context:{CONTEXT_ID}:close_result'] = json.dumps(result).encode()
+        client.get_received()
+        with mock.patch.object(api.finaliser, 'submit') as submit, \
+                mock.patch.object(api.socketio, 'start_background_task') as start_background_task:
+            client.emit('closeContext', {'contextId': CONTEXT_ID})
+        assert not submit.called and not start_background_task.called
+        return [(event['name'], event['args'][0]) for event in client.get_received()]
+
+    yield send
+    client.disconnect()
+
+
+@pytest.mark.parametrize('status', ['sealed', 'finalising'])
+def test_still_closing(close, status):
+    assert close(status) == []
+
+
+def test_closed(close):
+    events = close('closed', {'readsSaved': ['read-1'], 'readsProcessed': 3})
+    assert events == [('contextClosed', {'contextId': CONTEXT_ID, 'savedReads': ['read-1'], 'processedReads': 3})]
+
+
+def test_failed(close):
+    events = close('failed', {'message': 'Reference unavailable'})
+    assert events == [('contextCloseError', {'message': 'Reference unavailable', 'code': 'close_failed'})]
+
+
+@pytest.mark.parametrize('status', ['closed', 'failed'])
+def test_result_expired(close, status):
+    assert [(name, args['code']) for name, args in close(status)] == [('contextCloseError', 'context_closed')]
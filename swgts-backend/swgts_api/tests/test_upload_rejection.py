@@ -0,0 +1,144 @@
+# coding=utf-8
+"""Every way handle_data_upload rejects a chunk: the client gets dataUploadError with the code and its chunk id, and
+nothing about the context is changed in redis."""
+from typing import Optional
+from unittest import mock
+
+import pytest
+
+CONTEXT_ID = '0b0e8a4e-5f0c-4a57-9d3c-6f4f3c7b8a11'
+REQUEST_SIZE = 1000
+
+
+def read(sequence: str = 'ACGT') -> list[str]:
+    return ['@read', sequence, '+', 'I' * len(sequence)]
+
+
+@pytest.fixture
+def context(api, redis_server):
+    """A context expecting single-end FASTQ chunks with an empty buffer."""
+
+    def create(pair_count: int = 1, upload_mode: Optional[str] = None, pending_bytes: int = 0) -> str:
+        upload_mode = upload_mode or api.UPLOAD_MODE_FASTQ
+        redis_server.store.update({
+            f'context:{CONTEXT_ID}:pair_count': str(pair_count).encode(),
+            f'context:{CONTEXT_ID}:upload_mode': upload_mode.encode(),
+            f'context:{CONTEXT_ID}:pending_bytes': str(pending_bytes).encode(),
+            'config:request_size_factor': b'8',
+            'config:request_size': str(REQUEST_SIZE).encode(),
+        })
+        return CONTEXT_ID
+
+    return create
+
+
+@pytest.fixture
+def upload(api, redis_server):
+    """Send a dataUpload event and return the dataUploadError events and the mocks of the calls that decide about or
+    process the chunk."""
+    client = api.socketio.test_client(api.app)
+
+    def send(payload):
+        client.get_received()
+        with mock.patch.object(api, 'get_upload_format', wraps=api.get_upload_format) as get_upload_format, \
+                mock.patch.object(api, 'reserve_pending_bytes',
+                                  wraps=api.reserve_pending_bytes) as reserve_pending_bytes, \
+                mock.patch.object(api, 'enqueue_chunks') as enqueue_chunks:
+            client.emit('dataUpload', payload)
+        errors = [event['args'][0] for event in client.get_received() if event['name'] == 'dataUploadError']
+        return errors, {'get_upload_format': get_upload_format, 'reserve_pending_bytes': reserve_pending_bytes,
+                        'enqueue_chunks': enqueue_chunks}
+
+    yield send
+    client.disconnect()
+
+
+def assert_rejected(errors, calls, code: str, chunk_id, called: tuple[str, ...] = ()) -> None:
+    """Only the calls named in called happened before the chunk was rejected."""
+    assert [(error['code'], error['chunkId']) for error in errors] == [(code, chunk_id)]
+    for name, call in calls.items():
+        if name in called:
+            call.assert_called_once()
+        else:
+            assert not call.called, f'{name} was called although the chunk was rejected before'
+
+
+@pytest.mark.parametrize('payload', [None, [], 'data', 42])
+def test_invalid_payload(upload, redis_server, payload):
+    errors, calls = upload(payload)
+    assert_rejected(errors, calls, 'invalid_payload', None)
+    assert not redis_server.mget.called
+
+
+@pytest.mark.parametrize('context_id', [CONTEXT_ID, None, 7])
+def test_context_not_found(upload, redis_server, context_id):
+    errors, calls = upload({'data': [[read()]], 'bytes': 4, 'contextId': context_id, 'chunkId': 3})
+    assert_rejected(errors, calls, 'context_not_found', 3)
+    assert not redis_server.mget.called
+
+
+@pytest.mark.parametrize('chunk, code', [
+    ('ACGT', 'chunk_not_a_list'),
+    (['ACGT'], 'pair_not_a_list'),
+    ([[read(), read()]], 'wrong_pair_size'),
+    ([['@read']], 'read_not_a_list'),
+    ([[read()[:3]]], 'wrong_read_size'),
+    ([[['@read', 4, '+', 'I']]], 'line_not_a_string'),
+    ([[['@read', 'AC\nGT', '+', 'IIIII']]], 'line_break_in_line'),
+    ([[['@read', 'ACGT', '+SWGTS_SEGMENTS 2 park', 'IIII']]], 'reserved_separator'),
+])
+def test_invalid_fastq_chunk(upload, context, chunk, code):
+    errors, calls = upload({'data': chunk, 'bytes': 4, 'contextId': context(), 'chunkId': 'chunk-1'})
+    assert_rejected(errors, calls, code, 'chunk-1', called=('get_upload_format',))
+
+
+@pytest.mark.parametrize('chunk, code', [
+    ({'0': 'ACGT'}, 'chunk_not_a_list'),
+    ([0, 'ACGT'], 'pair_not_a_list'),
+    ([[0, 'ACGT', 'ACGT']], 'wrong_pair_size'),
+    ([['0', 'ACGT']], 'index_not_an_integer'),
+    ([[True, 'ACGT']], 'index_not_an_integer'),
+    ([[-1, 'ACGT']], 'index_not_an_integer'),
+    ([[0, 'ACGT'], [0, 'ACGT']], 'duplicate_index'),
+    ([[0, 4]], 'line_not_a_string'),
+    ([[0, 'AC\nGT']], 'line_break_in_line'),
+])
+def test_invalid_sequence_chunk(api, upload, context, chunk, code):
+    errors, calls = upload({'data': chunk, 'bytes': 4, 'contextId': context(upload_mode=api.UPLOAD_MODE_SEQUENCES),
+                            'chunkId': 5})
+    assert_rejected(errors, calls, code, 5, called=('get_upload_format',))
+
+
+def test_more_than_requested(upload, context):
+    errors, calls = upload({'data': [[read('A' * (REQUEST_SIZE + 1))]], 'bytes': REQUEST_SIZE + 1,
+                            'contextId': context(), 'chunkId': 8})
+    assert_rejected(errors, calls, 'more_than_requested', 8, called=('get_upload_format',))
+    assert errors[0]['requestSize'] == REQUEST_SIZE
+
+
+def test_buffer_full(api, upload, context):
+    pending_bytes = api.app.config['MAXIMUM_PENDING_BYTES'] - 10
+    errors, calls = upload({'data': [[read('A' * 20)]], 'bytes': 20, 'contextId': context(pending_bytes=pending_bytes),
+                            'chunkId': 9})
+    assert_rejected(errors, calls, 'buffer_full', 9, called=('get_upload_format',))
+    assert errors[0]['pendingBytes'] == pending_bytes
+    assert errors[0]['retryAfter'] > 0
+
+
+def test_context_closed(api, upload, context, redis_server):
+    # The finaliser already started to write the context, so reserve_pending_bytes refuses the chunk
+    context_id = context(pending_bytes=0)
+    redis_server.store[f'context:{context_id}:close_status'] = api.CLOSE_STATUS_FINALISING.encode()
+    errors, calls = upload({'data': [[read()]], 'bytes': 4, 'contextId': context_id, 'chunkId': 11})
+    assert_rejected(errors, calls, 'context_closed', 11, called=('get_upload_format', 'reserve_pending_bytes'))
+    assert redis_server.store[f'context:{context_id}:pending_bytes'] == b'0'
+
+
+def test_accepted_chunk_is_enqueued(upload, context, redis_server):
+    # The counterpart of the rejections: the same mocks do see an accepted chunk
+    errors, calls = upload({'data': [[read()]], 'bytes': 4, 'contextId': context(), 'chunkId': 10})
+    assert errors == []
+    calls['get_upload_format'].assert_called_once_with(CONTEXT_ID)
+    calls['reserve_pending_bytes'].assert_called_once_with(CONTEXT_ID, 4)
+    assert calls['enqueue_chunks'].call_count == 1
+    assert redis_server.store[f'context:{CONTEXT_ID}:pending_bytes'] == b'4'
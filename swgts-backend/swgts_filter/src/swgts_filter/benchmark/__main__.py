@@ -1,127 +1,222 @@
 # coding=utf-8
+"""Filter accuracy and throughput benchmark.
+
+Every file in the modes directory is a python file defining
+    params = {...}   # keyword arguments of swgts_filter.filter.Filter
+    samples = [...]  # fastq files relative to the samples directory, [file_1, file_2] for paired-end samples
+and optionally
+    prefilter = {...}  # keyword arguments of swgts_filter.filter.Prefilter
+
+Read ids have to start with human_ or pathogen_ (see swgts_filter.benchmark.synthetic), filtering a human read counts
+as a true positive. Each filter mode x sample combination runs in its own process; use --processes 1 when absolute
+throughput numbers matter, parallel runs compete for CPU and memory bandwidth.
+
+    python -m swgts_filter.benchmark run --output results.json
+    python -m swgts_filter.benchmark compare baseline.json results.json
+"""
 import glob
-import gzip
-import sys
+import json
 import os
-import time
-from importlib import reload
-from typing import Optional
-
-from Bio import SeqIO
+import platform
+import resource
+import runpy
+import sys
+from argparse import ArgumentParser, Namespace
+from array import array
+from multiprocessing import Pool
+from time import perf_counter, process_time, time
+from typing import Any, Union
 
-import filter
 from .config import TEST_MODES_PATH, TEST_SAMPLES_PATH
+from .fastq import read_fastq_pairs
+
+# Metrics compared between runs and whether larger values are better
+COMPARED_METRICS: dict[str, bool] = {
+    'reads_per_second': True,
+    'bases_per_second': True,
+    'latency_p99_ms': False,
+    'peak_rss_mb': False,
+    'precision': True,
+    'recall': True,
+    'f1': True,
+}
+ACCURACY_METRICS = ['precision', 'recall', 'f1']
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def load_mode(filepath: str) -> dict[str, Any]:
+    namespace = runpy.run_path(filepath)
+    if 'params' not in namespace:
+        raise ValueError(f"{filepath} hasn't initialized the benchmark (params missing). Please check the file!")
+    if 'samples' not in namespace:
+        raise ValueError(f"{filepath} hasn't provided any samples. Please check the file!")
+    return {'params': namespace['params'], 'samples': namespace['samples'],
+            'prefilter': namespace.get('prefilter')}
+
+
+def classification_metrics(tp: int, tn: int, fp: int, fn: int) -> dict[str, float]:
+    return {
+        'precision': tp / (tp + fp) if tp + fp > 0 else 0.0,
+        'recall': tp / (tp + fn) if tp + fn > 0 else 0.0,
+        'f1': 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else 0.0,
+    }
+
+
+def run_task(mode_name: str, mode: dict[str, Any], sample: Union[str, list[str]]) -> dict[str, Any]:
+    """Benchmark one filter mode on one sample. Runs in a fresh process, so that the peak RSS belongs to this task."""
+    # Imported here so that listing or comparing results works without mappy
+    from swgts_filter.filter import Filter
+
+    files = [sample] if isinstance(sample, str) else list(sample)
+    files = [os.path.join(TEST_SAMPLES_PATH, f) for f in files]
+
+    load_start = perf_counter()
+    active_filter = Filter(**mode['params'], prefilter=mode['prefilter'])
+    load_seconds = perf_counter() - load_start
+
+    latencies = array('d')
+    counts = {'reads': 0, 'bases': 0, 'filtered': 0, 'unlabelled': 0, 'tp': 0, 'tn': 0, 'fp': 0, 'fn': 0}
+    wall_start, cpu_start = perf_counter(), process_time()
+
+    for read in read_fastq_pairs(files):
+        start = perf_counter()
+        keep = active_filter.is_read_legal(read)
+        latencies.append(perf_counter() - start)
+
+        counts['reads'] += 1
+        counts['bases'] += sum(len(mate[1]) for mate in read)
+        counts['filtered'] += not keep
+
+        label = read[0][0][1:].split(maxsplit=1)[0].split('_')[0] if len(read[0][0]) > 1 else ''
+        if label not in ['human', 'pathogen']:
+            counts['unlabelled'] += 1
+            continue
+        should_filter = label == 'human'
+        if should_filter:
+            counts['tp' if not keep else 'fn'] += 1
+        else:
+            counts['fp' if not keep else 'tn'] += 1
+
+    wall_seconds, cpu_seconds = perf_counter() - wall_start, process_time() - cpu_start
+    sorted_latencies = sorted(latencies)
+
+    result = {
+        'mode': mode_name,
+        'sample': sample,
+        'params': mode['params'],
+        'prefilter': mode['prefilter'],
+        'load_seconds': load_seconds,
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds,
+        'reads_per_second': counts['reads'] / wall_seconds if wall_seconds > 0 else 0.0,
+        'bases_per_second': counts['bases'] / wall_seconds if wall_seconds > 0 else 0.0,
+        'latency_p50_ms': percentile(sorted_latencies, 0.5) * 1000,
+        'latency_p90_ms': percentile(sorted_latencies, 0.9) * 1000,
+        'latency_p99_ms': percentile(sorted_latencies, 0.99) * 1000,
+        'latency_max_ms': (sorted_latencies[-1] if sorted_latencies else 0.0) * 1000,
+        # ru_maxrss is reported in KiB on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    result.update(counts)
+    result.update(classification_metrics(counts['tp'], counts['tn'], counts['fp'], counts['fn']))
+    print(f"{mode_name} on {sample}: {result['reads_per_second']:.1f} reads/s, F1 {result['f1']:.4f}, "
+          f"filtered {counts['filtered']} of {counts['reads']}")
+    return result
+
+
+def run(arguments: Namespace) -> int:
+    mode_files = sorted(glob.glob(os.path.join(arguments.modes, '*.py')))
+    print(f'Found the following filter configurations: {mode_files}')
+    tasks = []
+    for mode_file in mode_files:
+        mode = load_mode(mode_file)
+        mode_name = os.path.splitext(os.path.basename(mode_file))[0]
+        tasks.extend((mode_name, mode, sample) for sample in mode['samples'])
+
+    if len(tasks) == 0:
+        print('Nothing to benchmark.')
+        return 1
+
+    processes = arguments.processes or min(len(tasks), os.cpu_count() or 1)
+    print(f'Running {len(tasks)} benchmarks in {processes} processes ...')
+    # maxtasksperchild=1 gives every benchmark a fresh process and thus its own peak RSS and index
+    with Pool(processes=processes, maxtasksperchild=1) as pool:
+        results = pool.starmap(run_task, tasks, chunksize=1)
+
+    report = {
+        'created': time(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'processes': processes,
+        'results': results,
+    }
+    with open(arguments.output, 'w') as handle:
+        json.dump(report, handle, indent=2)
+    print(f'Wrote results to {arguments.output}')
+    return 0
+
+
+def compare(arguments: Namespace) -> int:
+    """Print the relative change of every metric and return 1 if a run regressed beyond the tolerances."""
+    with open(arguments.baseline) as handle:
+        baseline = {(r['mode'], json.dumps(r['sample'])): r for r in json.load(handle)['results']}
+    with open(arguments.candidate) as handle:
+        candidate = {(r['mode'], json.dumps(r['sample'])): r for r in json.load(handle)['results']}
+
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        print(f'{key[0]} on {key[1]}:')
+        for metric, larger_is_better in COMPARED_METRICS.items():
+            old, new = baseline[key][metric], candidate[key][metric]
+            if metric in ACCURACY_METRICS:
+                change = new - old
+                regressed = change < -arguments.accuracy_tolerance
+                description = f'{old:.4f} -> {new:.4f} ({change:+.4f})'
+            else:
+                change = (new - old) / old if old != 0 else 0.0
+                regressed = (change < -arguments.tolerance) if larger_is_better else (change > arguments.tolerance)
+                description = f'{old:.2f} -> {new:.2f} ({change:+.1%})'
+            regressions += regressed
+            print(f"  {metric}: {description}{'  REGRESSION' if regressed else ''}")
+
+    for key in sorted(baseline.keys() ^ candidate.keys()):
+        print(f'{key[0]} on {key[1]} is only part of one run')
+
+    print(f'{regressions} regressions')
+    return 1 if regressions > 0 else 0
+
+
+def get_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Benchmark filter accuracy and throughput.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run every filter mode on its samples.')
+    run_parser.add_argument('--modes', type=str, default=TEST_MODES_PATH,
+                            help='The directory containing the filter mode files.')
+    run_parser.add_argument('--processes', type=int,
+                            help='Number of benchmarks running in parallel, defaults to the number of CPUs.')
+    run_parser.add_argument('--output', type=str, required=True, help='The json file to write the results to.')
+    run_parser.set_defaults(function=run)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('baseline', type=str)
+    compare_parser.add_argument('candidate', type=str)
+    compare_parser.add_argument('--tolerance', type=float, default=0.05,
+                                help='Relative throughput, latency and memory change tolerated.')
+    compare_parser.add_argument('--accuracy-tolerance', type=float, default=0.001,
+                                help='Absolute precision, recall and F1 decrease tolerated.')
+    compare_parser.set_defaults(function=compare)
+    return parser
 
-# TODO: Multiprocessing to add parallel processing of benchmarks?
 
 if __name__ == '__main__':
-
-    if len(sys.argv) != 2:
-        print('specify output file ...')
-
-    TEST_MODES = []
-    for f in glob.glob(os.path.join(TEST_MODES_PATH, '*')):
-        TEST_MODES.append(os.path.join(TEST_MODES_PATH, f))
-
-
-    print(f'Found the following filter configurations: {TEST_MODES}')
-    with open(sys.argv[1],'w') as outfile:
-        print("Running Benchmarks ...")
-        for filter_cfg in TEST_MODES:
-
-            with open(filter_cfg, 'r') as cfg_file:
-
-                content = cfg_file.read()
-
-                params: Optional[dict[str, str]] = None
-                samples: Optional[list[str]] = None
-
-                exec(content)  # Very Python
-
-                if params is None:
-                    # The exec should have initialized parameters
-                    print(f"{filter_cfg} hasn't initialized the benchmark. Please check the file!")
-                    sys.exit(-1)
-
-
-                if samples is None:
-                    # The exec should have initialized samples
-                    print(f"{filter_cfg} hasn't provided any samples. Please check the file!")
-                    sys.exit(-1)
-
-                for sample in samples:
-
-                    #append path
-                    sample = os.path.join(TEST_SAMPLES_PATH, sample)
-
-                    start = time.time()
-
-                    reload(filter)
-
-                    print(f'Initializing the filter with: {params}')  # params comes from the exec
-                    filter.init_filter(params)
-                    # TODO: Actually do something
-                    print(f'Benchmarking the file: {sample}')
-
-                    reads = None
-
-                    if sample.endswith('.gz'):
-                        handle = gzip.open(sample, "rt")
-                        reads = SeqIO.parse(handle, 'fastq')
-                    else:
-                        reads = SeqIO.parse(sample, 'fastq')
-
-                    total = 0
-                    filtered = 0
-
-                    tp = 0
-                    tn = 0
-                    fp = 0
-                    fn = 0
-
-                    for read in reads:
-                        total += 1
-
-                        hasFiltered = not filter.is_read_legal(
-                            ['dummyid',
-                             read.seq,
-                             '+',
-                             'dummyquality'
-                             ])
-
-                        identifier = read.id.split('_')[0]
-                        try:
-                            assert(identifier in ['human','pathogen'])
-                        except AssertionError as msg:
-                                print('Identifier: {} makes no sense (should be human or pathogen)'.format(identifier))
-                        shouldFilter = identifier == 'human'
-
-                        filtered += hasFiltered
-
-                        if shouldFilter and hasFiltered:
-                            tp += 1
-                        elif not shouldFilter and hasFiltered:
-                            fp += 1
-                        elif shouldFilter and not hasFiltered:
-                            fn += 1
-                        elif not shouldFilter and not hasFiltered:
-                            tn += 1
-
-                    end = time.time()
-
-                    elapsed_time = end - start
-                    print('Filtered {} of {} reads! (elapsed time: {}s)'.format(filtered,total,elapsed_time))
-                    print('TP: {} TN: {} FP: {} FN: {}'.format(tp, tn, fp, fn))
-
-                    if filtered == 0:
-                        print('Nothing was filtered ... this is probably suspicious!')
-                    else:
-                        prec = tp / (tp + fp)
-                        rec = tp / (tp + fn)
-                        f1 = 2 * tp / (2 * tp + fp + fn)
-                        print('Precision: {} Recall: {} F1: {}'.format(prec,rec,f1))
-
-                    #Write to csv for easier downstream analysis
-                    outfile.write('{},{},{},{},{},{},{},{},{},{},{},{}\n'.format(
-                        params,sample,filtered,total,elapsed_time,tp,tn,fp,fn,prec,rec,f1
-                    ))
\ No newline at end of file
+    parsed_arguments = get_argument_parser().parse_args()
+    sys.exit(parsed_arguments.function(parsed_arguments))
@@ -0,0 +1,103 @@
+# coding=utf-8
+"""Compare the decisions of a filter fast path with the full minimap2 path on the same reads.
+
+Examples:
+    python -m swgts_filter.benchmark.agreement --fast-path sketch --mode COMBINED \
+        --database combinedHumanCovid.mmi --sketch-reference EPI_ISL_402124.fasta.gz reads.fastq.gz
+    python -m swgts_filter.benchmark.agreement --fast-path mate-first --preset sr \
+        --database combinedHumanCovid.mmi reads_1.fastq.gz reads_2.fastq.gz
+"""
+import json
+from argparse import ArgumentParser
+from time import perf_counter
+
+from swgts_filter.filter import Filter
+from swgts_filter.server import config
+from .fastq import read_fastq_pairs
+
+# Fast paths return the keep decision of a read or None if they leave it to the full path
+FAST_PATHS = {
+    'sketch': Filter.classify_with_sketch,
+    'mate-first': Filter.classify_mate_first,
+}
+
+
+def get_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Report how often a filter fast path agrees with the full mapping path.')
+    parser.add_argument('--fast-path', type=str, default='sketch', choices=list(FAST_PATHS))
+    parser.add_argument('--mode', type=str, default=config.FILTER_MODE, choices=['COMBINED', 'NEGATIVE'])
+    parser.add_argument('--preset', type=str, default=config.MAPPING_PRESET)
+    parser.add_argument('--database', type=str, default=config.MINIMAP2_REFERENCE_DATABASE)
+    parser.add_argument('--contig', type=str, default=config.MINIMAP2_POSITIVE_CONTIG)
+    parser.add_argument('--quality-threshold', type=int, default=config.MINIMAP2_QUALITY_THRESHOLD)
+    parser.add_argument('--mate-first-minimum-mapq', type=int, default=config.MATE_FIRST_MINIMUM_MAPQ)
+    parser.add_argument('--sketch-reference', type=str,
+                        help='The (gzipped) pathogen FASTA the k-mer sketch is built from (sketch only).')
+    parser.add_argument('--kmer-size', type=int, default=config.SKETCH_KMER_SIZE)
+    parser.add_argument('--stride', type=int, default=config.SKETCH_STRIDE)
+    parser.add_argument('--positive-fraction', type=float, default=config.SKETCH_POSITIVE_FRACTION)
+    parser.add_argument('--minimum-kmers', type=int, default=config.SKETCH_MINIMUM_KMERS)
+    parser.add_argument('--negative-minimum-kmers', type=int, default=config.SKETCH_NEGATIVE_MINIMUM_KMERS)
+    parser.add_argument('--output', type=str, help='Write the report as json to this file.')
+    parser.add_argument('files', type=str, nargs='+', help='The fastq file(s), two for paired-end reads.')
+    return parser
+
+
+def main() -> None:
+    parser = get_argument_parser()
+    arguments = parser.parse_args()
+    if arguments.fast_path == 'sketch' and arguments.sketch_reference is None:
+        parser.error('--sketch-reference is required for the sketch fast path')
+    if arguments.fast_path == 'mate-first' and len(arguments.files) < 2:
+        parser.error('the mate-first fast path needs paired-end files')
+
+    # The full path always maps whole pairs, the fast path is called explicitly below
+    active_filter = Filter(arguments.mode, arguments.preset, arguments.database, arguments.contig,
+                           arguments.quality_threshold, 'pair', arguments.mate_first_minimum_mapq,
+                           arguments.sketch_reference, arguments.kmer_size, arguments.stride,
+                           arguments.positive_fraction, arguments.minimum_kmers, arguments.negative_minimum_kmers)
+    fast_path = FAST_PATHS[arguments.fast_path]
+
+    report = {'fast_path': arguments.fast_path, 'reads': 0, 'decided': 0, 'agreed': 0, 'kept_instead_of_discarded': 0,
+              'discarded_instead_of_kept': 0, 'full_path_seconds': 0.0, 'fast_path_seconds': 0.0}
+
+    for read in read_fastq_pairs(arguments.files):
+        start = perf_counter()
+        fast_decision = fast_path(active_filter, read)
+        decided = perf_counter()
+        full_decision = active_filter._actual_is_read_legal(read)
+        mapped = perf_counter()
+
+        report['reads'] += 1
+        report['full_path_seconds'] += mapped - decided
+        if fast_decision is None:
+            # The fast path falls back to the full path for ambiguous reads
+            report['fast_path_seconds'] += mapped - start
+            continue
+
+        report['fast_path_seconds'] += decided - start
+        report['decided'] += 1
+        if fast_decision == full_decision:
+            report['agreed'] += 1
+        elif fast_decision:
+            report['kept_instead_of_discarded'] += 1
+        else:
+            report['discarded_instead_of_kept'] += 1
+
+    if report['decided'] > 0:
+        report['agreement'] = report['agreed'] / report['decided']
+    if report['reads'] > 0:
+        report['decided_fraction'] = report['decided'] / report['reads']
+    if report['fast_path_seconds'] > 0:
+        report['speedup'] = report['full_path_seconds'] / report['fast_path_seconds']
+
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+    if arguments.output:
+        with open(arguments.output, 'w') as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+# coding=utf-8
+import gzip
+from typing import Iterator
+
+
+def read_fastq(filepath: str) -> Iterator[list[str]]:
+    """Yield the four lines (without line breaks) of every record of a plain or gzipped FASTQ file."""
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt') as handle:
+        record: list[str] = []
+        for line in handle:
+            record.append(line.rstrip('\n'))
+            if len(record) == 4:
+                yield record
+                record = []
+
+
+def read_fastq_pairs(filepaths: list[str]) -> Iterator[list[list[str]]]:
+    """Yield the corresponding records of one or more FASTQ files in the format the filter expects."""
+    return map(list, zip(*map(read_fastq, filepaths)))
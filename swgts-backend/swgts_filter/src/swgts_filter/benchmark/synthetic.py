@@ -0,0 +1,221 @@
+# coding=utf-8
+"""Generate labelled host/pathogen read mixtures for the benchmarks without external datasets.
+
+Reads are sampled from both strands of a pathogen and a host FASTA, get sequencing errors and are streamed to plain or
+gzipped FASTQ files. Read ids start with human_ or pathogen_, which is what the benchmark uses as ground truth. Without
+--host a random genome is used as host, which is enough for throughput runs but makes the host trivially separable;
+use a real host FASTA for accuracy numbers. The same seed and arguments always produce the same reads.
+
+Examples:
+    python -m swgts_filter.benchmark.synthetic --reads 100000 --profile ont ont.fastq.gz
+    python -m swgts_filter.benchmark.synthetic --reads 100000 --profile illumina --host hg38_chr21.fa.gz \
+        --pathogen-fraction 0.01 illumina_1.fastq.gz illumina_2.fastq.gz
+"""
+import bisect
+import gzip
+import math
+import os
+import random
+from argparse import ArgumentParser
+from typing import IO, Iterator, Optional
+
+from swgts_filter.filter.sketch import read_fasta
+
+# The pathogen genome shipped in the repository
+DEFAULT_PATHOGEN: str = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..',
+                                                     'example_data', 'EPI_ISL_402124.fasta.gz'))
+
+_COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+_BASES = 'ACGT'
+
+# Defaults per sequencing profile: read length model and error rates (substitution, insertion, deletion)
+PROFILES: dict[str, dict] = {
+    # Log-normal lengths with a long tail, median around 2.7 kb
+    'ont': {'length_model': 'lognormal', 'mean_length': 4000, 'length_sigma': 0.9, 'minimum_length': 100,
+            'substitution_rate': 0.03, 'insertion_rate': 0.01, 'deletion_rate': 0.02},
+    # Fixed read length, pairs come from fragments of insert_size +- insert_sigma
+    'illumina': {'length_model': 'fixed', 'mean_length': 150, 'length_sigma': 0.0, 'minimum_length': 150,
+                 'substitution_rate': 0.002, 'insertion_rate': 0.0001, 'deletion_rate': 0.0001},
+}
+
+
+def reverse_complement(sequence: str) -> str:
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+class Genome:
+    """All contigs of a FASTA, concatenated for position sampling weighted by contig length."""
+
+    def __init__(self, contigs: list[str]):
+        self.contigs = [c.upper() for c in contigs if len(c) > 0]
+        if len(self.contigs) == 0:
+            raise ValueError('Genome without sequence.')
+        self.offsets: list[int] = []
+        total = 0
+        for contig in self.contigs:
+            total += len(contig)
+            self.offsets.append(total)
+
+    @classmethod
+    def from_fasta(cls, filepath: str) -> 'Genome':
+        return cls([sequence for _, sequence in read_fasta(filepath)])
+
+    @classmethod
+    def synthetic(cls, size: int, gc_content: float, rng: random.Random) -> 'Genome':
+        # Random bytes mapped to bases with a 256 entry table, orders of magnitude faster than drawing every base
+        at, gc = round(128 * (1 - gc_content)), round(128 * gc_content)
+        table = bytes.maketrans(bytes(range(256)), (b'A' * at + b'C' * gc + b'G' * gc + b'T' * (256 - 2 * gc - at)))
+        return cls([rng.randbytes(size).translate(table).decode()])
+
+    def fragment(self, length: int, rng: random.Random) -> str:
+        """A random fragment of at most length bases (contigs shorter than that are returned whole) from a random
+        strand."""
+        contig = self.contigs[bisect.bisect_right(self.offsets, rng.randrange(self.offsets[-1]))]
+        length = min(length, len(contig))
+        start = rng.randrange(len(contig) - length + 1)
+        fragment = contig[start:start + length]
+        return fragment if rng.random() < 0.5 else reverse_complement(fragment)
+
+
+class ReadSimulator:
+    """Draws read lengths and applies substitution, insertion and deletion errors."""
+
+    def __init__(self, rng: random.Random, length_model: str, mean_length: int, length_sigma: float,
+                 minimum_length: int, substitution_rate: float, insertion_rate: float, deletion_rate: float):
+        if length_model not in ['lognormal', 'fixed']:
+            raise ValueError(f'Unknown length model {length_model}')
+        self.rng = rng
+        self.length_model = length_model
+        self.mean_length = mean_length
+        self.length_sigma = length_sigma
+        self.minimum_length = minimum_length
+        self.substitution_rate = substitution_rate
+        self.insertion_rate = insertion_rate
+        self.deletion_rate = deletion_rate
+        self.error_rate = substitution_rate + insertion_rate + deletion_rate
+        # Mean of a log-normal is exp(mu + sigma^2 / 2)
+        self._mu = math.log(mean_length) - length_sigma ** 2 / 2
+        # Per-base quality encoded from the total error rate, Illumina and ONT qualities are both phred+33
+        phred = min(41, int(-10 * math.log10(self.error_rate))) if self.error_rate > 0 else 41
+        self.quality_character = chr(phred + 33)
+
+    def length(self) -> int:
+        if self.length_model == 'fixed':
+            return self.mean_length
+        return max(self.minimum_length, int(self.rng.lognormvariate(self._mu, self.length_sigma)))
+
+    def add_errors(self, sequence: str) -> str:
+        """Apply errors at positions drawn per read instead of per base, which keeps long reads fast."""
+        if self.error_rate <= 0 or len(sequence) == 0:
+            return sequence
+        count = self._binomial(len(sequence), self.error_rate)
+        if count == 0:
+            return sequence
+        bases = list(sequence)
+        # From the back, so that insertions and deletions don't shift the remaining positions
+        for position in sorted(self.rng.sample(range(len(bases)), min(count, len(bases))), reverse=True):
+            kind = self.rng.random() * self.error_rate
+            if kind < self.substitution_rate:
+                bases[position] = self.rng.choice(_BASES.replace(bases[position], '') or _BASES)
+            elif kind < self.substitution_rate + self.insertion_rate:
+                bases.insert(position, self.rng.choice(_BASES))
+            elif len(bases) > 1:
+                del bases[position]
+        return ''.join(bases)
+
+    def _binomial(self, n: int, p: float) -> int:
+        if n * p > 30:
+            # Normal approximation, exact enough for error counts and much cheaper than n draws
+            return max(0, int(round(self.rng.gauss(n * p, math.sqrt(n * p * (1 - p))))))
+        # Count the geometric gaps between errors
+        count, position = 0, -1
+        while True:
+            position += 1 + int(math.log(1 - self.rng.random()) / math.log(1 - p))
+            if position >= n:
+                return count
+            count += 1
+
+    def record(self, name: str, sequence: str) -> str:
+        sequence = self.add_errors(sequence)
+        return f'@{name}\n{sequence}\n+\n{self.quality_character * len(sequence)}\n'
+
+
+def generate(host: Genome, pathogen: Genome, simulator: ReadSimulator, rng: random.Random, reads: int,
+             pathogen_fraction: float, paired: bool, insert_size: int, insert_sigma: float) -> Iterator[list[str]]:
+    """Yield the FASTQ records (one per mate) of every read."""
+    for index in range(reads):
+        is_pathogen = rng.random() < pathogen_fraction
+        source, label = (pathogen, 'pathogen') if is_pathogen else (host, 'human')
+        name = f'{label}_{index}'
+        if not paired:
+            yield [simulator.record(name, source.fragment(simulator.length(), rng))]
+            continue
+        length = simulator.length()
+        fragment_length = max(length, int(rng.gauss(insert_size, insert_sigma)))
+        fragment = source.fragment(fragment_length, rng)
+        # Forward-reverse orientation, mates overlap if the fragment is shorter than two reads
+        yield [simulator.record(f'{name}/1', fragment[:length]),
+               simulator.record(f'{name}/2', reverse_complement(fragment[-length:]))]
+
+
+def open_output(filepath: str) -> IO[str]:
+    if filepath.endswith('.gz'):
+        # A low compression level, the generator should not be bottlenecked by gzip
+        return gzip.open(filepath, 'wt', compresslevel=3)
+    return open(filepath, 'w')
+
+
+def get_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Generate a labelled host/pathogen FASTQ mixture.')
+    parser.add_argument('output', type=str, nargs='+',
+                        help='One FASTQ file for single-end reads, two for paired-end reads. .gz compresses.')
+    parser.add_argument('--reads', type=int, default=10000, help='Number of reads (pairs) to generate.')
+    parser.add_argument('--profile', type=str, choices=list(PROFILES), default='ont')
+    parser.add_argument('--pathogen', type=str, default=DEFAULT_PATHOGEN, help='FASTA of the pathogen.')
+    parser.add_argument('--host', type=str, help='FASTA of the host, a random genome is used if omitted.')
+    parser.add_argument('--host-size', type=int, default=10_000_000, help='Size of the random host genome.')
+    parser.add_argument('--host-gc', type=float, default=0.41, help='GC content of the random host genome.')
+    parser.add_argument('--pathogen-fraction', type=float, default=0.1, help='Fraction of pathogen reads.')
+    parser.add_argument('--mean-length', type=int, help='Mean (or fixed) read length.')
+    parser.add_argument('--length-sigma', type=float, help='Sigma of the log-normal length model.')
+    parser.add_argument('--minimum-length', type=int)
+    parser.add_argument('--substitution-rate', type=float)
+    parser.add_argument('--insertion-rate', type=float)
+    parser.add_argument('--deletion-rate', type=float)
+    parser.add_argument('--insert-size', type=int, default=350, help='Mean fragment length of pairs.')
+    parser.add_argument('--insert-sigma', type=float, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    arguments = get_argument_parser().parse_args(argv)
+    if len(arguments.output) > 2:
+        raise ValueError('At most two output files (paired-end) are supported.')
+    paired = len(arguments.output) == 2
+
+    settings = dict(PROFILES[arguments.profile])
+    for key in settings:
+        if getattr(arguments, key, None) is not None:
+            settings[key] = getattr(arguments, key)
+
+    rng = random.Random(arguments.seed)
+    pathogen = Genome.from_fasta(arguments.pathogen)
+    host = Genome.from_fasta(arguments.host) if arguments.host is not None else \
+        Genome.synthetic(arguments.host_size, arguments.host_gc, rng)
+    simulator = ReadSimulator(rng, **settings)
+
+    handles = [open_output(filepath) for filepath in arguments.output]
+    try:
+        for records in generate(host, pathogen, simulator, rng, arguments.reads, arguments.pathogen_fraction, paired,
+                                arguments.insert_size, arguments.insert_sigma):
+            for handle, record in zip(handles, records):
+                handle.write(record)
+    finally:
+        for handle in handles:
+            handle.close()
+    print(f"Wrote {arguments.reads} {'pairs' if paired else 'reads'} to {', '.join(arguments.output)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# coding=utf-8
+"""Sweep minimap2 options on labelled reads and report the Pareto front of throughput and accuracy.
+
+Every combination of the given option values is benchmarked like a filter mode of the benchmark (see
+swgts_filter.benchmark), always including the preset's own values as baseline. Read ids have to be labelled as for the
+benchmark, e.g. by swgts_filter.benchmark.synthetic. The combinations that no other one beats in both reads/s and F1
+form the Pareto front; the fastest of them that loses at most --accuracy-tolerance F1 against the baseline is written
+as MAPPING_OPTIONS setting for config_filter.py. Combinations run one after another by default, parallel runs compete
+for CPU and memory bandwidth and distort the throughput.
+
+Examples:
+    python -m swgts_filter.benchmark.tune --mode COMBINED --preset map-ont --database combinedHumanCovid.mmi \
+        --option min_chain_score=20,40,80 --option bw=200,500 --config tuned.py ont.fastq.gz
+    python -m swgts_filter.benchmark.tune --preset sr --database combinedHumanCovid.fasta \
+        --option k=15,21 --option w=5,11 illumina_1.fastq.gz illumina_2.fastq.gz
+"""
+import itertools
+import json
+import os
+import pprint
+import sys
+from argparse import ArgumentParser, Namespace
+from multiprocessing import Pool
+from typing import Any, Optional
+
+from swgts_filter.filter import MAPPING_OPTIONS
+from swgts_filter.server import config
+from .__main__ import classification_metrics, run_task
+
+# Swept if no --option is given, reasonable for all long and short read presets
+DEFAULT_GRID: dict[str, list[Any]] = {
+    'min_chain_score': [20, 40, 80],
+    'min_cnt': [2, 4],
+    'bw': [100, 500],
+    'max_chain_skip': [10, 25],
+}
+
+
+def parse_option(argument: str) -> tuple[str, list[Any]]:
+    """Parse name=value,value,... into the option name and its values (ints where possible)."""
+    name, _, values = argument.partition('=')
+    if name not in MAPPING_OPTIONS or not values:
+        raise ValueError(f'Expected name=value,... with one of {", ".join(MAPPING_OPTIONS)}, got {argument}')
+    parsed = []
+    for value in values.split(','):
+        try:
+            parsed.append(int(value))
+        except ValueError:
+            parsed.append(float(value))
+    return name, parsed
+
+
+def combinations(grid: dict[str, list[Any]]) -> list[dict[str, Any]]:
+    """All combinations of the option values, starting with the preset's own values (no options)."""
+    names = sorted(grid)
+    combined = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    return [{}] + [options for options in combined if options]
+
+
+def aggregate(options: dict[str, Any], results: list[dict[str, Any]]) -> dict[str, Any]:
+    """The throughput and accuracy of one combination over all samples."""
+    totals = {key: sum(result[key] for result in results)
+              for key in ['reads', 'bases', 'wall_seconds', 'tp', 'tn', 'fp', 'fn']}
+    entry = {'options': options, **totals,
+             'reads_per_second': totals['reads'] / totals['wall_seconds'] if totals['wall_seconds'] > 0 else 0.0,
+             'bases_per_second': totals['bases'] / totals['wall_seconds'] if totals['wall_seconds'] > 0 else 0.0,
+             'peak_rss_mb': max(result['peak_rss_mb'] for result in results)}
+    entry.update(classification_metrics(totals['tp'], totals['tn'], totals['fp'], totals['fn']))
+    return entry
+
+
+def pareto_front(entries: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """The entries no other entry beats in reads/s and F1 at once, fastest first."""
+    front = []
+    for entry in sorted(entries, key=lambda e: (-e['reads_per_second'], -e['f1'])):
+        # Sorted by throughput, so an entry is dominated iff a faster one is at least as accurate
+        if not front or entry['f1'] > front[-1]['f1']:
+            front.append(entry)
+    return front
+
+
+def recommend(front: list[dict[str, Any]], baseline: dict[str, Any], tolerance: float) -> Optional[dict[str, Any]]:
+    """The fastest entry of the front whose F1 is at most tolerance below the baseline's."""
+    return next((entry for entry in front if entry['f1'] >= baseline['f1'] - tolerance), None)
+
+
+def config_snippet(mode: str, preset: str, options: dict[str, Any]) -> str:
+    return f'MAPPING_OPTIONS = {pprint.pformat({mode: {preset: options}})}\n'
+
+
+def get_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Find minimap2 options that trade accuracy for filter throughput.')
+    parser.add_argument('--mode', type=str, default=config.FILTER_MODE, choices=['COMBINED', 'NEGATIVE'])
+    parser.add_argument('--preset', type=str, default=config.MAPPING_PRESET)
+    parser.add_argument('--database', type=str, default=config.MINIMAP2_REFERENCE_DATABASE,
+                        help='The index or, to sweep k and w, the FASTA it is built from.')
+    parser.add_argument('--contig', type=str, default=config.MINIMAP2_POSITIVE_CONTIG)
+    parser.add_argument('--quality-threshold', type=int, default=config.MINIMAP2_QUALITY_THRESHOLD)
+    parser.add_argument('--option', type=str, action='append', default=[],
+                        help=f'Values of a mappy option to sweep, e.g. min_chain_score=20,40,80. Can be repeated, '
+                             f'defaults to {DEFAULT_GRID}.')
+    parser.add_argument('--processes', type=int, default=1, help='Number of combinations benchmarked in parallel.')
+    parser.add_argument('--accuracy-tolerance', type=float, default=0.001,
+                        help='Absolute F1 decrease against the preset defaults tolerated for the recommendation.')
+    parser.add_argument('--output', type=str, help='Write all results and the Pareto front as json to this file.')
+    parser.add_argument('--config', type=str, help='Write the recommended MAPPING_OPTIONS setting to this file.')
+    parser.add_argument('files', type=str, nargs='+',
+                        help='Labelled fastq file(s), two for a paired-end sample, or a single-end sample each with '
+                             '--single-end.')
+    parser.add_argument('--single-end', action='store_true', help='Treat every file as a sample of its own.')
+    return parser
+
+
+def tune(arguments: Namespace) -> int:
+    try:
+        grid = dict(map(parse_option, arguments.option)) if arguments.option else DEFAULT_GRID
+    except ValueError as e:
+        print(e)
+        return 1
+    if arguments.database.endswith('.mmi') and {'k', 'w'} & set(grid):
+        print(f'k and w can not be swept with the prebuilt index {arguments.database}, pass the FASTA instead.')
+        return 1
+
+    # Sample paths of the benchmark are relative to its samples directory
+    files = [os.path.abspath(file) for file in arguments.files]
+    samples = [[file] for file in files] if arguments.single_end else [files]
+    tasks = []
+    for index, options in enumerate(combinations(grid)):
+        print(f'combination-{index}: {options or "preset defaults"}')
+        params = {'filter_mode': arguments.mode, 'mapping_preset': arguments.preset,
+                  'minimap2_reference_database': arguments.database, 'minimap2_positive_contig': arguments.contig,
+                  'minimap2_quality_threshold': arguments.quality_threshold,
+                  'mapping_options': {arguments.preset: options}}
+        mode = {'params': params, 'samples': samples, 'prefilter': None}
+        tasks.extend((f'combination-{index}', mode, sample) for sample in samples)
+
+    print(f'Benchmarking {len(tasks) // len(samples)} combinations on {len(samples)} samples ...')
+    # maxtasksperchild=1 gives every run a fresh process with its own index
+    with Pool(processes=arguments.processes, maxtasksperchild=1) as pool:
+        results = pool.starmap(run_task, tasks, chunksize=1)
+
+    entries = [aggregate(options, results[index * len(samples):(index + 1) * len(samples)])
+               for index, options in enumerate(combinations(grid))]
+    baseline = entries[0]
+    front = pareto_front(entries)
+    recommended = recommend(front, baseline, arguments.accuracy_tolerance)
+
+    print(f"Baseline ({arguments.preset} defaults): {baseline['reads_per_second']:.1f} reads/s, F1 {baseline['f1']:.4f}")
+    print('Pareto front:')
+    for entry in front:
+        speedup = entry['reads_per_second'] / baseline['reads_per_second'] if baseline['reads_per_second'] > 0 else 0.0
+        print(f"  {entry['reads_per_second']:.1f} reads/s ({speedup:.2f}x), F1 {entry['f1']:.4f} "
+              f"({entry['f1'] - baseline['f1']:+.4f}): {entry['options'] or 'preset defaults'}")
+
+    if recommended is None:
+        # Can only happen with a negative tolerance
+        print('No combination is accurate enough.')
+    else:
+        snippet = config_snippet(arguments.mode, arguments.preset, recommended['options'])
+        print(f'Recommended setting:\n{snippet}', end='')
+        if arguments.config:
+            with open(arguments.config, 'w') as handle:
+                handle.write(snippet)
+            print(f'Wrote it to {arguments.config}')
+
+    if arguments.output:
+        with open(arguments.output, 'w') as handle:
+            json.dump({'mode': arguments.mode, 'preset': arguments.preset, 'grid': grid, 'samples': samples,
+                       'results': entries, 'pareto_front': front, 'recommended': recommended}, handle, indent=2)
+        print(f'Wrote results to {arguments.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(tune(get_argument_parser().parse_args()))
@@ -2,16 +2,29 @@
 import os
 import time
 from logging import getLogger
-from typing import Optional, Callable
+from typing import Any, Optional, Callable
 
 from mappy import Aligner
 
-ALL = ['is_read_legal', 'init_filter']
+from .prefilter import Prefilter
+from .sketch import KmerSketch
 
-aligner: Optional[Aligner] = None
-MINIMAP2_CONTIG: Optional[str] = None
-MINIMAP2_QUALITY_THRESHOLD: Optional[int] = None
-_actual_is_read_legal: Optional[Callable[[list[str]], bool]] = None
+ALL = ['Filter', 'Prefilter', 'is_read_legal', 'init_filter', 'init_sketch', 'parse_segments', 'MAPPING_OPTIONS',
+       'SEGMENTS_MARKER']
+
+# Starts the separator line of a read the api segmented because it is longer than its buffer, followed by the window
+# length and the id under which the whole record is parked
+SEGMENTS_MARKER = '+SWGTS_SEGMENTS'
+
+# Keyword arguments of mappy.Aligner that can be configured per mapping preset, they override the preset's values.
+# k and w only apply when the index is built from a FASTA, a prebuilt .mmi index keeps the ones it was built with.
+MAPPING_OPTIONS = ('k', 'w', 'min_cnt', 'min_chain_score', 'min_dp_score', 'bw', 'bw_long', 'best_n', 'max_frag_len',
+                   'max_chain_skip', 'scoring')
+# Only the primary hit decides a read
+DEFAULT_MAPPING_OPTIONS: dict[str, Any] = {'best_n': 1}
+
+# The filter used by the module level functions, see init_filter
+default_filter: Optional['Filter'] = None
 logger = getLogger(__name__)
 
 
@@ -19,64 +32,215 @@ def info(*args, **kwargs) -> None:
     logger.info(*args, **kwargs)
 
 
-def is_read_legal(read: list[list[str]]) -> bool:
-    """Return True if you want to keep the read.
-    :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
-    if read[0][2] == 'TOO_LONG':
-        return False
-    return _actual_is_read_legal(read)
-
-
-def init_filter(filter_mode : str, mapping_preset: str, minimap2_reference_database: str, minimap2_positive_contig: str, minimap2_quality_threshold : int):
-    global _actual_is_read_legal
-
-    info(f'Filter initialization {filter_mode}')
-
-    if filter_mode in ['COMBINED', 'NEGATIVE']:
-        global aligner
-        # TODO: Minimap2 Args to CONFIG
-        print(f'Loading database {minimap2_reference_database} from {os.getcwd()}')
-        aligner = Aligner(minimap2_reference_database, preset=mapping_preset, best_n=1)
-        if not os.path.isfile(minimap2_reference_database):
-            raise Exception('ERROR: failed to locate index')
-        if filter_mode == 'COMBINED':
-            global MINIMAP2_CONTIG
-            MINIMAP2_CONTIG = minimap2_positive_contig
-            _actual_is_read_legal = is_read_legal_combined
-        elif filter_mode == 'NEGATIVE':
-            global MINIMAP2_QUALITY_THRESHOLD
-            _actual_is_read_legal = is_read_legal_negative
-            MINIMAP2_QUALITY_THRESHOLD = minimap2_quality_threshold
-    elif filter_mode == 'NONE':
-        _actual_is_read_legal = is_read_legal_dummy
-    else:
-        raise NotImplemented()
-    info(f'Filter initialized.')
+class Filter:
+    """One loaded filter configuration: a reference index, the mode it is used in and its optional fast paths.
+    Instances are never modified after construction, so a job that started with an instance can finish with it while
+    a rebuilt index is swapped in for the next jobs. The lines of a read may be str or, as in the worker, undecoded
+    bytes."""
+
+    def __init__(self, filter_mode: str, mapping_preset: str, minimap2_reference_database: str,
+                 minimap2_positive_contig: str, minimap2_quality_threshold: int, paired_mapping_strategy: str = 'pair',
+                 mate_first_minimum_mapq: int = 30, sketch_reference: Optional[str] = None,
+                 sketch_kmer_size: int = 15, sketch_stride: int = 4, sketch_positive_fraction: float = 0.1,
+                 sketch_minimum_kmers: int = 10, sketch_negative_minimum_kmers: int = 50,
+                 mapping_options: Optional[dict[str, dict[str, Any]]] = None,
+                 prefilter: Optional[dict[str, Any]] = None):
+        info(f'Filter initialization {filter_mode}')
+        self.filter_mode = filter_mode
+        self.mapping_preset = mapping_preset
+        # mapping_options holds the aligner options per preset, only the ones of mapping_preset are used
+        preset_options = (mapping_options or {}).get(mapping_preset, {})
+        unknown = set(preset_options) - set(MAPPING_OPTIONS)
+        if unknown:
+            raise ValueError(f'Unknown mapping options {sorted(unknown)} for preset {mapping_preset}')
+        self.mapping_options = {**DEFAULT_MAPPING_OPTIONS, **preset_options}
+        self.database = minimap2_reference_database
+        self.contig = minimap2_positive_contig
+        self.quality_threshold = minimap2_quality_threshold
+        if paired_mapping_strategy not in ['pair', 'mate-first']:
+            raise ValueError(f'Unknown paired mapping strategy {paired_mapping_strategy}')
+        # Map the first mate of a pair alone and only map the whole pair if its primary hit is inconclusive
+        self.mate_first = paired_mapping_strategy == 'mate-first'
+        # Mapping quality of the first mate's primary hit from which on the mate alone decides the pair
+        self.mate_first_minimum_mapq = mate_first_minimum_mapq
+        self.aligner: Optional[Aligner] = None
+        self.sketch: Optional[KmerSketch] = None
+        self.sketch_reference = sketch_reference
+        # prefilter holds the keyword arguments of Prefilter, None disables the stage
+        self.prefilter: Optional[Prefilter] = Prefilter(**prefilter) if prefilter is not None else None
+        # Identifies the configuration (including the index generation) in the shared decision cache, set by the
+        # registry
+        self.cache_key: str = filter_mode
+        # The reference and preset it is registered under, set by the registry
+        self.key: Optional[tuple[str, str]] = None
+        self._actual_is_read_legal: Callable[[list[list[str]]], bool]
+
+        if filter_mode in ['COMBINED', 'NEGATIVE']:
+            print(f'Loading database {minimap2_reference_database} from {os.getcwd()}')
+            if not os.path.isfile(minimap2_reference_database):
+                raise Exception('ERROR: failed to locate index')
+            if minimap2_reference_database.endswith('.mmi') and {'k', 'w'} & set(preset_options):
+                logger.warning(f'k and w are ignored for the prebuilt index {minimap2_reference_database}')
+            self.aligner = Aligner(minimap2_reference_database, preset=mapping_preset, **self.mapping_options)
+            if filter_mode == 'COMBINED':
+                self._actual_is_read_legal = self.is_read_legal_combined
+            elif filter_mode == 'NEGATIVE':
+                self._actual_is_read_legal = self.is_read_legal_negative
+            if sketch_reference is not None:
+                self.sketch = KmerSketch(sketch_reference, sketch_kmer_size, sketch_stride, sketch_positive_fraction,
+                                         sketch_minimum_kmers, sketch_negative_minimum_kmers)
+        elif filter_mode == 'NONE':
+            self._actual_is_read_legal = is_read_legal_dummy
+        else:
+            raise NotImplemented()
+        info(f'Filter initialized.')
+
+    def source_files(self) -> list[str]:
+        """The files this filter was built from, used to detect rebuilt indices."""
+        if self.aligner is None:
+            return []
+        return [self.database] + ([self.sketch_reference] if self.sketch_reference is not None else [])
+
+    def is_read_legal(self, read: list[list[str]]) -> bool:
+        """Return True if you want to keep the read.
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+        return self.passes_prefilter(read) and self.classify(read)
+
+    def passes_prefilter(self, read: list[list[str]]) -> bool:
+        """Return False if the read is discarded before looking at the reference. These checks may depend on more
+        than the sequence (e.g. the quality string).
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+        if read[0][2] in ('TOO_LONG', b'TOO_LONG'):
+            return False
+        if self.prefilter is not None and self.prefilter.is_read_junk(read):
+            return False
+        return True
 
+    def classify(self, read: list[list[str]]) -> bool:
+        """Return True if the read is kept according to the reference. Only depends on the sequences, so decisions can
+        be cached for duplicate reads.
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+        segments = parse_segments(read)
+        if segments is not None:
+            return self.classify_segments(read, segments[0])
+        if self.sketch is not None:
+            decision = self.classify_with_sketch(read)
+            if decision is not None:
+                return decision
+        return self._actual_is_read_legal(read)
+
+    def classify_segments(self, read: list[list[str]], window: int) -> bool:
+        """Classify every window of a segmented read on its own and keep the read if the majority of its windows is
+        kept. A tie discards the read.
+        :param read: A segmented single end read ( 1 list of a 4 element List of str) ."""
+        header, sequence, _, quality = read[0]
+        # The separator of a plain read, in the type of the lines
+        separator = '+' if isinstance(header, str) else b'+'
+        kept = sum(self.classify([[header, sequence[start:start + window], separator, quality[start:start + window]]])
+                   for start in range(0, len(sequence), window))
+        return 2 * kept > -(-len(sequence) // window)
+
+    def classify_with_sketch(self, read: list[list[str]]) -> Optional[bool]:
+        """Return the keep decision of the k-mer sketch or None if the read is ambiguous and has to be mapped.
+        In NEGATIVE mode the index only contains the host, so a read without pathogen k-mers still has to be mapped.
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+        decision = self.sketch.classify([r[1] for r in read])
+        if decision is False and self.filter_mode == 'NEGATIVE':
+            return None
+        return decision
+
+    def _primary_hit(self, *sequences: str):
+        """Return the primary hit of the sequences (one per mate) or None if they don't map."""
+        return next(self.aligner.map(*sequences), None)
+
+    def classify_mate_first(self, read: list[list[str]]) -> Optional[bool]:
+        """Map only the first mate and return the keep decision if its primary hit is conclusive, None if the whole
+        pair has to be mapped. Unmapped first mates are never conclusive, since the pair might still map through the
+        second.
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+        hit = self._primary_hit(read[0][1])
+        if hit is None or hit.mapq < self.mate_first_minimum_mapq:
+            return None
+        if self.filter_mode == 'COMBINED':
+            return hit.ctg == self.contig
+        # NEGATIVE: A confident host hit discards the pair, anything else is left to the pair mapping
+        return False if hit.mapq >= self.quality_threshold else None
+
+    def is_read_legal_combined(self, read: list[list[str]]) -> bool:
+        """Return True if you want to keep the read.
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+
+        if self.mate_first and len(read) > 1:
+            decision = self.classify_mate_first(read)
+            if decision is not None:
+                return decision
+
+        hit = self._primary_hit(*[r[1] for r in read])
+        if hit is None:
+            return False
+        return hit.ctg == self.contig
+
+    def is_read_legal_negative(self, read: list[list[str]]) -> bool:
+        """Return True if you want to keep the read.
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+
+        if self.mate_first and len(read) > 1:
+            decision = self.classify_mate_first(read)
+            if decision is not None:
+                return decision
+
+        hit = self._primary_hit(*[r[1] for r in read])
+        if hit is None:
+            return True
+
+        return hit.mapq < self.quality_threshold
+
+
+def parse_segments(read: list[list[str]]) -> Optional[tuple[int, str]]:
+    """Return the window length and the park id of a segmented read, None for any other read (including ones whose
+    separator starts with SEGMENTS_MARKER but is malformed, those are filtered as they are)."""
+    if len(read) != 1:
+        return None
+    separator = read[0][2]
+    if isinstance(separator, bytes):
+        if not separator.startswith(SEGMENTS_MARKER.encode()):
+            return None
+        separator = separator.decode(errors='replace')
+    elif not separator.startswith(SEGMENTS_MARKER):
+        return None
+    parts = separator.split()
+    if len(parts) != 3 or parts[0] != SEGMENTS_MARKER or not parts[1].isdecimal() or int(parts[1]) <= 0:
+        return None
+    return int(parts[1]), parts[2]
 
-def is_read_legal_dummy(_: list[list[str]]) -> bool:
-    time.sleep(0.005)
-    """Always returns True, pauses however for one second which can be used for benchmarking purposes"""
-    return True
 
-def is_read_legal_combined(read: list[list[str]]) -> bool:
-    """Return True if you want to keep the read.
+def is_read_legal(read: list[list[str]]) -> bool:
+    """Return True if you want to keep the read, using the filter set up by init_filter.
     :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+    return default_filter.is_read_legal(read)
 
-    try:
-        hit = next(aligner.map(*[r[1] for r in read]))
-    except StopIteration:
-        return False
-    return hit.ctg == MINIMAP2_CONTIG
 
+def init_filter(filter_mode : str, mapping_preset: str, minimap2_reference_database: str, minimap2_positive_contig: str, minimap2_quality_threshold : int,
+                paired_mapping_strategy: str = 'pair', mate_first_minimum_mapq: int = 30,
+                mapping_options: Optional[dict[str, dict[str, Any]]] = None):
+    global default_filter
+    default_filter = Filter(filter_mode, mapping_preset, minimap2_reference_database, minimap2_positive_contig,
+                            minimap2_quality_threshold, paired_mapping_strategy, mate_first_minimum_mapq,
+                            mapping_options=mapping_options)
 
-def is_read_legal_negative(read: list[list[str]]) -> bool:
-    """Return True if you want to keep the read.
-    :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
 
-    try:
-        hit = next(aligner.map(*[r[1] for r in read]))
-    except StopIteration:
-        return True
+def init_sketch(reference_fasta: str, kmer_size: int, stride: int, positive_fraction: float, minimum_kmers: int,
+                negative_minimum_kmers: int) -> None:
+    """Build the k-mer sketch of the pathogen reference used by the filter set up by init_filter."""
+    if default_filter.filter_mode not in ['COMBINED', 'NEGATIVE']:
+        info(f'Not building a k-mer sketch for filter mode {default_filter.filter_mode}')
+        return
+    default_filter.sketch_reference = reference_fasta
+    default_filter.sketch = KmerSketch(reference_fasta, kmer_size, stride, positive_fraction, minimum_kmers,
+                                       negative_minimum_kmers)
+
 
-    return hit.mapq < MINIMAP2_QUALITY_THRESHOLD
+def is_read_legal_dummy(_: list[list[str]]) -> bool:
+    time.sleep(0.005)
+    """Always returns True, pauses however for one second which can be used for benchmarking purposes"""
+    return True
@@ -0,0 +1,97 @@
+# coding=utf-8
+import hashlib
+from collections import Counter, OrderedDict
+from logging import getLogger
+from typing import Callable, Optional, Union
+
+from redis import Redis
+
+ALL = ['DecisionCache']
+
+logger = getLogger(__name__)
+
+
+def read_digest(read: list[list[Union[str, bytes]]]) -> bytes:
+    """Hash of the sequences of all mates of a read, the only part of a read the cached decisions depend on. Reads
+    given as str and as bytes have the same digest."""
+    digest = hashlib.blake2b(digest_size=16)
+    for index, mate in enumerate(read):
+        if index > 0:
+            digest.update(b'\0')
+        digest.update(mate[1] if isinstance(mate[1], bytes) else mate[1].encode())
+    return digest.digest()
+
+
+class DecisionCache:
+    """Bounded LRU cache of keep/discard decisions per filter configuration, keyed by a hash of the read sequences.
+    Amplicon runs contain a lot of identical reads, which then only have to be mapped once. Optionally the decisions
+    are also shared between all workers (and filter servers) through redis, where they expire after ttl seconds."""
+
+    def __init__(self, capacity: int, redis_server: Optional[Redis] = None, ttl: int = 3600):
+        self.capacity = capacity
+        self.redis_server = redis_server
+        self.ttl = ttl
+        self._decisions: OrderedDict[tuple[str, bytes], bool] = OrderedDict()
+        # Lookups since the last call of pop_statistics, by outcome
+        self.statistics: Counter = Counter()
+
+    def _remember(self, key: tuple[str, bytes], decision: bool) -> None:
+        self._decisions[key] = decision
+        self._decisions.move_to_end(key)
+        if len(self._decisions) > self.capacity:
+            self._decisions.popitem(last=False)
+
+    def decide(self, configuration: str, reads: list[list[list[str]]],
+               classify: Callable[[list[list[str]]], bool]) -> list[bool]:
+        """Return the decisions for all reads of a job, calling classify only for reads that are in neither cache.
+        Costs at most two redis round trips per job if the shared cache is enabled."""
+        digests = [read_digest(read) for read in reads]
+        decisions: list[Optional[bool]] = [None] * len(reads)
+        missing: list[int] = []
+
+        for index, digest in enumerate(digests):
+            decision = self._decisions.get((configuration, digest))
+            if decision is None:
+                missing.append(index)
+            else:
+                self._decisions.move_to_end((configuration, digest))
+                decisions[index] = decision
+                self.statistics['local_hits'] += 1
+
+        if self.redis_server is not None and len(missing) > 0:
+            shared = self.redis_server.mget([f'cache:{configuration}:{digests[i].hex()}' for i in missing])
+            still_missing = []
+            for index, value in zip(missing, shared):
+                if value is None:
+                    still_missing.append(index)
+                else:
+                    decisions[index] = value == b'1'
+                    self._remember((configuration, digests[index]), decisions[index])
+                    self.statistics['shared_hits'] += 1
+            missing = still_missing
+
+        new_decisions: dict[bytes, bool] = {}
+        for index in missing:
+            digest = digests[index]
+            if digest in new_decisions:
+                # Duplicate within the same job
+                decisions[index] = new_decisions[digest]
+                self.statistics['local_hits'] += 1
+                continue
+            decisions[index] = new_decisions[digest] = classify(reads[index])
+            self._remember((configuration, digest), decisions[index])
+            self.statistics['misses'] += 1
+
+        if self.redis_server is not None and len(new_decisions) > 0:
+            pipeline = self.redis_server.pipeline(transaction=False)
+            for digest, decision in new_decisions.items():
+                pipeline.set(f'cache:{configuration}:{digest.hex()}', int(decision), ex=self.ttl)
+            pipeline.execute()
+
+        return decisions
+
+    def pop_statistics(self) -> dict[str, int]:
+        """Return the lookup outcomes counted since the last call and reset them."""
+        collected = dict(self.statistics)
+        self.statistics.clear()
+        return collected
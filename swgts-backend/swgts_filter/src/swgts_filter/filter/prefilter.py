@@ -0,0 +1,119 @@
+# coding=utf-8
+import math
+import re
+from collections import Counter
+from logging import getLogger
+from typing import Optional, Pattern, Union
+
+ALL = ['Prefilter']
+
+REASON_TOO_SHORT = 'too_short'
+REASON_LOW_QUALITY = 'low_quality'
+REASON_LOW_COMPLEXITY = 'low_complexity'
+REASON_HOMOPOLYMER = 'homopolymer'
+REASON_ADAPTER_ONLY = 'adapter_only'
+
+# Phred+33 character (str or byte value) -> error probability, used to compute the mean quality the same way
+# basecallers report it
+ERROR_PROBABILITY: dict[Union[str, int], float] = {**{chr(q + 33): 10 ** (-q / 10) for q in range(94)},
+                                                   **{q + 33: 10 ** (-q / 10) for q in range(94)}}
+
+logger = getLogger(__name__)
+
+
+def _reverse_complement(sequence: str) -> str:
+    return sequence.translate(str.maketrans('ACGTacgt', 'TGCAtgca'))[::-1]
+
+
+def _mean_quality(quality: Union[str, bytes]) -> float:
+    """Mean phred quality computed from the mean error probability. The character histogram is built by Counter in C,
+    so the Python-level work only depends on the alphabet size and not on the read length."""
+    histogram = Counter(quality)
+    error_sum = sum(ERROR_PROBABILITY.get(character, 1.0) * count for character, count in histogram.items())
+    return -10 * math.log10(max(error_sum / len(quality), 1e-10))
+
+
+def _dinucleotide_entropy(sequence: Union[str, bytes]) -> float:
+    """Shannon entropy (in bits, at most 4) of the dinucleotide composition. Homopolymers score 0, dinucleotide
+    repeats 1 and random sequence close to 4."""
+    pairs = len(sequence) - 1
+    histogram = Counter(zip(sequence, sequence[1:]))
+    return -sum(count / pairs * math.log2(count / pairs) for count in histogram.values())
+
+
+class Prefilter:
+    """The pre-filter stage of one filter, so that every reference has its own thresholds and rejection counts.
+    A threshold of 0 (or a fraction of 1.0) disables the respective check."""
+
+    def __init__(self, minimum_length: int, minimum_mean_quality: float, minimum_dinucleotide_entropy: float,
+                 homopolymer_length: int, maximum_homopolymer_fraction: float, adapters: list[str],
+                 adapter_remainder: int):
+        self.minimum_length = minimum_length
+        self.minimum_mean_quality = minimum_mean_quality
+        self.minimum_dinucleotide_entropy = minimum_dinucleotide_entropy
+        self.maximum_homopolymer_fraction = maximum_homopolymer_fraction
+        self.adapter_remainder = adapter_remainder
+        self._homopolymer_pattern: Optional[Pattern] = re.compile(
+            '|'.join(f'{base}{{{homopolymer_length},}}' for base in 'ACGT'), re.IGNORECASE) \
+            if homopolymer_length > 0 else None
+        self._homopolymer_pattern_bytes: Optional[Pattern] = re.compile(
+            self._homopolymer_pattern.pattern.encode(), re.IGNORECASE) if self._homopolymer_pattern is not None else None
+        # Longer adapters first, so that str.replace does not leave fragments of an adapter that contains a shorter one
+        self._adapters: list[str] = sorted({a for adapter in adapters for a in (adapter, _reverse_complement(adapter))},
+                                           key=len, reverse=True)
+        self._adapters_bytes: list[bytes] = [adapter.encode() for adapter in self._adapters]
+        # Rejected reads per reason since the last call of pop_statistics
+        self.statistics: Counter = Counter()
+        logger.info(f'Pre-filter initialized (minimum length {minimum_length}, minimum mean quality '
+                    f'{minimum_mean_quality}, minimum dinucleotide entropy {minimum_dinucleotide_entropy}, '
+                    f'homopolymer fraction {maximum_homopolymer_fraction} for runs >= {homopolymer_length}, '
+                    f'{len(adapters)} adapters)')
+
+    def screen(self, sequence: Union[str, bytes], quality: Union[str, bytes]) -> Optional[str]:
+        """Return the reason for rejecting a single read or None if it should be handed to the aligner.
+        Cheap checks come first. Works on str as well as on the undecoded bytes the worker gets."""
+        length = len(sequence)
+        if length < self.minimum_length or length == 0:
+            return REASON_TOO_SHORT
+
+        is_bytes = isinstance(sequence, bytes)
+        if self._adapters and self.adapter_remainder > 0:
+            stripped = sequence
+            for adapter in (self._adapters_bytes if is_bytes else self._adapters):
+                stripped = stripped.replace(adapter, b'' if is_bytes else '')
+            if len(stripped) != length and len(stripped) < self.adapter_remainder:
+                return REASON_ADAPTER_ONLY
+
+        # Quality strings may be missing or made up (e.g. FASTA input), only check them if they belong to the sequence
+        if self.minimum_mean_quality > 0 and len(quality) == length and \
+                _mean_quality(quality) < self.minimum_mean_quality:
+            return REASON_LOW_QUALITY
+
+        if self._homopolymer_pattern is not None and self.maximum_homopolymer_fraction < 1.0:
+            pattern = self._homopolymer_pattern_bytes if is_bytes else self._homopolymer_pattern
+            covered = sum(map(len, pattern.findall(sequence)))
+            if covered > self.maximum_homopolymer_fraction * length:
+                return REASON_HOMOPOLYMER
+
+        if self.minimum_dinucleotide_entropy > 0 and length > 1 and \
+                _dinucleotide_entropy(sequence.upper()) < self.minimum_dinucleotide_entropy:
+            return REASON_LOW_COMPLEXITY
+
+        return None
+
+    def is_read_junk(self, read: list[list[Union[str, bytes]]]) -> bool:
+        """Return True if any mate of the read fails the pre-filter. The whole pair is discarded in that case, just
+        like the api discards a pair if one of its mates is too long.
+        :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
+        for mate in read:
+            reason = self.screen(mate[1], mate[3])
+            if reason is not None:
+                self.statistics[reason] += 1
+                return True
+        return False
+
+    def pop_statistics(self) -> dict[str, int]:
+        """Return the per-reason rejection counts collected since the last call and reset them."""
+        collected = dict(self.statistics)
+        self.statistics.clear()
+        return collected
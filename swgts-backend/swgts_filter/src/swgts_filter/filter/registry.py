@@ -0,0 +1,245 @@
+# coding=utf-8
+import hashlib
+import os
+from collections import OrderedDict
+from logging import getLogger
+from time import time
+from typing import Any, Iterable, Optional
+
+import psutil
+
+from . import Filter
+
+ALL = ['FilterNotLoaded', 'FilterUnavailable', 'FilterRegistry']
+
+logger = getLogger(__name__)
+
+
+def _modification_times(filepaths: list[str]) -> list[float]:
+    return [os.path.getmtime(filepath) if os.path.exists(filepath) else 0.0 for filepath in filepaths]
+
+
+# A reference mapped with a minimap2 preset
+FilterKey = tuple[str, str]
+
+
+class FilterNotLoaded(Exception):
+    """The filter is configured, but the main process has not loaded it (yet), see FilterRegistry.get_loaded."""
+
+    def __init__(self, key: FilterKey):
+        super().__init__(f'Reference {key[0]} with preset {key[1]} is not loaded')
+        self.key = key
+
+
+class FilterUnavailable(Exception):
+    """The main process gave up loading the filter after load_attempts failed attempts, see FilterRegistry.refresh."""
+
+    def __init__(self, key: FilterKey):
+        super().__init__(f'Reference {key[0]} with preset {key[1]} could not be loaded')
+        self.key = key
+
+
+class FilterRegistry:
+    """Keeps several named filter configurations loaded. Every reference can be used with its own mapping preset and
+    with each of mapping_presets, every combination is a filter of its own (with its own aligner, mappy can't share an
+    index between presets). Filters are loaded on first use and the least recently used ones are unloaded when the
+    estimated index memory exceeds the budget, the default reference with its own preset is never unloaded.
+    A reference whose index (or sketch reference) changed on disk is rebuilt and swapped in; jobs that already hold
+    the old Filter instance finish with it.
+
+    In the filter server only the main process loads filters (preload, refresh), so the budget is charged once for
+    all workers, which are forked afterwards and share the indices. Workers only look filters up with get_loaded.
+    A filter that fails to load is tried again after load_retry_delay seconds (doubling with every failure) and given
+    up after load_attempts failures, until the server restarts."""
+
+    def __init__(self, references: dict[str, dict[str, Any]], default_reference: str, memory_budget: int,
+                 reload_interval: float, mapping_presets: Iterable[str] = (), load_attempts: int = 3,
+                 load_retry_delay: float = 30):
+        if default_reference not in references:
+            raise ValueError(f'The default reference {default_reference} is not configured.')
+        self.references = references
+        self.default_reference = default_reference
+        self.memory_budget = memory_budget
+        self.reload_interval = reload_interval
+        self.mapping_presets = sorted({settings['mapping_preset'] for settings in references.values()} |
+                                      set(mapping_presets))
+        self._loaded: OrderedDict[FilterKey, Filter] = OrderedDict()
+        self._memory: dict[FilterKey, int] = {}
+        self._modification_times: dict[FilterKey, list[float]] = {}
+        self._last_check: dict[FilterKey, float] = {}
+        self.load_attempts = load_attempts
+        self.load_retry_delay = load_retry_delay
+        self._load_failures: dict[FilterKey, int] = {}
+        self._next_load_attempt: dict[FilterKey, float] = {}
+        self.unavailable: set[FilterKey] = set()
+
+    def names(self) -> list[str]:
+        return list(self.references)
+
+    def default_preset(self, name: Optional[str] = None) -> str:
+        """The mapping preset configured for the named reference (the default one if name is None)."""
+        return self.references[self.default_reference if name is None else name]['mapping_preset']
+
+    def _default_key(self) -> FilterKey:
+        return self.default_reference, self.default_preset()
+
+    def loaded_memory(self) -> int:
+        return sum(self._memory.values())
+
+    def _load(self, key: FilterKey) -> Filter:
+        name, preset = key
+        settings = {**self.references[name], 'mapping_preset': preset}
+        logger.info(f'Loading reference {name} with preset {preset}')
+        rss_before = psutil.Process().memory_info().rss
+        loaded = Filter(**settings)
+        memory = psutil.Process().memory_info().rss - rss_before
+        if memory <= 0:
+            # The allocator might have reused freed memory, fall back to the size of the index on disk
+            memory = sum(os.path.getsize(f) for f in loaded.source_files() if os.path.exists(f))
+        self._memory[key] = memory
+        self._modification_times[key] = _modification_times(loaded.source_files())
+        # Decisions cached for an older index or different settings must not be reused
+        generation = repr((sorted(settings.items()), self._modification_times[key])).encode()
+        loaded.cache_key = f'{name}:{hashlib.sha1(generation).hexdigest()[:16]}'
+        loaded.key = key
+        self._last_check[key] = time()
+        self._loaded[key] = loaded
+        logger.info(f'Loaded reference {name} with preset {preset} using ~{memory // 2 ** 20} MiB, '
+                    f'{self.loaded_memory() // 2 ** 20} MiB of {self.memory_budget // 2 ** 20} MiB in use')
+        self._enforce_budget(keep=key)
+        return loaded
+
+    def _unload(self, key: FilterKey) -> None:
+        logger.info(f'Unloading reference {key[0]} with preset {key[1]}')
+        del self._loaded[key]
+        del self._memory[key]
+
+    def _enforce_budget(self, keep: FilterKey) -> None:
+        for key in list(self._loaded):
+            if self.loaded_memory() <= self.memory_budget:
+                break
+            if key not in [keep, self._default_key()]:
+                self._unload(key)
+
+    def _is_outdated(self, key: FilterKey) -> bool:
+        now = time()
+        if now - self._last_check[key] < self.reload_interval:
+            return False
+        self._last_check[key] = now
+        return _modification_times(self._loaded[key].source_files()) != self._modification_times[key]
+
+    def key(self, name: Optional[str] = None, preset: Optional[str] = None) -> FilterKey:
+        """The key of the filter for the named reference (the default one if name is None) mapped with the preset
+        (the one configured for the reference if preset is None). Raises KeyError for references and presets that are
+        not configured."""
+        if name is None:
+            name = self.default_reference
+        if name not in self.references:
+            raise KeyError(name)
+        if preset is None or self.references[name]['filter_mode'] == 'NONE':
+            # Nothing is mapped in filter mode NONE, one filter serves all presets
+            preset = self.default_preset(name)
+        if preset not in self.mapping_presets:
+            raise KeyError(preset)
+        return name, preset
+
+    def _rebuild(self, key: FilterKey) -> Filter:
+        name, preset = key
+        logger.info(f'The index of reference {name} changed on disk, rebuilding it for preset {preset}.')
+        # Drop the old instance first so its memory does not count against the budget of the new one
+        old_filter, old_memory = self._loaded[key], self._memory[key]
+        self._unload(key)
+        try:
+            return self._load(key)
+        except Exception as e:
+            # E.g. an index that is still being written, keep serving the old one until the files change again
+            logger.error(f'Could not rebuild reference {name} with preset {preset}, keeping the old index: {e}')
+            self._loaded[key], self._memory[key] = old_filter, old_memory
+            self._modification_times[key] = _modification_times(old_filter.source_files())
+            return old_filter
+
+    def get(self, name: Optional[str] = None, preset: Optional[str] = None) -> Filter:
+        """Return the filter for the named reference (the default one if name is None) mapped with the preset (the
+        one configured for the reference if preset is None), loading or rebuilding it if necessary. Raises KeyError
+        for references and presets that are not configured."""
+        key = self.key(name, preset)
+        if key in self._loaded:
+            self._loaded.move_to_end(key)
+            if not self._is_outdated(key):
+                return self._loaded[key]
+            return self._rebuild(key)
+        return self._load(key)
+
+    def get_loaded(self, name: Optional[str] = None, preset: Optional[str] = None) -> Filter:
+        """Like get, but never loads or rebuilds anything, for forked workers: a load there would only fill the
+        memory of that worker. Raises FilterNotLoaded if the filter is not loaded, FilterUnavailable if loading it was
+        given up and KeyError if it is not configured."""
+        key = self.key(name, preset)
+        if key in self.unavailable:
+            raise FilterUnavailable(key)
+        if key not in self._loaded:
+            raise FilterNotLoaded(key)
+        return self._loaded[key]
+
+    def outdated(self) -> list[FilterKey]:
+        """The loaded filters whose files changed on disk, each checked at most every reload_interval seconds."""
+        return [key for key in list(self._loaded) if self._is_outdated(key)]
+
+    def may_load(self, key: FilterKey) -> bool:
+        """False while a failed load of the filter waits for its next attempt and once the filter is unavailable."""
+        return key not in self.unavailable and time() >= self._next_load_attempt.get(key, 0.0)
+
+    def _load_failed(self, key: FilterKey, error: Exception) -> bool:
+        """Count a failed load of the requested filter, True if it is given up now."""
+        failures = self._load_failures.get(key, 0) + 1
+        self._load_failures[key] = failures
+        if failures >= self.load_attempts:
+            logger.error(f'Could not load reference {key[0]} with preset {key[1]}, giving up after {failures} '
+                         f'attempts: {error}')
+            self.unavailable.add(key)
+            return True
+        delay = self.load_retry_delay * 2 ** (failures - 1)
+        self._next_load_attempt[key] = time() + delay
+        logger.error(f'Could not load reference {key[0]} with preset {key[1]}, trying again in {delay} seconds: '
+                     f'{error}')
+        return False
+
+    def refresh(self, outdated: Iterable[FilterKey], requested: Iterable[FilterKey]) -> bool:
+        """Rebuild the outdated filters and load the requested ones (within the budget) that may_load. Returns True if
+        any loaded filter changed or one became unavailable, the workers then have to be forked again to see the
+        changes."""
+        changed = False
+        for key in outdated:
+            if key in self._loaded:
+                old_filter = self._loaded[key]
+                changed |= self._rebuild(key) is not old_filter
+        for key in requested:
+            if key in self._loaded:
+                self._loaded.move_to_end(key)
+                continue
+            if not self.may_load(key):
+                continue
+            try:
+                self._load(key)
+            except Exception as e:
+                # Until it is given up, the workers ask again with the next job that needs it
+                changed |= self._load_failed(key, e)
+                continue
+            self._load_failures.pop(key, None)
+            self._next_load_attempt.pop(key, None)
+            changed = True
+        return changed
+
+    def preload(self) -> None:
+        """Load as many filters as fit into the budget, starting with the default reference, then the other references
+        with their own presets and then the other presets. Called before the workers are forked, so that the indices
+        are shared between them."""
+        self.get(self.default_reference)
+        keys = [(name, self.default_preset(name)) for name in self.references] + \
+               [(name, preset) for name in self.references for preset in self.mapping_presets
+                if preset != self.default_preset(name) and self.references[name]['filter_mode'] != 'NONE']
+        for name, preset in keys:
+            # The size of the largest index loaded so far is the best guess for the next one
+            if (name, preset) not in self._loaded and \
+                    self.loaded_memory() + max(self._memory.values()) <= self.memory_budget:
+                self.get(name, preset)
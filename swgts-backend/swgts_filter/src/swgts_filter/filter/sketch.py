@@ -0,0 +1,79 @@
+# coding=utf-8
+import gzip
+from logging import getLogger
+from typing import Iterator, Optional, Union
+
+ALL = ['KmerSketch', 'read_fasta']
+
+_COMPLEMENT = str.maketrans('ACGTacgt', 'TGCATGCA')
+logger = getLogger(__name__)
+
+
+def read_fasta(filepath: str) -> Iterator[tuple[str, str]]:
+    """Yield (name, sequence) tuples of a plain or gzipped FASTA file."""
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt') as handle:
+        name: Optional[str] = None
+        parts: list[str] = []
+        for line in handle:
+            line = line.rstrip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(parts)
+                name = line[1:].split(maxsplit=1)[0] if len(line) > 1 else ''
+                parts = []
+            elif line:
+                parts.append(line)
+        if name is not None:
+            yield name, ''.join(parts)
+
+
+class KmerSketch:
+    """Set of all k-mers (both strands) of a small reference, usually the pathogen genome. Reads are classified by
+    looking up every stride-th k-mer, which is orders of magnitude cheaper than seeding against a human index."""
+
+    def __init__(self, reference_fasta: str, kmer_size: int, stride: int, positive_fraction: float,
+                 minimum_kmers: int, negative_minimum_kmers: int):
+        self.kmer_size = kmer_size
+        self.stride = stride
+        self.positive_fraction = positive_fraction
+        self.minimum_kmers = minimum_kmers
+        self.negative_minimum_kmers = negative_minimum_kmers
+        # Stored as bytes, the encoding the worker gets reads in
+        self.kmers: set[bytes] = set()
+
+        for name, sequence in read_fasta(reference_fasta):
+            sequence = sequence.upper()
+            for strand in (sequence, sequence.translate(_COMPLEMENT)[::-1]):
+                for position in range(len(strand) - kmer_size + 1):
+                    kmer = strand[position:position + kmer_size]
+                    # Low complexity k-mers (e.g. from the poly-A tail) would also be found in host reads
+                    if len(set(kmer)) > 2 and 'N' not in kmer:
+                        self.kmers.add(kmer.encode())
+        logger.info(f'Built k-mer sketch with {len(self.kmers)} {kmer_size}-mers from {reference_fasta}')
+
+    def count_hits(self, sequence: Union[str, bytes]) -> tuple[int, int]:
+        """Return the number of sampled k-mers of the sequence found in the sketch and the number of sampled k-mers."""
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        # The sketch k-mers are upper case, soft-masked (lower case) bases must still hit them
+        sequence = sequence.upper()
+        kmers = self.kmers
+        k = self.kmer_size
+        sampled = [sequence[p:p + k] for p in range(0, len(sequence) - k + 1, self.stride)]
+        return sum(map(kmers.__contains__, sampled)), len(sampled)
+
+    def classify(self, sequences: list[Union[str, bytes]]) -> Optional[bool]:
+        """Return True if the sequences (mates of one read) confidently stem from the reference, False if they
+        confidently don't and None if the aligner has to decide."""
+        hits, sampled = 0, 0
+        for sequence in sequences:
+            mate_hits, mate_sampled = self.count_hits(sequence)
+            hits += mate_hits
+            sampled += mate_sampled
+
+        if sampled >= self.minimum_kmers and hits >= self.positive_fraction * sampled:
+            return True
+        if sampled >= self.negative_minimum_kmers and hits == 0:
+            return False
+        return None
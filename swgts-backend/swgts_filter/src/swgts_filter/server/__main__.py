@@ -4,14 +4,24 @@ import logging
 import os
 import signal
 import sys
-from multiprocessing import Pool, Event, Manager
+import socket
+from multiprocessing import Event, SimpleQueue, Value
+from multiprocessing.sharedctypes import Synchronized
+from threading import Thread
 from time import time, sleep
-from uuid import UUID
+from typing import Any, Optional
+from uuid import UUID, uuid4
 
 import requests
-from redis import Redis
-from swgts_filter.filter import init_filter, is_read_legal
+from redis import Redis, WatchError
+from swgts_filter.filter import SEGMENTS_MARKER, Filter, parse_segments
+from swgts_filter.filter.cache import DecisionCache
+from swgts_filter.filter.registry import FilterKey, FilterNotLoaded, FilterRegistry, FilterUnavailable
 from swgts_filter.server.config import *
+from swgts_filter.server.job import Job, encode_job_reads
+from swgts_filter.server.logs import setup_logging
+from swgts_filter.server.profiling import Profiler
+from swgts_filter.server.supervisor import WorkerSupervisor
 
 if os.path.exists(CONFIG_FILE):
     print(f'Found config file: {CONFIG_FILE}, overwriting defaults!')
@@ -20,12 +30,18 @@ if os.path.exists(CONFIG_FILE):
 else:
     print('Using defaults, no config file specified')
 
+# Contexts created with this preset get theirs chosen from the length of their reads, see detect_mapping_preset
+MAPPING_PRESET_AUTO: str = 'auto'
+# Jobs are searched for it before their reads are, most never contain a segmented read
+SEGMENTS_MARKER_BYTES: bytes = SEGMENTS_MARKER.encode()
+# Close states of a context, see swgts_api.context_manager. The filter only fails contexts, see fail_job.
+CLOSE_STATUS_SEALED: str = 'sealed'
+CLOSE_STATUS_FAILED: str = 'failed'
+
 # This is the same timeout that is used in the api portion, the timeout value is exchanged via redis
 CONTEXT_TIMEOUT = None
 REQUEST_SIZE = None
 
-API_BASE_URL = 'https://traefik/api/'  # production
-
 
 def get_context_timeout():
     debug_current = time()
@@ -59,58 +75,161 @@ def get_request_size():
     return REQUEST_SIZE
 
 
-logging.basicConfig(filename=LOG_FILE, level='INFO',
-                    format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+setup_logging(LOG_FILE, LOG_LEVEL, LOG_QUEUED, LOG_JSON, LOG_EVENT_RATE, LOG_EVENT_BURST)
 
-redis_server = Redis(host=REDIS_SERVER)
+redis_server = Redis(host=REDIS_SERVER, port=REDIS_PORT)
 
 logger = logging.getLogger()
-logger.addHandler(logging.StreamHandler())
 
 logger.info('Setting up server.')
 
-logger.info('Calling init_filter')
-
-init_filter(FILTER_MODE, MAPPING_PRESET, MINIMAP2_REFERENCE_DATABASE, MINIMAP2_POSITIVE_CONTIG,
-            MINIMAP2_QUALITY_THRESHOLD)
+logger.info('Setting up filter registry')
+
+# Keyword arguments of swgts_filter.filter.Prefilter, used by the references that don't configure their own
+PREFILTER: Optional[dict[str, Any]] = None
+if PREFILTER_ENABLED:
+    PREFILTER = {'minimum_length': PREFILTER_MINIMUM_LENGTH, 'minimum_mean_quality': PREFILTER_MINIMUM_MEAN_QUALITY,
+                 'minimum_dinucleotide_entropy': PREFILTER_MINIMUM_DINUCLEOTIDE_ENTROPY,
+                 'homopolymer_length': PREFILTER_HOMOPOLYMER_LENGTH,
+                 'maximum_homopolymer_fraction': PREFILTER_MAXIMUM_HOMOPOLYMER_FRACTION,
+                 'adapters': PREFILTER_ADAPTERS, 'adapter_remainder': PREFILTER_ADAPTER_REMAINDER}
+
+if FILTER_REFERENCES is None:
+    # Single reference deployment configured through the plain settings
+    FILTER_REFERENCES = {DEFAULT_REFERENCE: {
+        'filter_mode': FILTER_MODE,
+        'mapping_preset': MAPPING_PRESET,
+        'minimap2_reference_database': MINIMAP2_REFERENCE_DATABASE,
+        'minimap2_positive_contig': MINIMAP2_POSITIVE_CONTIG,
+        'minimap2_quality_threshold': MINIMAP2_QUALITY_THRESHOLD,
+        'paired_mapping_strategy': PAIRED_MAPPING_STRATEGY.get(FILTER_MODE, 'pair'),
+        'mate_first_minimum_mapq': MATE_FIRST_MINIMUM_MAPQ,
+        'sketch_reference': SKETCH_REFERENCE,
+        'sketch_kmer_size': SKETCH_KMER_SIZE,
+        'sketch_stride': SKETCH_STRIDE,
+        'sketch_positive_fraction': SKETCH_POSITIVE_FRACTION,
+        'sketch_minimum_kmers': SKETCH_MINIMUM_KMERS,
+        'sketch_negative_minimum_kmers': SKETCH_NEGATIVE_MINIMUM_KMERS,
+        'mapping_options': MAPPING_OPTIONS.get(FILTER_MODE, {}),
+    }}
+FILTER_REFERENCES = {name: {'prefilter': PREFILTER, **settings} for name, settings in FILTER_REFERENCES.items()}
+
+filter_registry = FilterRegistry(FILTER_REFERENCES, DEFAULT_REFERENCE, FILTER_MEMORY_BUDGET, FILTER_RELOAD_INTERVAL,
+                                 MAPPING_PRESETS, FILTER_LOAD_ATTEMPTS, FILTER_LOAD_RETRY_DELAY)
+# Load the indices before the workers are forked, so that they share them
+filter_registry.preload()
+# Workers ask the main process through this queue to load filters that are not loaded, they never load one themselves
+LOAD_REQUESTS: SimpleQueue = SimpleQueue()
 
 if not redis_server.ping():
     logger.fatal('Could not connect to stateful backend. Goodbye.')
     sys.exit(1)
 
-logger.info('Setting up queue and worker')
+# Tell the api which references contexts can choose from
+pipeline = redis_server.pipeline()
+pipeline.delete('config:references')
+pipeline.sadd('config:references', *filter_registry.names())
+pipeline.delete('config:mapping_presets')
+pipeline.sadd('config:mapping_presets', *filter_registry.mapping_presets)
+pipeline.set('config:default_reference', DEFAULT_REFERENCE)
+pipeline.execute()
 
+logger.info('Setting up queue and worker')
 
-def mark_for_saving(context: UUID, reads: list[list[list[str]]], how_many_were_processed: int) -> None:
-    pipeline = redis_server.pipeline()
-
-    for pair in reads:
-        for pair_index, read in enumerate(pair):
-            pipeline.sadd(f'context:{context}:pair:{pair_index}:reads', '\n'.join(read))
 
-    pair_count_raw = redis_server.get(f'context:{context}:pair_count')
+def mark_for_saving(context: UUID, records: list[list[memoryview]], read_ids: list[bytes], pair_count: int,
+                    processed_reads: int, processed_bytes: int, seconds_per_byte: Optional[float],
+                    active_filter: Optional[Filter], decision_cache: Optional[DecisionCache]) -> None:
+    """Commit the result of a job in a single transaction: the kept reads (one variadic SADD per mate, or only their
+    ids for hands-off contexts), the processed read count, the pending bytes, the statistics and the speed sample.
+    Nothing is written for a context that expired or was closed meanwhile, that would recreate its keys, only the
+    global statistics are still counted."""
+    timeout = get_context_timeout()
+    # Popped once, a transaction that has to be repeated must not lose them
+    statistics = pop_statistics(active_filter, decision_cache)
+    with redis_server.pipeline(transaction=True) as transaction:
+        while True:
+            try:
+                transaction.watch(f'context:{context}:pair_count')
+                exists = transaction.exists(f'context:{context}:pair_count')
+                transaction.multi()
+                if exists:
+                    for pair_index in range(pair_count):
+                        if len(records) > 0:
+                            # The records are slices of the job buffer, they are sent as they are
+                            transaction.sadd(f'context:{context}:pair:{pair_index}:reads',
+                                             *[pair[pair_index] for pair in records])
+                        # TODO: Check if expiration shouldn't be set in close_context
+                        transaction.expire(f'context:{context}:pair:{pair_index}:reads', timeout)
+                        transaction.expire(f'context:{context}:pair:{pair_index}:filename', timeout)
+                    if len(read_ids) > 0:
+                        transaction.sadd(f'context:{context}:read_ids', *read_ids)
+                        transaction.expire(f'context:{context}:read_ids', timeout)
+
+                    transaction.incrby(f'context:{context}:processed_reads', processed_reads)
+                    transaction.expire(f'context:{context}:processed_reads', timeout)
+                    transaction.expire(f'context:{context}:pair_count', timeout)
+                    transaction.expire(f'context:{context}:reference', timeout)
+                    transaction.expire(f'context:{context}:hands_off', timeout)
+                    transaction.expire(f'context:{context}:upload_mode', timeout)
+                    transaction.expire(f'context:{context}:mapping_preset', timeout)
+                    transaction.expire(f'context:{context}:detected_preset', timeout)
+                    transaction.incrby(f'context:{context}:pending_bytes', -processed_bytes)
+                    transaction.expire(f'context:{context}:pending_bytes', timeout)
+                    if seconds_per_byte is not None:
+                        transaction.lpush(f'context:{context}:speed', seconds_per_byte)
+                        transaction.ltrim(f'context:{context}:speed', 0, 9)
+                transaction.incrby('stats:bases', processed_bytes)
+                for key, counts in statistics.items():
+                    for field, count in counts.items():
+                        transaction.hincrby(key, field, count)
+                transaction.execute()
+                break
+            except WatchError:
+                # Another worker refreshed the expiry of the context, or the api closed it
+                continue
 
-    if pair_count_raw is None:
+    if not exists:
         logger.warning(
-            f"Attempting to process reads for context {context} but no pair_count is stored, maybe the context is orphaned")
-        return
-
-    # TODO: Check if expiration shouldn't be set in close_context
-    for pair_index in range(int(pair_count_raw)):
-        pipeline.expire(f'context:{context}:pair:{pair_index}:reads', get_context_timeout())
-        pipeline.expire(f'context:{context}:pair:{pair_index}:filename', get_context_timeout())
-
-    pipeline.incrby(f'context:{context}:processed_reads', how_many_were_processed)
-    pipeline.expire(f'context:{context}:processed_reads', get_context_timeout())
-    pipeline.expire(f'context:{context}:pair_count', get_context_timeout())
-    logger.info('Will now execute')
-    pipeline.execute()
-
-
-def change_pending_bytes_count(context: UUID, diff: int) -> int:
-    now_pending = redis_server.incrby(f'context:{context}:pending_bytes', diff)
-    redis_server.expire(f'context:{context}:pending_bytes', get_context_timeout())
-    return int(now_pending)
+            f"Processed reads for context {context} but no pair_count is stored, maybe the context is orphaned",
+            extra={'context': context})
+
+
+def pop_statistics(active_filter: Optional[Filter],
+                   decision_cache: Optional[DecisionCache]) -> dict[str, dict[str, int]]:
+    """The counters of the last job by the hash they are added to: the pre-filter rejections of its filter
+    (stats:prefilter:<reference>:<preset>) and its decision cache lookups (stats:decision_cache)."""
+    statistics = {}
+    if active_filter is not None and active_filter.prefilter is not None:
+        name, preset = active_filter.key
+        statistics[f'stats:prefilter:{name}:{preset}'] = active_filter.prefilter.pop_statistics()
+    if decision_cache is not None:
+        statistics['stats:decision_cache'] = decision_cache.pop_statistics()
+    return statistics
+
+
+def fail_job(context: str, processed_bytes: int, message: str) -> None:
+    """Give up on a job that can't be filtered: release its pending bytes and fail its context, unless the api already
+    finalises it. The api then rejects further chunks of the context and closing it reports the message, like for a
+    context the api could not write."""
+    with redis_server.pipeline(transaction=True) as transaction:
+        while True:
+            try:
+                transaction.watch(f'context:{context}:pair_count', f'context:{context}:close_status')
+                if not transaction.exists(f'context:{context}:pair_count'):
+                    # Expired or closed meanwhile, nothing is left to release
+                    return
+                status = transaction.get(f'context:{context}:close_status')
+                transaction.multi()
+                transaction.incrby(f'context:{context}:pending_bytes', -processed_bytes)
+                if status is None or status.decode() == CLOSE_STATUS_SEALED:
+                    transaction.set(f'context:{context}:close_result', json.dumps({'message': message}),
+                                    ex=get_context_timeout())
+                    transaction.set(f'context:{context}:close_status', CLOSE_STATUS_FAILED, ex=get_context_timeout())
+                transaction.execute()
+                return
+            except WatchError:
+                continue
 
 
 def request_data_from_backend(context_id: UUID, bytes_to_request: int):
@@ -127,94 +246,353 @@ def request_data_from_backend(context_id: UUID, bytes_to_request: int):
         logger.error(f"Error requesting data: {e}")
 
 
-def spawn_worker(worker_id: int, is_shutting_down: Event):
+def fetch_job(job_id: str) -> list[bytes]:
+    """Take all elements of a job in one round trip, in the order they were pushed."""
+    transaction = redis_server.pipeline(transaction=True)
+    transaction.lrange(f'work:{job_id}', 0, -1)
+    transaction.delete(f'work:{job_id}')
+    # The api pushes to the left
+    return transaction.execute()[0][::-1]
+
+
+def requeue_job(context_id: str, job: Job, indices: range, start_time: float, front: bool = True) -> None:
+    """Put reads of an interrupted job back in front of the queue (or at its end), in the format enqueue_chunks of the
+    api uses."""
+    job_id = uuid4()
+    transaction = redis_server.pipeline(transaction=True)
+    transaction.lpush(f'work:{job_id}', context_id)
+    transaction.lpush(f'work:{job_id}', job.sequence_bytes(indices))
+    transaction.lpush(f'work:{job_id}', len(indices))
+    transaction.lpush(f'work:{job_id}', job.pair_count)
+    transaction.lpush(f'work:{job_id}', start_time)
+    transaction.lpush(f'work:{job_id}', encode_job_reads([job.records[i] for i in indices]))
+    if front:
+        # Jobs are popped from the right, so this one is next
+        transaction.rpush('work:queue', str(job_id))
+    else:
+        transaction.lpush('work:queue', str(job_id))
+    transaction.execute()
+
+
+def take_parked_records(context_id: str, park_ids: dict[int, str], wanted: list[int]) -> dict[int, Optional[bytes]]:
+    """Fetch the whole records of the wanted segmented reads (by their index in the job) and delete the parked
+    records of all given reads in one round trip. None marks a record that is gone, e.g. because the context expired."""
+    transaction = redis_server.pipeline(transaction=True)
+    for index in wanted:
+        transaction.get(f'context:{context_id}:parked:{park_ids[index]}')
+    transaction.delete(*[f'context:{context_id}:parked:{park_id}' for park_id in park_ids.values()])
+    return dict(zip(wanted, transaction.execute()))
+
+
+def detect_mapping_preset(context_id: str, reference: Optional[str], job: Job) -> str:
+    """Choose the preset of a context created with the preset 'auto' from the read lengths of the job. The first job
+    of the context decides, later ones (also those other workers filter at the same time) use its decision."""
+    lengths = sorted(len(record[1]) for corresponding_reads in job.reads for record in corresponding_reads)
+    median = lengths[len(lengths) // 2] if lengths else 0
+    if lengths and median <= SHORT_READ_MAXIMUM_LENGTH and SHORT_READ_PRESET in filter_registry.mapping_presets:
+        preset = SHORT_READ_PRESET
+    else:
+        preset = filter_registry.default_preset(reference)
+    transaction = redis_server.pipeline(transaction=True)
+    transaction.set(f'context:{context_id}:detected_preset', preset, ex=get_context_timeout(), nx=True)
+    transaction.get(f'context:{context_id}:detected_preset')
+    detected = transaction.execute()[1].decode()
+    if detected == preset:
+        logger.info(f'Mapping context {context_id} with preset {preset}, the median read length is {median}.',
+                    extra={'context': context_id})
+    return detected
+
+
+def drain_deadline_passed() -> bool:
+    return 0 < DRAIN_DEADLINE.value < time()
+
+
+def spawn_worker(worker_id: int, is_shutting_down: Event, busy: Synchronized):
     logger.info(f'Worker spawned with id {worker_id}')
+    # The main process coordinates the shutdown through is_shutting_down and DRAIN_DEADLINE and counts the workers
+    # that hold a job through busy
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    decision_cache: Optional[DecisionCache] = None
+    if DECISION_CACHE_SIZE > 0:
+        decision_cache = DecisionCache(DECISION_CACHE_SIZE, redis_server if DECISION_CACHE_SHARED else None,
+                                       DECISION_CACHE_TTL)
+    profiler = Profiler(PROFILING_ENABLED, f'worker-{worker_id}', PROFILING_DIRECTORY, PROFILING_SAMPLE_INTERVAL,
+                        PROFILING_DUMP_INTERVAL)
+    profiler.start()
     while not is_shutting_down.is_set():
+        busy.value = False
         # Fetch a job
-        work_assignment = redis_server.brpop(f'work:queue', 60)
+        # Short timeout, so that idle workers notice is_shutting_down quickly
+        work_assignment = redis_server.brpop(f'work:queue', WORKER_POLL_TIMEOUT)
 
         if work_assignment is None:
-            logger.info(f'Worker {worker_id} reporting: Nothing to be done here, boring ...')
+            logger.info(f'Worker {worker_id} reporting: Nothing to be done here, boring ...',
+                        extra={'event': 'worker_idle', 'worker': worker_id})
+            profiler.maybe_dump()
             continue
         else:
+            busy.value = True
 
             # Redis brpop can be called on multiple lists and thus returns a tuple, first value is the list
             pending_job_id = work_assignment[1].decode()
-            context_id = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-            # TODO: Extract correct type instead of casting to int
-            effective_cumulative_chunk_size = int(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-            read_count = int(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-            pair_count = int(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-            start_time = float(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-
-            logger.info(
-                f'Worker {worker_id} reporting: I am working on a chunk for context {context_id} (ECCS: {effective_cumulative_chunk_size}) with {read_count} reads (in pairs of {pair_count})!')
+            with profiler.stage('fetch'):
+                elements = fetch_job(pending_job_id)
 
-            if redis_server.llen(f'work:{pending_job_id}') == 0:
+            if len(elements) <= 5:
                 # We have an empty or incomplete work package
-                logger.info(f'Worker {worker_id} reporting: I found an incomplete or empty chunk, I will delete it!')
+                logger.info(f'Worker {worker_id} reporting: I found an incomplete or empty chunk, I will delete it!',
+                            extra={'worker': worker_id, 'job': pending_job_id})
                 continue
 
-            # reconstruct chunk
-            chunk = []
-            for read_idx in range(read_count):
-                reads = []
-                for pair_idx in range(pair_count):
-                    l1 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    l2 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    l3 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    l4 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    reads.append([l1, l2, l3, l4])
-                chunk.append(reads)
-            # logger.info(f'Worker {worker_id} reporting: I reconstructed the reads, time to filter them!')
-            to_save: list[list[list[str]]] = []
-            for corresponding_reads in chunk:
-                if is_read_legal(corresponding_reads):
-                    to_save.append(corresponding_reads)
-            logger.info(
-                f'Worker {worker_id} reporting: I filtered {len(chunk) - len(to_save)} of {len(chunk)}, time to mark the reads for saving')
-
-            mark_for_saving(context_id, to_save, len(chunk))
-            logger.info(f'Worker {worker_id} reporting: I will now update the pending byte count')
-            redis_server.incrby('stats:bases', effective_cumulative_chunk_size)
-            change_pending_bytes_count(context_id, -effective_cumulative_chunk_size)
-            logger.info(f'Worker {worker_id} reporting: Done!')
-            end_time = time()
-
-            # Request more data from client, after processing is finished
-            logger.info(f'Worker {worker_id} requesting data for context {context_id}.')
-            request_data_from_backend(context_id, get_request_size())
-
-            pipeline = redis_server.pipeline()
-            pipeline.lpush(f'context:{context_id}:speed', (end_time - start_time) / effective_cumulative_chunk_size)
-            pipeline.ltrim(f'context:{context_id}:speed', 0, 9)
-            pipeline.execute()
-
+            # The bytes of the job that are still counted as pending, fail_job releases them if the job fails
+            context_id, unreleased_bytes = None, 0
+            try:
+                context_id = elements[0].decode()
+                # TODO: Extract correct type instead of casting to int
+                effective_cumulative_chunk_size = int(elements[1])
+                unreleased_bytes = effective_cumulative_chunk_size
+                read_count = int(elements[2])
+                pair_count = int(elements[3])
+                start_time = float(elements[4])
+
+                # Identifies the job in the structured log fields
+                job_fields = {'worker': worker_id, 'context': context_id, 'job': pending_job_id}
+                logger.info(
+                    f'Worker {worker_id} reporting: I am working on a chunk for context {context_id} (ECCS: {effective_cumulative_chunk_size}) with {read_count} reads (in pairs of {pair_count})!',
+                    extra={'event': 'job_started', **job_fields})
+
+                reference, hands_off, mapping_preset, detected_preset = redis_server.mget(
+                    f'context:{context_id}:reference', f'context:{context_id}:hands_off',
+                    f'context:{context_id}:mapping_preset', f'context:{context_id}:detected_preset')
+                reference = None if reference is None else reference.decode()
+                mapping_preset = None if mapping_preset is None else mapping_preset.decode()
+
+                # reconstruct chunk, the reads stay bytes
+                with profiler.stage('decode'):
+                    try:
+                        if len(elements) == 6:
+                            job = Job(elements[5], read_count, pair_count)
+                        else:
+                            # Enqueued by an api that still pushes every line separately
+                            job = Job.from_lines(elements[5:], read_count, pair_count)
+                    except ValueError as e:
+                        # E.g. a line break within a line, the reads can't be told apart anymore
+                        logger.error(f'Worker {worker_id} reporting: Discarding a malformed job of context {context_id}: '
+                                     f'{e}', extra=job_fields)
+                        job = None
+
+                active_filter = None
+                if job is not None:
+                    try:
+                        if mapping_preset == MAPPING_PRESET_AUTO:
+                            mapping_preset = detected_preset.decode() if detected_preset is not None else \
+                                detect_mapping_preset(context_id, reference, job)
+                        # The job keeps using this instance even if the main process swaps in a rebuilt index meanwhile
+                        active_filter = filter_registry.get_loaded(reference, mapping_preset)
+                    except FilterNotLoaded as e:
+                        # Loading it here would block this worker and fill its private memory, the main process loads it
+                        # and forks new workers. The job waits at the end of the queue meanwhile.
+                        logger.info(f'Worker {worker_id} reporting: Reference {e.key[0]} with preset {e.key[1]} is not '
+                                    f'loaded yet, requeueing the job of context {context_id}.', extra=job_fields)
+                        LOAD_REQUESTS.put(e.key)
+                        requeue_job(context_id, job, range(len(job)), start_time, front=False)
+                        is_shutting_down.wait(WORKER_POLL_TIMEOUT)
+                        continue
+                    except FilterUnavailable as e:
+                        logger.error(f'Worker {worker_id} reporting: Reference {e.key[0]} with preset {e.key[1]} could not '
+                                     f'be loaded, failing context {context_id}.', extra=job_fields)
+                        fail_job(context_id, effective_cumulative_chunk_size,
+                                 f'The reference {e.key[0]} could not be loaded with preset {e.key[1]}.')
+                        continue
+                    except KeyError:
+                        logger.error(f'Worker {worker_id} reporting: Context {context_id} uses the unknown reference '
+                                     f'{reference} or preset {mapping_preset}, its reads will be discarded!',
+                                     extra=job_fields)
+                # logger.info(f'Worker {worker_id} reporting: I reconstructed the reads, time to filter them!')
+                kept: list[int] = []
+                processed = read_count
+                if active_filter is not None:
+                    # Filtered in batches, so that a draining worker can stop in the middle of a long job
+                    processed = 0
+                    while processed < len(job) and not drain_deadline_passed():
+                        batch = range(processed, min(processed + DRAIN_BATCH_SIZE, len(job)))
+                        with profiler.stage('prefilter'):
+                            screened = [index for index in batch if active_filter.passes_prefilter(job.reads[index])]
+                        with profiler.stage('mapping'):
+                            reads = [job.reads[index] for index in screened]
+                            if decision_cache is not None and active_filter.filter_mode != 'NONE':
+                                decisions = decision_cache.decide(active_filter.cache_key, reads, active_filter.classify)
+                            else:
+                                decisions = [active_filter.classify(corresponding_reads) for corresponding_reads in reads]
+                        kept.extend(index for index, keep in zip(screened, decisions) if keep)
+                        processed = batch.stop
+                processed_bytes = effective_cumulative_chunk_size
+                if processed < read_count:
+                    remainder = range(processed, read_count)
+                    processed_bytes -= job.sequence_bytes(remainder)
+                    logger.warning(f'Worker {worker_id} reporting: The drain timeout passed, requeueing {len(remainder)} '
+                                   f'of {read_count} reads of context {context_id}.', extra=job_fields)
+                    requeue_job(context_id, job, remainder, start_time)
+                    unreleased_bytes = processed_bytes
+                logger.info(
+                    f'Worker {worker_id} reporting: I filtered {processed - len(kept)} of {processed}, time to mark the reads for saving',
+                    extra={'event': 'job_filtered', **job_fields})
+
+                finished = processed == read_count and processed_bytes > 0
+                end_time = time()
+                with profiler.stage('commit'):
+                    # Reads the api segmented because they are longer than its buffer, their whole records are parked
+                    # (except for hands-off contexts). The records of requeued reads stay parked for the worker that
+                    # finishes them.
+                    park_ids = {}
+                    if hands_off is None and job is not None and SEGMENTS_MARKER_BYTES in job.buffer:
+                        park_ids = {index: segments[1] for index in range(processed)
+                                    if (segments := parse_segments(job.reads[index])) is not None}
+                    if hands_off is not None:
+                        # Only the read ids are returned to the client, the header of the first mate is enough
+                        records, read_ids = [], [job.reads[index][0][0] for index in kept]
+                    elif not park_ids:
+                        records, read_ids = [job.records[index] for index in kept], []
+                    else:
+                        parked = take_parked_records(context_id, park_ids, [index for index in kept if index in park_ids])
+                        records, read_ids = [], []
+                        for index in kept:
+                            if index not in parked:
+                                records.append(job.records[index])
+                            elif parked[index] is not None:
+                                records.append([parked[index]])
+                            else:
+                                logger.error(f'Worker {worker_id} reporting: The parked record of a kept long read of '
+                                             f'context {context_id} is gone, the read is lost!', extra=job_fields)
+                    mark_for_saving(context_id, records, read_ids, pair_count, processed, processed_bytes,
+                                    (end_time - start_time) / processed_bytes if finished else None, active_filter,
+                                    decision_cache)
+                    unreleased_bytes = 0
+                logger.info(f'Worker {worker_id} reporting: Done!', extra={'event': 'job_done', **job_fields})
+
+                if not finished:
+                    # The worker that finishes the requeued reads asks for more data
+                    continue
+
+                with profiler.stage('callback'):
+                    # Request more data from client, after processing is finished
+                    logger.info(f'Worker {worker_id} requesting data for context {context_id}.',
+                                extra={'event': 'request_data', **job_fields})
+                    request_data_from_backend(context_id, get_request_size())
+            except Exception as e:
+                # E.g. a malformed job or a bug in the filter, the job was already taken from redis
+                logger.exception(f'Worker {worker_id} reporting: Could not filter job {pending_job_id} of context '
+                                 f'{context_id}: {e}', extra={'worker': worker_id, 'job': pending_job_id})
+                if context_id is not None and unreleased_bytes > 0:
+                    fail_job(context_id, unreleased_bytes, 'The filter could not process the reads of the context.')
+
+    profiler.stop()
     logger.info(f'Worker {worker_id} shutting down.')
 
 
-with Manager() as manager:
-    IS_SHUTTING_DOWN: Event = manager.Event()
+IS_SHUTTING_DOWN: Event = Event()
+# Time after which draining workers requeue the rest of their current job, 0 while not shutting down. Shared with
+# the workers, which are forked after it is created.
+DRAIN_DEADLINE = Value('d', 0.0)
+# Identifies this server in the set of ready filter servers
+NODE_ID: str = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def signal_handler(sig, frame):
+    logger.info(f'Got {signal.Signals(sig).name}, trying to shut down.')
+    IS_SHUTTING_DOWN.set()
+
 
+class FilterLoader(Thread):
+    """Rebuilds changed indices and loads the ones workers asked for in the main process, in the background so the
+    main loop keeps announcing readiness while a large index loads. No workers are forked while it runs."""
 
-    def signal_handler(sig, frame):
-        logger.info('Got SIGINT, trying to shut down.')
-        IS_SHUTTING_DOWN.set()
+    def __init__(self, outdated: list[FilterKey], requested: set[FilterKey]):
+        super().__init__(name='filter-loader', daemon=True)
+        self.outdated = outdated
+        self.requested = requested
+        self.changed = False
 
+    def run(self) -> None:
+        self.changed = filter_registry.refresh(self.outdated, self.requested)
 
-    signal.signal(signal.SIGINT, signal_handler)
-    logger.info('Press Ctrl+C to safely shutdown')
 
-    pool: Pool = Pool(processes=WORKER_THREADS)
-    SERVER_LAUNCH_TIME = time()
-    logger.info('Server launched.')
-    dummy_result = pool.starmap_async(spawn_worker, ((x, IS_SHUTTING_DOWN) for x in range(WORKER_THREADS)))
-    logger.info('Worker threads launched!')
-    while not IS_SHUTTING_DOWN.is_set():
-        # logger.info('I am still alive')
-        # Main thread may not block since this would prevent signal handler from working
-        sleep(10)
-    logger.info('Closing worker pool')
-    pool.close()
-    logger.info('Joining worker pool')
-    pool.join()
+def pending_load_requests() -> set[FilterKey]:
+    """The filters workers asked for, without the ones whose failed load waits for its next attempt."""
+    requested = set()
+    while not LOAD_REQUESTS.empty():
+        requested.add(LOAD_REQUESTS.get())
+    return {key for key in requested if filter_registry.may_load(key)}
+
+
+def announce_readiness() -> None:
+    """Tell the api that this server takes jobs for the next READINESS_TTL seconds."""
+    pipeline = redis_server.pipeline()
+    pipeline.zadd('filter:ready', {NODE_ID: time() + READINESS_TTL})
+    pipeline.zremrangebyscore('filter:ready', '-inf', time())
+    pipeline.execute()
+
+
+signal.signal(signal.SIGINT, signal_handler)
+# Sent by docker on stop and restart
+signal.signal(signal.SIGTERM, signal_handler)
+logger.info('Press Ctrl+C to safely shutdown')
+
+if WORKER_AUTOSCALING:
+    supervisor = WorkerSupervisor(spawn_worker, redis_server, MINIMUM_WORKERS,
+                                  MAXIMUM_WORKERS if MAXIMUM_WORKERS is not None else WORKER_THREADS,
+                                  SCALE_UP_JOBS_PER_WORKER, SCALE_UP_JOB_AGE, SCALE_DOWN_IDLE_TIME,
+                                  WORKER_MEMORY_ESTIMATE, WORKER_MEMORY_RESERVE)
+else:
+    # A fixed number of workers
+    supervisor = WorkerSupervisor(spawn_worker, redis_server, WORKER_THREADS, WORKER_THREADS, 0, float('inf'), 0, 0,
+                                  0)
+
+if PROFILING_ENABLED:
+    def forward_profile_request(sig, frame):
+        logger.info('Got SIGUSR1, asking the workers to write their profiles.')
+        for pid in supervisor.pids():
+            os.kill(pid, signal.SIGUSR1)
+
+
+    signal.signal(signal.SIGUSR1, forward_profile_request)
+
+SERVER_LAUNCH_TIME = time()
+logger.info('Server launched.')
+supervisor.start()
+logger.info(f'{supervisor.worker_count()} workers launched!')
+announce_readiness()
+loader: Optional[FilterLoader] = None
+while not IS_SHUTTING_DOWN.is_set():
+    # Main thread may not block since this would prevent signal handler from working
+    sleep(SUPERVISOR_INTERVAL)
+    if IS_SHUTTING_DOWN.is_set():
+        break
+    try:
+        if loader is None:
+            outdated, requested = filter_registry.outdated(), pending_load_requests()
+            if outdated or requested:
+                loader = FilterLoader(outdated, requested)
+                loader.start()
+        elif not loader.is_alive():
+            if loader.changed:
+                # Only freshly forked workers see the changed (or given up) filters
+                supervisor.restart()
+            loader = None
+        if loader is None:
+            supervisor.scale()
+        announce_readiness()
+    except Exception as e:
+        # E.g. redis being restarted, the workers keep running and scaling resumes once it is back
+        logger.error(f'Could not scale workers: {e}')
+
+try:
+    redis_server.zrem('filter:ready', NODE_ID)
+except Exception as e:
+    logger.error(f'Could not withdraw readiness, the api notices after {READINESS_TTL} seconds: {e}')
+DRAIN_DEADLINE.value = time() + SHUTDOWN_DRAIN_TIMEOUT
+logger.info(f'Waiting up to {SHUTDOWN_DRAIN_TIMEOUT} seconds for the workers to finish their current jobs')
+# Workers requeue unfinished reads at the deadline, the grace period covers a batch that is still being mapped
+supervisor.stop(SHUTDOWN_DRAIN_TIMEOUT + SHUTDOWN_GRACE_PERIOD)
+logger.info('All workers stopped.')
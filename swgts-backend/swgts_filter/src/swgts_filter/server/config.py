@@ -1,8 +1,19 @@
 # coding=utf-8
 from os import getcwd, path
+from typing import Any, Optional
 
 # The log file
 LOG_FILE: str = 'server.log'
+LOG_LEVEL: str = 'INFO'
+# Hand log records to a background thread (one per process) that writes them, so that the workers don't wait for the
+# log I/O
+LOG_QUEUED: bool = False
+# Write one JSON object per line, with the ids of workers, contexts and jobs as separate fields
+LOG_JSON: bool = False
+# Messages logged per job (e.g. started, filtered, done) or idle poll are limited to LOG_EVENT_RATE per second and kind
+# of message in each process, with bursts of up to LOG_EVENT_BURST. 0 logs all of them.
+LOG_EVENT_RATE: float = 0
+LOG_EVENT_BURST: int = 20
 
 INPUT_DIRECTORY: str = path.join(getcwd(), 'input')
 # The secondary configuration file to load to override the defaults set in here
@@ -18,11 +29,143 @@ MINIMAP2_REFERENCE_DATABASE: str = path.join(INPUT_DIRECTORY, 'databases', 'comb
 MINIMAP2_POSITIVE_CONTIG: str = 'hCoV-19/Wuhan/WIV04/2019|EPI_ISL_402124'
 # Minimap2 Mapping Preset
 MAPPING_PRESET: str = 'map-ont'
+# Further presets every reference is also loaded with, contexts can choose one at creation. Each preset holds its own
+# copy of the index (within FILTER_MEMORY_BUDGET). The k-mer and window sizes of a prebuilt .mmi index stay those it was
+# built with, the preset sets the chaining and alignment parameters. E.g. ['sr', 'map-hifi'].
+MAPPING_PRESETS: list[str] = []
+# Contexts created with the preset 'auto' are mapped with SHORT_READ_PRESET if the median read length of their first
+# job is at most SHORT_READ_MAXIMUM_LENGTH, else with the preset of their reference. SHORT_READ_PRESET has to be in
+# MAPPING_PRESETS.
+SHORT_READ_PRESET: str = 'sr'
+SHORT_READ_MAXIMUM_LENGTH: int = 500
 # Quality threshold, only used in negative filtering mode
 MINIMAP2_QUALITY_THRESHOLD: int = 20
+# How paired-end reads are mapped per filter mode. 'pair' always maps both mates together, 'mate-first' maps the first
+# mate alone and only maps the pair if the first mate's primary hit has a mapping quality below
+# MATE_FIRST_MINIMUM_MAPQ (or, in NEGATIVE mode, doesn't confidently hit the host).
+PAIRED_MAPPING_STRATEGY: dict[str, str] = {'COMBINED': 'pair', 'NEGATIVE': 'pair'}
+MATE_FIRST_MINIMUM_MAPQ: int = 30
+# minimap2 options per filter mode and mapping preset, keyword arguments of mappy.Aligner that override the preset's
+# values (see swgts_filter.filter.MAPPING_OPTIONS). k and w only apply to indices built from a FASTA. The benchmark
+# tuner (python -m swgts_filter.benchmark.tune) writes this setting, e.g.
+# MAPPING_OPTIONS = {'COMBINED': {'map-ont': {'min_chain_score': 60, 'bw': 200}}}
+MAPPING_OPTIONS: dict[str, dict[str, dict[str, Any]]] = {'COMBINED': {}, 'NEGATIVE': {}}
+
+# Named references that contexts can choose from at creation. Each entry holds the keyword arguments of
+# swgts_filter.filter.Filter, e.g.
+# FILTER_REFERENCES = {
+#     'sars-cov-2': {'filter_mode': 'COMBINED', 'mapping_preset': 'map-ont',
+#                    'minimap2_reference_database': path.join(INPUT_DIRECTORY, 'databases', 'combinedHumanCovid.mmi'),
+#                    'minimap2_positive_contig': 'hCoV-19/Wuhan/WIV04/2019|EPI_ISL_402124',
+#                    'minimap2_quality_threshold': 20},
+#     ...
+# }
+# If None, a single reference named DEFAULT_REFERENCE is built from the settings in this file. References without a
+# 'prefilter' entry (the keyword arguments of swgts_filter.filter.Prefilter, None disables it) use the PREFILTER_*
+# settings.
+FILTER_REFERENCES: Optional[dict[str, dict[str, Any]]] = None
+# The reference used by contexts that don't choose one
+DEFAULT_REFERENCE: str = 'default'
+# Estimated index memory (bytes) that may be loaded at once, least recently used references are unloaded first. Only the
+# main process loads indices and the workers share them, so the budget holds for the whole server.
+FILTER_MEMORY_BUDGET: int = 32 * 2 ** 30
+# How often (seconds) the main process checks whether the index files of a reference changed and have to be reloaded.
+# References that are not preloaded are loaded when a job needs them. In both cases the jobs that need them wait in
+# the queue meanwhile and the workers are replaced by ones forked after the load.
+# Replace index files atomically (write to a temporary file and rename it) to avoid loading half written indices.
+FILTER_RELOAD_INTERVAL: int = 30
+# A reference that fails to load is tried again after FILTER_LOAD_RETRY_DELAY seconds, doubling with every failure.
+# After FILTER_LOAD_ATTEMPTS failures it is given up until the server restarts and the contexts that use it fail.
+FILTER_LOAD_ATTEMPTS: int = 3
+FILTER_LOAD_RETRY_DELAY: float = 30
+
+# Number of keep/discard decisions each worker caches for duplicate reads (keyed by a hash of the sequences), 0 disables
+# the cache. It is not used in filter mode NONE.
+DECISION_CACHE_SIZE: int = 100000
+# Also share decisions between all workers and filter servers through redis, where they expire after
+# DECISION_CACHE_TTL seconds
+DECISION_CACHE_SHARED: bool = False
+DECISION_CACHE_TTL: int = 3600
 
 # docker name or hostname of the redis service
 REDIS_SERVER: str = 'redis'
+REDIS_PORT: int = 6379
+
+# The api the filter asks to request more data from socket.io clients once a job is done
+API_BASE_URL: str = 'https://traefik/api/'  # production
+
+# Opt-in profiling of the workers, see swgts_filter.server.profiling. Each worker writes <PROFILING_DIRECTORY>/
+# worker-<id>.folded (flamegraph compatible stack samples) and worker-<id>.stages.json (wall and CPU time per stage of
+# the job loop) when it receives SIGUSR1 (sent to the main process, it is forwarded to all workers), every
+# PROFILING_DUMP_INTERVAL seconds if that is > 0 and on shutdown.
+PROFILING_ENABLED: bool = False
+PROFILING_DIRECTORY: str = 'profiles'
+# CPU seconds between two stack samples, 0 only records the stage times
+PROFILING_SAMPLE_INTERVAL: float = 0.01
+PROFILING_DUMP_INTERVAL: float = 0
 
 # Number of concurrent worker threads used for filtering
 WORKER_THREADS: int = 8
+
+# Seconds an idle worker blocks waiting for a job before checking whether it should stop
+WORKER_POLL_TIMEOUT: int = 1
+# On SIGTERM/SIGINT the workers finish their current job within SHUTDOWN_DRAIN_TIMEOUT seconds, afterwards they put
+# the reads they didn't filter yet back into the queue. They check the timeout every DRAIN_BATCH_SIZE reads and are
+# killed if they still run SHUTDOWN_GRACE_PERIOD seconds later. Keep the sum below the stop_grace_period of the filter
+# service in docker-compose.yml.
+SHUTDOWN_DRAIN_TIMEOUT: float = 6
+SHUTDOWN_GRACE_PERIOD: float = 3
+DRAIN_BATCH_SIZE: int = 64
+# The server announces that it takes jobs in redis (filter:ready) every SUPERVISOR_INTERVAL seconds, the announcement
+# expires after READINESS_TTL seconds. The api only creates contexts while at least one server is ready.
+READINESS_TTL: float = 10
+
+# Grow and shrink the number of workers with the load instead of always running WORKER_THREADS workers
+WORKER_AUTOSCALING: bool = False
+MINIMUM_WORKERS: int = 2
+# None uses WORKER_THREADS
+MAXIMUM_WORKERS: Optional[int] = None
+# Seconds between two scaling decisions
+SUPERVISOR_INTERVAL: float = 1
+# Queued jobs per worker, e.g. 2 runs one worker per two waiting jobs on top of one per job that is being filtered
+SCALE_UP_JOBS_PER_WORKER: float = 2
+# Start another worker if the oldest queued job waited longer than this many seconds
+SCALE_UP_JOB_AGE: float = 2
+# Stop surplus workers only after the queue stayed empty and not all workers were busy for this many seconds
+SCALE_DOWN_IDLE_TIME: float = 30
+# Private memory (bytes) of one worker, the indices are shared between all workers. No workers beyond
+# MINIMUM_WORKERS are started if the available memory would fall below WORKER_MEMORY_RESERVE.
+WORKER_MEMORY_ESTIMATE: int = 512 * 2 ** 20
+WORKER_MEMORY_RESERVE: int = 2 * 2 ** 30
+
+# Pre-filter stage that rejects junk reads before they are handed to minimap2. A threshold of 0 disables the check.
+# These are the defaults of all references, each filter counts its rejections per reason in
+# stats:prefilter:<reference>:<preset>.
+PREFILTER_ENABLED: bool = False
+# Reads (or pairs with a mate) shorter than this are discarded
+PREFILTER_MINIMUM_LENGTH: int = 50
+# Minimum mean phred quality, computed from the mean error probability like the basecaller does
+PREFILTER_MINIMUM_MEAN_QUALITY: float = 7.0
+# Minimum Shannon entropy of the dinucleotide composition in bits (random sequence ~4, dinucleotide repeats ~1)
+PREFILTER_MINIMUM_DINUCLEOTIDE_ENTROPY: float = 1.5
+# Reads are discarded if more than PREFILTER_MAXIMUM_HOMOPOLYMER_FRACTION of their bases are in homopolymer runs
+# of at least PREFILTER_HOMOPOLYMER_LENGTH bases
+PREFILTER_HOMOPOLYMER_LENGTH: int = 8
+PREFILTER_MAXIMUM_HOMOPOLYMER_FRACTION: float = 0.5
+# Reads that contain one of these adapters (or its reverse complement) and have fewer than
+# PREFILTER_ADAPTER_REMAINDER bases left after removing them are discarded
+PREFILTER_ADAPTERS: list[str] = ['AATGTACTTCGTTCAGTTACGTATTGCT',  # ONT ligation adapter
+                                 'AGATCGGAAGAGC']  # Illumina universal adapter
+PREFILTER_ADAPTER_REMAINDER: int = 20
+
+# Optional first pass that decides obvious reads with a k-mer sketch of the pathogen genome instead of minimap2.
+# Set to the (gzipped) FASTA of the pathogen, e.g. the one the combined index was built from, to enable it.
+SKETCH_REFERENCE: Optional[str] = None
+# k-mer size and distance between the k-mers that are looked up in a read
+SKETCH_KMER_SIZE: int = 15
+SKETCH_STRIDE: int = 4
+# A read is kept without mapping if at least this fraction of its sampled k-mers belongs to the pathogen
+SKETCH_POSITIVE_FRACTION: float = 0.1
+SKETCH_MINIMUM_KMERS: int = 10
+# In COMBINED mode a read is discarded without mapping if none of at least this many sampled k-mers is a hit
+SKETCH_NEGATIVE_MINIMUM_KMERS: int = 50
@@ -0,0 +1,49 @@
+# coding=utf-8
+from itertools import accumulate
+from typing import Optional
+
+ALL = ['Job', 'encode_job_reads']
+
+
+def encode_job_reads(records: list[list[bytes]]) -> bytes:
+    """The read part of a job: all records (4 FASTQ lines each, the mates of a read consecutively) joined by line
+    breaks. Inverse of Job."""
+    return b'\n'.join(record for pair in records for record in pair)
+
+
+class Job:
+    """The reads of one job, parsed from the single buffer the api stores them in without decoding them.
+    reads[i][m] holds the four lines of mate m of read i as bytes, which is what the filter works on (mappy takes
+    bytes as is). records[i][m] is a memoryview of the whole record in the buffer (lines separated by line breaks),
+    which is how kept reads are stored and requeued, without joining or encoding them again."""
+
+    def __init__(self, buffer: bytes, read_count: int, pair_count: int):
+        self.buffer = buffer
+        self.pair_count = pair_count
+        # One copy of the data, but no decoding; splitting in C is much faster than finding the line breaks in Python
+        lines = buffer.split(b'\n')
+        if len(lines) != read_count * pair_count * 4:
+            raise ValueError(f'Expected {read_count * pair_count * 4} lines but the job has {len(lines)}')
+        # Start offset of every line, each line is followed by one line break
+        starts = list(accumulate((len(line) + 1 for line in lines), initial=0))
+        view = memoryview(buffer)
+
+        self.reads: list[list[tuple[bytes, ...]]] = []
+        self.records: list[list[memoryview]] = []
+        for read_start in range(0, len(lines), pair_count * 4):
+            mates = range(read_start, read_start + pair_count * 4, 4)
+            self.reads.append([tuple(lines[start:start + 4]) for start in mates])
+            self.records.append([view[starts[start]:starts[start + 4] - 1] for start in mates])
+
+    @classmethod
+    def from_lines(cls, lines: list[bytes], read_count: int, pair_count: int) -> 'Job':
+        """A job in the old format, one list element per line."""
+        return cls(b'\n'.join(lines), read_count, pair_count)
+
+    def __len__(self) -> int:
+        return len(self.reads)
+
+    def sequence_bytes(self, indices: Optional[range] = None) -> int:
+        """Number of bases of the given reads (all by default), the unit of the pending byte accounting."""
+        reads = self.reads if indices is None else [self.reads[i] for i in indices]
+        return sum(len(mate[1]) for read in reads for mate in read)
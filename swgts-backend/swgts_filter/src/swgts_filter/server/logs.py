@@ -0,0 +1,124 @@
+# coding=utf-8
+"""Logging setup of the filter server.
+
+Messages that are logged per job pass extra={'event': ..., 'worker': ..., 'context': ..., 'job': ...}. The event name
+lets SamplingFilter rate limit them, the ids become separate fields of the JSON log lines. With a queued setup the
+workers only put the records into a queue, a background thread of each process formats them and writes them to the
+file and the console.
+
+The api is built into a separate image and shares no package with the filter server, so this module has a twin in
+swgts_api/logs.py. Keep the formatters, SamplingFilter and setup_logging of both in sync, only restarting the queue
+listener in forked workers (restart_in_worker) is specific to this one.
+"""
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.util import Finalize, register_after_fork
+from queue import SimpleQueue
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
+ALL = ['JsonFormatter', 'SamplingFilter', 'setup_logging']
+
+LOG_FORMAT = '%(asctime)s:%(levelname)s:%(name)s:%(message)s'
+
+# Attributes passed with extra= that are written as their own fields of a JSON log line
+STRUCTURED_FIELDS = ('event', 'context', 'job', 'worker', 'suppressed')
+
+
+class TextFormatter(logging.Formatter):
+    """The plain format, which tells how many messages of the event were suppressed before this one."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f'{line} (+{suppressed} suppressed)' if suppressed else line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the structured fields of the record as separate keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value if isinstance(value, (int, float)) else str(value)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets at most rate records per second of each event pass, with bursts of up to burst records (a token bucket per
+    event). Records without an event and warnings or worse always pass. The number of records suppressed since the
+    last one that passed is attached to it as suppressed."""
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # event -> (tokens, time of the last update, suppressed records)
+        self._buckets: dict[str, tuple[float, float, int]] = {}
+        self._lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, 'event', None)
+        if event is None or self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        if hasattr(record, 'sampled'):
+            # Already decided by the filter of another handler
+            return record.sampled
+        now = monotonic()
+        with self._lock:
+            tokens, last, suppressed = self._buckets.get(event, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            record.sampled = tokens >= 1
+            if not record.sampled:
+                self._buckets[event] = (tokens, now, suppressed + 1)
+                return False
+            self._buckets[event] = (tokens - 1, now, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+def setup_logging(log_file: str, level: str, queued: bool, json_format: bool, event_rate: float,
+                  event_burst: int) -> Optional[QueueListener]:
+    """Log to log_file and the console. If queued, returns the listener of the main process that writes the records,
+    it is stopped (and the queue flushed) at exit."""
+    formatter = JsonFormatter() if json_format else TextFormatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    sampling = SamplingFilter(event_rate, event_burst)
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    if not queued:
+        for handler in handlers:
+            handler.addFilter(sampling)
+            root.addHandler(handler)
+        return None
+
+    queue_handler = QueueHandler(SimpleQueue())
+    # Suppressed records are dropped before they are queued
+    queue_handler.addFilter(sampling)
+    root.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart_in_worker(handler: QueueHandler) -> None:
+        # The thread of the listener doesn't exist in forked workers, each of them gets its own queue and listener.
+        # Worker processes leave without running atexit, their listener is stopped by a multiprocessing finaliser.
+        handler.queue = SimpleQueue()
+        worker_listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+        worker_listener.start()
+        Finalize(None, worker_listener.stop, exitpriority=0)
+
+    register_after_fork(queue_handler, restart_in_worker)
+    return listener
@@ -0,0 +1,131 @@
+# coding=utf-8
+"""Opt-in profiling of the filter workers.
+
+Every worker process accumulates wall and CPU time per stage of its job loop and, if a sample interval is set, samples
+its Python stack on SIGPROF (i.e. per consumed CPU time, idle waiting for jobs costs nothing). The samples are written
+in the folded format understood by flamegraph.pl, speedscope and similar tools, one line per distinct stack:
+
+    __main__.py:spawn_worker;__init__.py:classify;__init__.py:is_read_legal_combined 1234
+
+Time spent inside mappy's C code is attributed to the Python frame that called it.
+"""
+import json
+import os
+import signal
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from logging import getLogger
+from time import perf_counter, process_time, time
+from types import FrameType
+from typing import ContextManager, Optional
+
+ALL = ['Profiler']
+
+logger = getLogger(__name__)
+
+
+def _folded_stack(frame: Optional[FrameType]) -> str:
+    names = []
+    while frame is not None:
+        names.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """Stage timer and stack sampler of one worker process. If not enabled, stage() returns a shared no-op context
+    manager, so the instrumentation can stay in the job loop."""
+
+    def __init__(self, enabled: bool, name: str, directory: str, sample_interval: float, dump_interval: float):
+        self.enabled = enabled
+        self.name = name
+        self.directory = directory
+        self.sample_interval = sample_interval
+        self.dump_interval = dump_interval
+        # Per stage: [calls, wall seconds, cpu seconds]
+        self.stages: dict[str, list[float]] = {}
+        self.samples: Counter = Counter()
+        self.started = time()
+        self._last_dump = self.started
+        self._dump_requested = False
+        self._open_stages = 0
+
+    def start(self) -> None:
+        """Install the signal handlers, has to be called in the worker process."""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        signal.signal(signal.SIGUSR1, self._request_dump)
+        if self.sample_interval > 0:
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.sample_interval, self.sample_interval)
+        logger.info(f'Profiling {self.name}, send SIGUSR1 to pid {os.getpid()} to write the profile to '
+                    f'{self.directory}')
+
+    def stop(self) -> None:
+        if not self.enabled:
+            return
+        if self.sample_interval > 0:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        self.dump()
+
+    def _sample(self, _signal_number: int, frame: Optional[FrameType]) -> None:
+        self.samples[_folded_stack(frame)] += 1
+
+    def _request_dump(self, _signal_number: int, _frame: Optional[FrameType]) -> None:
+        if self._open_stages == 0:
+            # E.g. waiting for a job
+            self.dump()
+        else:
+            # Written when the stage ends, not in the middle of updating the counters
+            self._dump_requested = True
+
+    def stage(self, name: str) -> ContextManager:
+        if not self.enabled:
+            return nullcontext()
+        return self._timed_stage(name)
+
+    @contextmanager
+    def _timed_stage(self, name: str):
+        wall, cpu = perf_counter(), process_time()
+        self._open_stages += 1
+        try:
+            yield
+        finally:
+            self._open_stages -= 1
+            totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += perf_counter() - wall
+            totals[2] += process_time() - cpu
+            self.maybe_dump()
+
+    def maybe_dump(self) -> None:
+        """Write the profile if it was requested by SIGUSR1 or the dump interval passed."""
+        if not self.enabled:
+            return
+        if self._dump_requested or (self.dump_interval > 0 and time() - self._last_dump >= self.dump_interval):
+            self._dump_requested = False
+            self.dump()
+
+    def dump(self) -> None:
+        """Write <name>.folded (stack samples) and <name>.stages.json (stage times) to the profiling directory. Both
+        contain everything since the worker started, so the latest files are always complete."""
+        self._last_dump = time()
+        base = os.path.join(self.directory, self.name)
+        # dict.copy runs without calling back into Python, so SIGPROF can't change the samples while they are copied
+        samples = dict.copy(self.samples)
+        try:
+            with open(f'{base}.folded.tmp', 'w') as handle:
+                for stack, count in sorted(samples.items(), key=lambda item: -item[1]):
+                    handle.write(f'{stack} {count}\n')
+            os.replace(f'{base}.folded.tmp', f'{base}.folded')
+            with open(f'{base}.stages.json.tmp', 'w') as handle:
+                json.dump({'pid': os.getpid(), 'seconds': self._last_dump - self.started,
+                           'samples': sum(samples.values()),
+                           'stages': {name: {'calls': int(calls), 'wall_seconds': wall, 'cpu_seconds': cpu}
+                                      for name, (calls, wall, cpu) in self.stages.items()}}, handle, indent=2)
+            os.replace(f'{base}.stages.json.tmp', f'{base}.stages.json')
+        except OSError as e:
+            logger.error(f'Could not write the profile of {self.name}: {e}')
+            return
+        logger.info(f'Wrote the profile of {self.name} to {base}.folded')
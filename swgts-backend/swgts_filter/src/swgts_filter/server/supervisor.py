@@ -0,0 +1,172 @@
+# coding=utf-8
+from logging import getLogger
+from multiprocessing import Event, Process, Value
+from multiprocessing.sharedctypes import Synchronized
+from time import time
+from typing import Callable, Optional
+
+import psutil
+from redis import Redis
+
+ALL = ['WorkerSupervisor']
+
+logger = getLogger(__name__)
+
+
+class _Worker:
+    def __init__(self, worker_id: int, process: Process, stop: Event, busy: Synchronized):
+        self.worker_id = worker_id
+        self.process = process
+        self.stop = stop
+        # Set by the worker while it works on a job it popped from the queue
+        self.busy = busy
+
+
+class WorkerSupervisor:
+    """Keeps between minimum_workers and maximum_workers worker processes running, depending on the length of
+    work:queue, the age of its oldest job and the number of workers busy with a job they already popped. Every worker
+    gets its own stop event, which it checks between jobs, and its own busy flag, which it sets while it works on a
+    job. So a worker that is scaled down always finishes the job it is working on. Workers are forked from the process
+    holding the preloaded indices and share them, only their private memory (estimated by worker_memory) has to fit
+    into the available memory above memory_reserve."""
+
+    def __init__(self, target: Callable[[int, Event, Synchronized], None], redis_server: Redis, minimum_workers: int,
+                 maximum_workers: int, jobs_per_worker: float, maximum_job_age: float, idle_time: float,
+                 worker_memory: int, memory_reserve: int):
+        if not 1 <= minimum_workers <= maximum_workers:
+            raise ValueError(f'Invalid worker range {minimum_workers} - {maximum_workers}')
+        self.target = target
+        self.redis_server = redis_server
+        self.minimum_workers = minimum_workers
+        self.maximum_workers = maximum_workers
+        self.jobs_per_worker = jobs_per_worker
+        self.maximum_job_age = maximum_job_age
+        self.idle_time = idle_time
+        self.worker_memory = worker_memory
+        self.memory_reserve = memory_reserve
+        self._workers: list[_Worker] = []
+        # Workers that were asked to stop and are finishing their last job
+        self._draining: list[_Worker] = []
+        self._next_worker_id = 0
+        self._last_busy = time()
+
+    def pids(self) -> list[int]:
+        return [w.process.pid for w in self._workers + self._draining if w.process.pid is not None]
+
+    def worker_count(self) -> int:
+        return len(self._workers)
+
+    def _spawn(self) -> None:
+        stop = Event()
+        busy = Value('b', False, lock=False)
+        worker_id = self._next_worker_id
+        self._next_worker_id += 1
+        process = Process(target=self.target, args=(worker_id, stop, busy), name=f'worker-{worker_id}')
+        process.start()
+        self._workers.append(_Worker(worker_id, process, stop, busy))
+
+    def _retire(self) -> None:
+        # The most recently started worker has the smallest decision cache to lose
+        worker = self._workers.pop()
+        worker.stop.set()
+        self._draining.append(worker)
+        logger.info(f'Scaling down, worker {worker.worker_id} will stop after its current job.')
+
+    def _reap(self) -> None:
+        for worker in [w for w in self._workers if not w.process.is_alive()]:
+            logger.error(f'Worker {worker.worker_id} died with exit code {worker.process.exitcode}, replacing it.')
+            worker.process.join()
+            self._workers.remove(worker)
+        for worker in [w for w in self._draining if not w.process.is_alive()]:
+            worker.process.join()
+            self._draining.remove(worker)
+            logger.info(f'Worker {worker.worker_id} stopped.')
+
+    def _can_afford_worker(self) -> bool:
+        return psutil.virtual_memory().available - self.worker_memory >= self.memory_reserve
+
+    def queue_state(self) -> tuple[int, float]:
+        """Return the number of queued jobs and the seconds the oldest one has been waiting."""
+        pipeline = self.redis_server.pipeline(transaction=False)
+        pipeline.llen('work:queue')
+        # Jobs are pushed to the left and popped from the right
+        pipeline.lindex('work:queue', -1)
+        queue_length, oldest_job = pipeline.execute()
+        if oldest_job is None:
+            return queue_length, 0.0
+        # The reception time is the fifth element pushed to a job, see enqueue_chunks of the api
+        enqueued = self.redis_server.lindex(f'work:{oldest_job.decode()}', -5)
+        return queue_length, max(0.0, time() - float(enqueued)) if enqueued is not None else 0.0
+
+    def busy_count(self) -> int:
+        """The number of (not draining) workers working on a job they popped, those jobs are no longer queued."""
+        return sum(bool(worker.busy.value) for worker in self._workers)
+
+    def desired_worker_count(self, queue_length: int, job_age: float, busy: int = 0) -> int:
+        current = len(self._workers)
+        if queue_length > 0 or job_age > 0 or busy >= current:
+            # A server whose workers are all busy usually has an empty queue, it just keeps up
+            self._last_busy = time()
+        # Every job in flight occupies its worker
+        wanted = busy + -(-queue_length // self.jobs_per_worker) if self.jobs_per_worker > 0 else current
+        if job_age > self.maximum_job_age:
+            # Jobs wait too long even if there are only a few of them (e.g. long reads)
+            wanted = max(wanted, current + 1)
+        if wanted < current and time() - self._last_busy < self.idle_time:
+            # Only shrink once the queue stayed empty and some workers idle for a while, the next batch usually
+            # follows soon
+            wanted = current
+        return int(max(self.minimum_workers, min(self.maximum_workers, wanted)))
+
+    def scale(self, target: Optional[int] = None) -> None:
+        """Replace dead workers and grow or shrink towards the target (computed from the queue and the busy workers if
+        None). With a fixed number of workers the queue is not inspected at all."""
+        self._reap()
+        if target is None and self.minimum_workers == self.maximum_workers:
+            target = self.minimum_workers
+        elif target is None:
+            target = self.desired_worker_count(*self.queue_state(), self.busy_count())
+        if target > len(self._workers):
+            started = 0
+            while len(self._workers) < target:
+                # Always keep the minimum, even if memory is short
+                if len(self._workers) >= self.minimum_workers and not self._can_afford_worker():
+                    logger.warning(f'Not enough memory to scale up beyond {len(self._workers)} workers.')
+                    break
+                self._spawn()
+                started += 1
+            if started > 0:
+                logger.info(f'Scaled up to {len(self._workers)} workers.')
+        while len(self._workers) > target:
+            self._retire()
+
+    def restart(self) -> None:
+        """Replace all workers by fresh ones forked from the current state of the main process, e.g. after it loaded
+        or rebuilt an index. The old workers finish their current job first."""
+        self._reap()
+        count = len(self._workers)
+        for worker in self._workers:
+            worker.stop.set()
+        self._draining.extend(self._workers)
+        self._workers = []
+        logger.info(f'Restarting {count} workers, the old ones stop after their current job.')
+        self.scale(max(count, self.minimum_workers))
+
+    def start(self) -> None:
+        self.scale(self.minimum_workers)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Ask all workers to stop after their current job and wait for them, killing those that are still running
+        after timeout seconds."""
+        deadline = time() + timeout if timeout is not None else None
+        for worker in self._workers:
+            worker.stop.set()
+        self._draining.extend(self._workers)
+        self._workers = []
+        for worker in self._draining:
+            worker.process.join(None if deadline is None else max(0.0, deadline - time()))
+            if worker.process.is_alive():
+                logger.error(f'Worker {worker.worker_id} did not stop in time, killing it. Its current job is lost.')
+                worker.process.kill()
+                worker.process.join()
+        self._draining = []
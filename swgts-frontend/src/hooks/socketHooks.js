@@ -50,6 +50,8 @@ export const useHandleSocketUpload = (files, downloadFiles) => {
   // Otherwise state updates won't show up
   const linesRef = useRef(lines);
   const linesOffsetRef = useRef(linesOffset);
+  // Line range of every chunk sent, keyed by its chunk id (the first line), to resend chunks the server discarded
+  const sentChunksRef = useRef(new Map());
 
   const startUpload = () => {
     if (files.length === 0) return;
@@ -69,14 +71,30 @@ export const useHandleSocketUpload = (files, downloadFiles) => {
       });
   };
 
+  const getChunk = (start, end) => {
+    const data = [];
+    let bytesSend = 0;
+    for (let i = start; i < end; i += 4) {
+      const read = linesRef.current.map((fileLines) =>
+        fileLines.slice(i, i + 4),
+      );
+      data.push(read);
+      bytesSend += read
+        .map((readPart) => readPart[1].length)
+        .reduce((sum, num) => sum + num);
+    }
+    return { data, bytesSend };
+  };
+
   const getUploadData = async (bytes) => {
     const data = [];
     let bytesSend = 0;
     let i = linesOffsetRef.current;
+    const chunkId = i;
     const linesTotal = linesRef.current[0].length;
 
     // When all reads have been sent, return empty data to trigger context close
-    if (i >= linesTotal) return { data, bytesSend: 0 };
+    if (i >= linesTotal) return { data, bytesSend: 0, chunkId };
 
     while (i < linesTotal) {
       const read = linesRef.current.map((fileLines) =>
@@ -94,8 +112,9 @@ export const useHandleSocketUpload = (files, downloadFiles) => {
 
     setLinesOffset(i);
     linesOffsetRef.current = i;
+    sentChunksRef.current.set(chunkId, i);
 
-    return { data, bytesSend };
+    return { data, bytesSend, chunkId };
   };
 
   const startDownload = (files, savedReads, fqsAsText) => {
@@ -115,12 +134,13 @@ export const useHandleSocketUpload = (files, downloadFiles) => {
     }
   };
 
-  const uploadData = (data, bytes, contextId) => {
+  const uploadData = (data, bytes, contextId, chunkId) => {
     console.debug(`(${contextId}): Uploading ${bytes} bytes to server.`);
     socket.emit("dataUpload", {
       data: data,
       bytes: bytes,
       contextId: contextId,
+      chunkId: chunkId,
     });
   };
 
@@ -133,6 +153,7 @@ export const useHandleSocketUpload = (files, downloadFiles) => {
     setLinesOffset(0);
     linesRef.current = null;
     linesOffsetRef.current = 0;
+    sentChunksRef.current.clear();
   };
 
   useEffect(() => {
@@ -164,14 +185,14 @@ export const useHandleSocketUpload = (files, downloadFiles) => {
       setReadsProgressed(processedReads);
 
       if (linesRef.current) {
-        const { data, bytesSend } = await getUploadData(bytes);
+        const { data, bytesSend, chunkId } = await getUploadData(bytes);
 
         if (data.length === 0) {
           console.debug(
             `(${contextId}): All reads sent. Request closing context.`,
           );
           closeContext(contextId);
-        } else uploadData(data, bytesSend, contextId);
+        } else uploadData(data, bytesSend, contextId, chunkId);
       }
     };
 
@@ -204,21 +225,47 @@ export const useHandleSocketUpload = (files, downloadFiles) => {
       console.error(`Failed to create context: ${message}`);
     };
 
+    // The server writes the context once the last reads are filtered and sends contextClosed then
+    const onContextSealed = (payload) => {
+      const { contextId } = payload;
+      console.debug(`(${contextId}): Context sealed, waiting for the result.`);
+    };
+
     const onContextCloseError = (payload) => {
       setUploadStatus("ERROR");
       const { message } = payload;
       console.error(`Failed to close context: ${message}`);
     };
 
+    // The server discarded a whole chunk, see reject_upload of the api for the codes
     const onDataUploadError = (payload) => {
+      const { code, message, contextId, chunkId, retryAfter } = payload;
+      const chunkEnd = sentChunksRef.current.get(chunkId);
+      if (code === "buffer_full" && chunkEnd !== undefined && linesRef.current) {
+        // Other chunks were faster, send this one again once the buffer drained
+        console.debug(
+          `(${contextId}): Buffer full, resending chunk ${chunkId} in ${retryAfter} s.`,
+        );
+        setTimeout(
+          () => {
+            const { data, bytesSend } = getChunk(chunkId, chunkEnd);
+            uploadData(data, bytesSend, contextId, chunkId);
+          },
+          Math.max(retryAfter ?? 0, 0.5) * 1000,
+        );
+        return;
+      }
+      // Malformed data, unknown context or data that was not requested: resending does not help
       setUploadStatus("ERROR");
-      const { message } = payload;
-      console.error(`Failed to upload data: ${message}`);
+      console.error(`Failed to upload data (${code}): ${message}`);
+      displayDialog(`Upload failed: ${message}`);
+      socket.disconnect();
     };
 
     socket.on("connect", onConnect);
     socket.on("disconnect", onDisconnect);
     socket.on("dataRequest", onDataRequest);
+    socket.on("contextSealed", onContextSealed);
     socket.on("contextClosed", onContextClosed);
     socket.on("contextCloseError", onContextCloseError);
     socket.on("contextCreationError", onContextCreationError);
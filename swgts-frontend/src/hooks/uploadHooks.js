@@ -186,36 +186,33 @@ const createContext = async (files) => {
   return data.context;
 };
 
-// Closes the context and returns saved reads
+// Closes the context and returns saved reads. The server seals the context and writes it in the background, so the
+// close status is polled until the result is there
 const closeContext = async (contextId, setBufferFill, setReadsProgressed) => {
   try {
-    const { data } = await axios.post(
+    let { status, data } = await axios.post(
       `${FLASK_API_URL}context/${contextId}/close`,
       {
         context: contextId,
       },
     );
-    const { readsProcessed, readsSaved } = data;
-    setReadsProgressed(readsProcessed);
-    return readsSaved;
-  } catch (error) {
-    // When data processing isn't finished yet, call closeContext recursively after timeout
-    if (error.response?.status === 503) {
-      const {
-        pendingBytes,
-        processedReads,
-        retryAfter = 1,
-      } = error.response.data;
+    while (status === 202) {
+      const { pendingBytes, processedReads, retryAfter = 1 } = data;
       console.debug(
-        `Context ${contextId} can't be closed - server still working. Retry after ${retryAfter} seconds`,
+        `Context ${contextId} is closing - server still working. Checking again in ${retryAfter} seconds`,
       );
-      if (pendingBytes) setBufferFill(pendingBytes);
-      if (processedReads) setReadsProgressed(processedReads);
+      if (pendingBytes !== undefined) setBufferFill(pendingBytes);
+      if (processedReads !== undefined) setReadsProgressed(processedReads);
       await sleep(retryAfter * 1000);
-      return await closeContext(contextId, setBufferFill, setReadsProgressed);
-    } else {
-      console.error("Unexpected server error:", error.toString());
+      ({ status, data } = await axios.get(
+        `${FLASK_API_URL}context/${contextId}/close`,
+      ));
     }
+    const { readsProcessed, readsSaved } = data;
+    setReadsProgressed(readsProcessed);
+    return readsSaved;
+  } catch (error) {
+    console.error("Unexpected server error:", error.toString());
   }
 };
 
@@ -1,8 +1,10 @@
 import gzip
 import mimetypes
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
 from json import JSONDecodeError
-from time import sleep
+from time import sleep, time
 from typing import Optional, Union, AnyStr, List, Tuple, Dict, TextIO, Generator, Set
 from uuid import UUID
 
@@ -10,6 +12,9 @@ import os
 import httpx
 from tqdm import tqdm
 
+from .batch import ByteBudget, Sample, SampleResult, print_summary, read_sample_sheet, write_summary
+from .watch import DirectoryWatcher, follow
+
 long_reads_counter = 0
 
 #TODO: Differentiate between file and stream and show progress bar accordingly for files (count reads prior to parsing and set total accordingly)
@@ -33,8 +38,23 @@ class Read:
     def __str__(self) -> str:
         return f'{self.barcode}\n{self.sequence}\n{self.plus}\n{self.quality}\n'
 
-def create_context(client: httpx.Client, filenames: List[str]) -> Optional[UUID]:
-    result = client.post('/context/create', json={'filenames': filenames})
+def create_context(client: httpx.Client, filenames: List[str], reference: Optional[str] = None,
+                   sequences_only: bool = False, mapping_preset: Optional[str] = None) -> Optional[UUID]:
+    body = {'filenames': filenames}
+    if reference is not None:
+        body['reference'] = reference
+    if mapping_preset is not None:
+        body['mappingPreset'] = mapping_preset
+    if sequences_only:
+        # We only send sequences and read indices and get the indices of the kept reads back
+        body['uploadMode'] = 'sequences'
+    result = client.post('/context/create', json=body)
+    while result.status_code == 503:
+        # No filter server is ready, e.g. during a restart
+        retry_after = result.json().get('retryAfter', 5)
+        print(f'The server is not ready, retrying in {retry_after} seconds.')
+        sleep(retry_after)
+        result = client.post('/context/create', json=body)
     if result.is_error:
         print('Could not create context.')
         return None
@@ -108,7 +128,8 @@ def split_n_bp_worth_of_reads(
         #Special case buffer size exceeded
         if this_reads_length > buffer_size:
             if long_reads_counter == 0: #Warning should only be issued once
-                tqdm.write(f'Your file contains a single read (pair) that is larger ({this_reads_length}) than the server-sided buffer size!')
+                tqdm.write(f'Your file contains a single read (pair) that is larger ({this_reads_length}) than the server-sided buffer size! '
+                           f'It is discarded, unless the server filters single-end long reads from segments.')
             long_reads_counter += 1
 
             progress_bar.total += 1
@@ -151,19 +172,21 @@ def close_context(client: httpx.Client, context: UUID, verbose: bool, progress_b
     :return: The total statistics we get from the server.
     """
 
+    # The server seals the context and writes it once all reads are filtered, we poll the close status until then
+    result = client.post(f'/context/{context}/close', timeout=30)
     while True:
-        result = client.post(f'/context/{context}/close', timeout=30)
         payload = None
         try:
             payload = result.json()
         except:
             pass
 
-        if result.status_code == httpx.codes.SERVICE_UNAVAILABLE: #Reads are still being processed
-            timeout : float = float(payload['Retry-After'])
+        if result.status_code == httpx.codes.ACCEPTED: #Reads are still being processed
+            timeout : float = float(payload['retryAfter'])
             if verbose:
                 progress_bar.write(f'Reads are still being processed, server asks us to check back in {timeout} seconds')
             sleep(timeout)
+            result = client.get(f'/context/{context}/close', timeout=30)
             continue
 
         if result.status_code != httpx.codes.OK:
@@ -174,11 +197,49 @@ def close_context(client: httpx.Client, context: UUID, verbose: bool, progress_b
             progress_bar.write(f'The server did not send any payload in the response. or the payload could not be parsed.')
             return None
 
-        return payload['saved'], payload['total']
+        return payload['readsSaved'], payload['readsProcessed']
+
+
+def send_heartbeat(client: httpx.Client, context: UUID) -> bool:
+    """Keep an idle context from expiring on the server."""
+    result = client.post(f'/context/{context}/heartbeat', timeout=30)
+    return not result.is_error
+
+
+def submit_watched_directory(client: httpx.Client, context: UUID, watcher: DirectoryWatcher, arguments,
+                             buffer_size: int, heartbeat_interval: float, progress_bar: tqdm) -> bool:
+    """
+    Submit the reads of all FASTQ files below the watched directory while the sequencer is still writing them, until
+    the run finished, nothing new arrived for --watch-idle-timeout seconds or the user pressed Ctrl+C.
+    :return False if the upload failed, else True
+    """
+    last_contact = time()
+    batches = follow(watcher, arguments.watch_block_size, arguments.watch_idle_timeout,
+                     not arguments.no_final_summary_stop)
+    try:
+        for records in batches:
+            if records is None:
+                if time() - last_contact >= heartbeat_interval:
+                    if not send_heartbeat(client, context):
+                        progress_bar.write(f'The context {context} is gone on the server.')
+                        return False
+                    last_contact = time()
+                continue
+            reads = ((Read(lines),) for lines in records)
+            if not submit_chunks(client, context, reads, arguments.count, buffer_size, arguments.retries,
+                                 arguments.verbose, progress_bar, report=False):
+                return False
+            last_contact = time()
+    except KeyboardInterrupt:
+        progress_bar.write('Stopped watching, closing the context with the reads submitted so far.')
+    finally:
+        batches.close()
+    return True
 
 
 def submit_chunks(client: httpx.Client, context: UUID, reads: List[Tuple[Read]],
-                  chunk_size: int, buffer_size : int, retries: int, verbose: bool, progress_bar: tqdm) -> bool:
+                  chunk_size: int, buffer_size : int, retries: int, verbose: bool, progress_bar: tqdm,
+                  sequences_only: bool = False, report: bool = True, budget: Optional[ByteBudget] = None) -> bool:
     """
     Work on a chunk of reads.
     Split a chunk of reads into smaller chunks, and send them sequentially. We do this with our own http client class
@@ -189,6 +250,9 @@ def submit_chunks(client: httpx.Client, context: UUID, reads: List[Tuple[Read]],
     :param context: The context we should submit it to.
     :param reads: The reads to submit. 1-tuples for single file submission, 2-tuples for paired-end.
     :param size_hint: The maximum read sequence length.
+    :param sequences_only: Send [read index, sequence, ...] per read (pair) instead of the whole records.
+    :param report: Print the transmission statistics at the end.
+    :param budget: Shared limit of the basepairs in flight, when several contexts are uploaded at once.
     :return False if cancelled, else True
     """
 
@@ -199,6 +263,8 @@ def submit_chunks(client: httpx.Client, context: UUID, reads: List[Tuple[Read]],
 
     transmissions : int = 0
     rejections: int = 0
+    # Index of the first read (pair) of the current chunk in the input files
+    next_index: int = 0
     chunks_to_send: Generator[List[Tuple[Read]], None, None] = split_n_bp_worth_of_reads(reads, chunk_size, buffer_size, progress_bar)
 
     # progress_bar.write(f'Hi! This is a worker. I will take care of {len(reads)} reads. To make the server happy, '
@@ -213,9 +279,18 @@ def submit_chunks(client: httpx.Client, context: UUID, reads: List[Tuple[Read]],
 
             try:
                 #print(f'Sending chunk of length {len(chunk)}')
-                response = client.post(f'/context/{context}/reads',
-                                       json=[[list(read) for read in corresponding_reads]
-                                             for corresponding_reads in chunk])
+                if sequences_only:
+                    body = [[next_index + offset] + [read.sequence for read in corresponding_reads]
+                            for offset, corresponding_reads in enumerate(chunk)]
+                else:
+                    body = [[list(read) for read in corresponding_reads] for corresponding_reads in chunk]
+                reserved = budget.acquire(sum(read.bp_count() for reads in chunk for read in reads)) \
+                    if budget is not None else 0
+                try:
+                    response = client.post(f'/context/{context}/reads', json=body)
+                finally:
+                    if budget is not None:
+                        budget.release(reserved)
                 transmissions += 1
             except Exception as e:
                 progress_bar.write(f'We had a failure, now at {rejections}. {e}')
@@ -244,22 +319,24 @@ def submit_chunks(client: httpx.Client, context: UUID, reads: List[Tuple[Read]],
             #Orderly timeout
             elif response.status_code == httpx.codes.UNPROCESSABLE_ENTITY:
                 rejections += 1
-                if verbose:
-                    progress_bar.write(f"Received timeout: Server wants retry after {float(response.headers['Retry-After'])} s")
-                    update_progress_bar(progress_bar, int(response.json()['processed reads']))
-                if 'Retry-After' not in response.headers:
-                    progress_bar.write(f"We received an orderly timeout without Retry-After headers, this should not happen!")
+                if 'retryAfter' not in response_json:
+                    progress_bar.write(f"We received an orderly timeout without retryAfter, this should not happen!")
                     return False
-                sleep(float(response.headers['Retry-After']))
+                if verbose:
+                    progress_bar.write(f"Received timeout: Server wants retry after {float(response_json['retryAfter'])} s")
+                    update_progress_bar(progress_bar, int(response_json['processedReads']))
+                sleep(float(response_json['retryAfter']))
                 continue
             elif response.is_error:
                 progress_bar.write(f"We received an error ({response.status_code}), let's treat it as a simple failure.")
                 return False
             else:
-                update_progress_bar(progress_bar, int(response.json()['processed reads']))
+                update_progress_bar(progress_bar, int(response_json['processedReads']))
                 chunk_transmitted = True
+                next_index += len(chunk)
 
-    progress_bar.write(f'Transmission had a total of {transmissions} transmissions of which {rejections} were retries due to exceeding the server buffer')
+    if report:
+        progress_bar.write(f'Transmission had a total of {transmissions} transmissions of which {rejections} were retries due to exceeding the server buffer')
 
     return True
 
@@ -272,9 +349,40 @@ def get_argument_parser() -> ArgumentParser:
     parser.add_argument('--count', type=int, help='Override the maximum amount the server gets from us at a time.')
     parser.add_argument('--retries', type=int, default=-1,
                         help='How many times to retry a submission that soft-failed. If -1 no limit is set.')
-    parser.add_argument('files', type=str, help='The fastq files to submit.', nargs='+')
+    parser.add_argument('files', type=str, help='The fastq files to submit.', nargs='*')
     parser.add_argument('--outfolder', type=str, help='The folder to save the filtered reads in')
     parser.add_argument('--verbose', action='store_true', help='Output detailed information about the transaction')
+    parser.add_argument('--reference', type=str,
+                        help='The reference to filter against, the server uses its default one if omitted.')
+    parser.add_argument('--mapping-preset', type=str,
+                        help='The minimap2 preset to filter with (see mappingPresets of the server status), e.g. sr for '
+                             'short reads. auto lets the server choose from the read lengths, the preset of the '
+                             'reference is used if omitted.')
+    parser.add_argument('--sequences-only', action='store_true',
+                        help='Upload only the sequences, roughly halving the upload. The server saves nothing, use '
+                             '--outfolder to reconstruct the filtered files locally.')
+    parser.add_argument('--watch', type=str, metavar='DIRECTORY',
+                        help='Follow a growing sequencer output directory (e.g. a MinKNOW run folder) and submit the '
+                             'reads of all fastq files below it as they are written, instead of uploading files.')
+    parser.add_argument('--watch-idle-timeout', type=float, default=0,
+                        help='Stop watching after this many seconds without new reads. 0 waits until the run finished '
+                             'or Ctrl+C is pressed.')
+    parser.add_argument('--watch-block-size', type=int, default=8 * 1024 * 1024,
+                        help='Read at most this many bytes of a file at a time while watching.')
+    parser.add_argument('--no-final-summary-stop', action='store_true',
+                        help='Keep watching after MinKNOW wrote the final summary of the run.')
+    parser.add_argument('--sample-sheet', type=str,
+                        help='Submit a batch of samples instead of files. Every row holds a sample name and its fastq '
+                             'file, or both files of a pair, separated by tabs or commas. Every sample gets its own '
+                             'context, --outfolder gets a subfolder per sample.')
+    parser.add_argument('--parallel', type=int, default=4, help='How many samples of a batch to upload at once.')
+    parser.add_argument('--inflight-bytes', type=int,
+                        help='How many basepairs all uploads of a batch may have in flight together. Defaults to the '
+                             'buffer size of the server.')
+    parser.add_argument('--summary', type=str,
+                        help='Write the per-sample throughput and read counts of a batch to this tab-separated file.')
+    parser.add_argument('--poll', action='store_true',
+                        help='Look for new reads by polling instead of inotify, e.g. on network file systems.')
     return parser
 
 
@@ -285,12 +393,217 @@ def get_maximum_pending_bytes(client: httpx.Client) -> int:
         print('Could not query server status. Is the server running?')
         raise e
 
-    return server_info['maximum pending bytes']
+    return server_info['bufferSize']
+
+
+def reconstruct_files(filenames: List[str], readids_to_keep: Union[Set[str], Set[int]], sequences_only: bool,
+                      outfolder: str) -> None:
+    """
+    Write the reads of the uploaded files the server kept to outfolder.
+    :param readids_to_keep: Read indices in sequences-only mode, else the header lines.
+    """
+    print(f'Reconstructing the filtered read files in {outfolder}')
+    os.makedirs(outfolder, exist_ok=True)
+
+    filehandles = {}
+    for fileidx, filename in enumerate(filenames):
+        print(f'Reconstructing the filtered read files for file: {filename}')
+        guessed_mimetype: Tuple[str, str] = mimetypes.guess_type(filename)
+        # Generate output folder and create modified (infixed) filename for output
+        split_components = os.path.basename(filename).split('.')
+        new_filename = '.'.join([split_components[0]] + ['filtered']+split_components[1:])
+        outfile = os.path.join(outfolder, new_filename)
+        filehandles[fileidx] = gzip.open(outfile, 'wt') if guessed_mimetype[1] == 'gzip' else open(outfile, 'w')
+
+    read_index = 0
+    in_file_stream = []
+    for in_file in filenames:
+        guessed_mimetype: Tuple[str, str] = mimetypes.guess_type(in_file)
+        in_file_stream.append(gzip.open(in_file, 'rt') if guessed_mimetype[1] == 'gzip' else open(in_file, 'r'))
+
+    still_reconstructing = True
+    while still_reconstructing:
+        readids_from_streams = list(map(lambda x: x.readline()[:-1], in_file_stream))
+        two = list(map(lambda x: x.readline(), in_file_stream))
+        three = list(map(lambda x: x.readline(), in_file_stream))
+        four = list(map(lambda x: x.readline(), in_file_stream))
+        keep = False
+        for readid in readids_from_streams:
+            if readid == '':
+                still_reconstructing = False
+                break
+            if readid in readids_to_keep or (sequences_only and read_index in readids_to_keep):
+                keep = True
+                break
+        read_index += 1
+        if keep:
+            for fileidx, handleid in enumerate(filehandles):
+                filehandles[handleid].writelines([readids_from_streams[fileidx]+'\n', two[fileidx], three[fileidx], four[fileidx]])
+
+    for s in in_file_stream:
+        s.close()
+    for s in filehandles:
+        filehandles[s].close()
+
+
+def upload_sample(client: httpx.Client, sample: Sample, arguments, buffer_size: int, budget: ByteBudget,
+                  positions: Queue) -> SampleResult:
+    """Upload one sample of a batch into its own context and close it. Runs in a thread of the batch pool."""
+    result = SampleResult(sample)
+    started = time()
+
+    def counted(reads):
+        for corresponding_reads in reads:
+            result.bases += sum(read.bp_count() for read in corresponding_reads)
+            yield corresponding_reads
+
+    # Every running upload gets its own line for the progress bar
+    position = positions.get()
+    progress_bar = tqdm(desc=sample.name, unit=' reads' if len(sample.files) == 1 else ' read pairs', total=0,
+                        position=position, leave=False)
+    try:
+        context = create_context(client, sample.files, arguments.reference, arguments.sequences_only,
+                                 arguments.mapping_preset)
+        if context is None:
+            return result
+        if not submit_chunks(client, context, counted(read_reads_from_files(sample.files)), arguments.count,
+                             buffer_size, arguments.retries, arguments.verbose, progress_bar, arguments.sequences_only,
+                             report=arguments.verbose, budget=budget):
+            return result
+        statistics = close_context(client, context, arguments.verbose, progress_bar)
+        if statistics is None:
+            return result
+    except Exception as e:
+        progress_bar.write(f'{sample.name}: {e}')
+        return result
+    finally:
+        progress_bar.close()
+        positions.put(position)
+        result.seconds = time() - started
+
+    result.status = 'ok'
+    result.reads_kept, result.reads_processed = len(statistics[0]), statistics[1]
+    if arguments.outfolder:
+        reconstruct_files(sample.files, set(statistics[0]), arguments.sequences_only,
+                          os.path.join(arguments.outfolder, sample.name))
+    return result
+
+
+def submit_batch(arguments) -> None:
+    try:
+        samples = read_sample_sheet(arguments.sample_sheet)
+    except (OSError, ValueError) as e:
+        print(f'Could not read the sample sheet: {e}')
+        return
+    missing = [file for sample in samples for file in sample.files if not os.path.isfile(file)]
+    if missing:
+        print(f'The sample sheet lists files that do not exist: {", ".join(missing)}')
+        return
+
+    # One HTTP/2 connection pool for all samples, the uploads are multiplexed over it
+    limits = httpx.Limits(max_connections=arguments.parallel, max_keepalive_connections=arguments.parallel)
+    with httpx.Client(base_url=arguments.server, verify=False, http2=True, limits=limits) as client:
+        mpb: int = get_maximum_pending_bytes(client)
+        if arguments.count is None:
+            arguments.count = mpb // 10
+        budget = ByteBudget(arguments.inflight_bytes if arguments.inflight_bytes is not None else mpb)
+        print(f'Submitting {len(samples)} samples, {arguments.parallel} at a time, with chunks of {arguments.count} '
+              f'basepairs and at most {budget.limit} basepairs in flight')
+
+        positions: Queue = Queue()
+        for position in range(arguments.parallel):
+            positions.put(position)
+        started = time()
+        with ThreadPoolExecutor(max_workers=arguments.parallel) as executor:
+            results = list(executor.map(lambda sample: upload_sample(client, sample, arguments, mpb, budget, positions),
+                                        samples))
+
+    print(f'Submitted {sum(result.status == "ok" for result in results)} of {len(samples)} samples in '
+          f'{time() - started:.1f} seconds')
+    print_summary(results)
+    if arguments.summary:
+        with open(arguments.summary, 'w', newline='') as handle:
+            write_summary(results, handle)
+
+
+def reconstruct_watched_files(watcher: DirectoryWatcher, readids_to_keep: Set[str], outfolder: str) -> None:
+    """Write the kept reads of every watched file to outfolder, keeping the layout below the watched directory."""
+    for filename in watcher.existing_files():
+        relative = os.path.relpath(filename, watcher.directory)
+        split_components = os.path.basename(relative).split('.')
+        new_filename = '.'.join([split_components[0]] + ['filtered'] + split_components[1:])
+        outfile = os.path.join(outfolder, os.path.dirname(relative), new_filename)
+        os.makedirs(os.path.dirname(outfile), exist_ok=True)
+        guessed_mimetype: Tuple[str, str] = mimetypes.guess_type(filename)
+        with gzip.open(outfile, 'wt') if guessed_mimetype[1] == 'gzip' else open(outfile, 'w') as filehandle:
+            try:
+                for read in read_reads_from_file(filename):
+                    if read.barcode in readids_to_keep:
+                        filehandle.write(str(read))
+            except (EOFError, OSError) as e:
+                # Still being written when we stopped watching
+                print(f'Could not read {filename} to the end: {e}')
+
+
+def watch(arguments) -> None:
+    directory = os.path.abspath(arguments.watch)
+    if not os.path.isdir(directory):
+        print(f'{arguments.watch} is not a directory.')
+        return
+
+    watcher = DirectoryWatcher(directory, use_inotify=not arguments.poll)
+    with httpx.Client(base_url=arguments.server, verify=False, http2=True) as client:
+        print(f'Watching {directory} for fastq files'
+              f'{" with inotify" if watcher.uses_inotify else f" every {watcher.poll_interval} seconds"}')
+
+        context = create_context(client, [os.path.basename(directory)], arguments.reference,
+                                 mapping_preset=arguments.mapping_preset)
+        if context is None:
+            return
+        server_info = query_server_status(client)
+        mpb: int = server_info['bufferSize']
+        # Contact the server well before an idle context expires
+        heartbeat_interval: float = server_info['contextTimeout'] / 3
+
+        if arguments.count is None:
+            arguments.count = mpb // 10
+        print(f'The server wants {mpb} bytes max, attempting chunks of {arguments.count} basepairs')
+
+        progress_bar_tm = tqdm(desc=os.path.basename(directory), unit=' reads', total=0, position=0)
+        try:
+            submit_watched_directory(client, context, watcher, arguments, mpb, heartbeat_interval, progress_bar_tm)
+        finally:
+            watcher.close()
+        statistics = close_context(client, context, arguments.verbose, progress_bar_tm)
+        if statistics is not None:
+            progress_bar_tm.write(f'The server saved {len(statistics[0])} of {statistics[1]}. ({long_reads_counter} larger than the server-sided buffer)')
+            progress_bar_tm.close()
+            if arguments.outfolder:
+                print(f'Reconstructing the filtered read files in {arguments.outfolder}')
+                reconstruct_watched_files(watcher, set(statistics[0]), arguments.outfolder)
 
 
 def main() -> None:
     arguments = get_argument_parser().parse_args()
 
+    if arguments.sample_sheet:
+        if arguments.files or arguments.paired or arguments.watch:
+            print('--sample-sheet lists the files of all samples (two for paired-end samples), it does not take '
+                  'files, --paired or --watch.')
+            return
+        submit_batch(arguments)
+        return
+    if arguments.watch:
+        if arguments.files or arguments.paired or arguments.sequences_only:
+            print('--watch uploads all single-end fastq files below the directory, it does not take files, --paired '
+                  'or --sequences-only.')
+            return
+        watch(arguments)
+        return
+    if not arguments.files:
+        print('Please provide the fastq files to submit, or a directory to --watch.')
+        return
+
     if arguments.paired:
         if len(arguments.files) == 1:
             print(f'You chose paired mode, but you provided only one file. Did you mean to just upload one file?')
@@ -302,12 +615,17 @@ def main() -> None:
                   f'non-paired-end files, please upload them separately. Continuing with only the first one.')
             arguments.files = [arguments.files[0]]
 
+    if arguments.sequences_only and not arguments.outfolder:
+        print('In sequences-only mode the server does not keep the filtered reads, without --outfolder you only get '
+              'statistics.')
+
     filenames: List[str] = list(map(lambda x: x, arguments.files))
     with httpx.Client(base_url=arguments.server, verify=False, http2=True) as client:
 
         print(f'Submitting {", ".join(filenames)}{" in paired-end mode" if len(filenames) > 1 else ""}')
 
-        context = create_context(client, filenames)
+        context = create_context(client, filenames, arguments.reference, arguments.sequences_only,
+                                 arguments.mapping_preset)
         mpb: int = get_maximum_pending_bytes(client)
 
         if arguments.count is None:
@@ -319,54 +637,15 @@ def main() -> None:
                             total=0, position = 0)
 
         all_reads = read_reads_from_files(arguments.files)
-        submit_chunks(client, context, all_reads, arguments.count, mpb, arguments.retries, arguments.verbose, progress_bar_tm)
+        submit_chunks(client, context, all_reads, arguments.count, mpb, arguments.retries, arguments.verbose, progress_bar_tm,
+                      arguments.sequences_only)
         statistics = close_context(client, context, arguments.verbose, progress_bar_tm)
         if statistics is not None:
-            progress_bar_tm.write(f'The server saved {len(statistics[0])} of {statistics[1]}. ({long_reads_counter} implicitly filtered due to size)')
+            progress_bar_tm.write(f'The server saved {len(statistics[0])} of {statistics[1]}. ({long_reads_counter} larger than the server-sided buffer)')
             progress_bar_tm.close()
             #Post Processing: If an output folder is given save the reads there
             if arguments.outfolder:
-                print(f'Reconstructing the filtered read files in {arguments.outfolder}')
-                os.makedirs(arguments.outfolder, exist_ok=True)
-
-                filehandles = {}
-                for fileidx, filename in enumerate(filenames):
-                    print(f'Reconstructing the filtered read files for file: {filename}')
-                    guessed_mimetype: Tuple[str, str] = mimetypes.guess_type(filename)
-                    # Generate output folder and create modified (infixed) filename for output
-                    split_components = os.path.basename(filename).split('.')
-                    new_filename = '.'.join([split_components[0]] + ['filtered']+split_components[1:])
-                    outfile = os.path.join(arguments.outfolder, new_filename)
-                    filehandles[fileidx] = gzip.open(outfile, 'wt') if guessed_mimetype[1] == 'gzip' else open(outfile, 'w')
-
-                readids_to_keep: set[str] = set(statistics[0])
-                in_file_stream = []
-                for in_file in arguments.files:
-                    guessed_mimetype: Tuple[str, str] = mimetypes.guess_type(in_file)
-                    in_file_stream.append(gzip.open(in_file, 'rt') if guessed_mimetype[1] == 'gzip' else open(in_file, 'r'))
-
-                still_reconstructing = True
-                while still_reconstructing:
-                    readids_from_streams = list(map(lambda x: x.readline()[:-1], in_file_stream))
-                    two = list(map(lambda x: x.readline(), in_file_stream))
-                    three = list(map(lambda x: x.readline(), in_file_stream))
-                    four = list(map(lambda x: x.readline(), in_file_stream))
-                    keep = False
-                    for readid in readids_from_streams:
-                        if readid == '':
-                            still_reconstructing = False
-                            break
-                        if readid in readids_to_keep:
-                            keep = True
-                            break
-                    if keep:
-                        for fileidx, handleid in enumerate(filehandles):
-                            filehandles[handleid].writelines([readids_from_streams[fileidx]+'\n', two[fileidx], three[fileidx], four[fileidx]])
-
-                for s in in_file_stream:
-                    s.close()
-                for s in filehandles:
-                    filehandles[s].close()
+                reconstruct_files(filenames, set(statistics[0]), arguments.sequences_only, arguments.outfolder)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+import csv
+import os
+from threading import Condition
+from typing import List, Optional, TextIO
+
+
+class Sample:
+    def __init__(self, name: str, files: List[str]) -> None:
+        self.name = name
+        self.files = files
+
+
+def read_sample_sheet(path: str) -> List[Sample]:
+    """
+    Read a sample sheet with one sample per row: the sample name followed by one fastq file, or two for paired-end
+    samples. Columns are separated by tabs or commas, empty lines and lines starting with # are ignored, as is a header
+    row starting with "sample". Relative file paths are relative to the sample sheet.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    samples: List[Sample] = []
+    with open(path, newline='') as handle:
+        lines = [line for line in handle if line.strip() and not line.startswith('#')]
+    if not lines:
+        return samples
+    dialect = csv.excel_tab if '\t' in lines[0] else csv.excel
+    for row_number, row in enumerate(csv.reader(lines, dialect), start=1):
+        row = [column.strip() for column in row if column.strip()]
+        if not row:
+            continue
+        if row_number == 1 and row[0].lower() == 'sample':
+            continue
+        if len(row) < 2:
+            raise ValueError(f'Row {row_number} of {path} has no fastq file: {row}')
+        if any(sample.name == row[0] for sample in samples):
+            raise ValueError(f'The sample {row[0]} is listed twice in {path}.')
+        samples.append(Sample(row[0], [os.path.join(base, file) for file in row[1:]]))
+    return samples
+
+
+class ByteBudget:
+    """
+    Limits the basepairs of all chunks that are on their way to the server at the same time, across all samples, so
+    concurrent uploads share the bandwidth instead of flooding the server with rejected chunks.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        self._condition = Condition()
+
+    def acquire(self, size: int) -> int:
+        # A chunk larger than the whole budget is sent alone
+        size = min(size, self.limit)
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight + size <= self.limit)
+            self.in_flight += size
+        return size
+
+    def release(self, size: int) -> None:
+        with self._condition:
+            self.in_flight -= size
+            self._condition.notify_all()
+
+
+class SampleResult:
+    def __init__(self, sample: Sample) -> None:
+        self.sample = sample
+        self.status = 'failed'
+        self.bases = 0
+        self.seconds = 0.0
+        self.reads_processed: Optional[int] = None
+        self.reads_kept: Optional[int] = None
+
+
+SUMMARY_COLUMNS = ['sample', 'status', 'reads processed', 'reads kept', 'basepairs', 'seconds', 'reads/s', 'Mbp/s']
+
+
+def summary_rows(results: List[SampleResult]) -> List[List[str]]:
+    rows = []
+    for result in results:
+        seconds = max(result.seconds, 1e-9)
+        rows.append([result.sample.name, result.status,
+                     '' if result.reads_processed is None else str(result.reads_processed),
+                     '' if result.reads_kept is None else str(result.reads_kept),
+                     str(result.bases), f'{result.seconds:.1f}',
+                     '' if result.reads_processed is None else f'{result.reads_processed / seconds:.0f}',
+                     f'{result.bases / seconds / 1e6:.2f}'])
+    return rows
+
+
+def print_summary(results: List[SampleResult]) -> None:
+    rows = [SUMMARY_COLUMNS] + summary_rows(results)
+    widths = [max(len(row[column]) for row in rows) for column in range(len(SUMMARY_COLUMNS))]
+    for row in rows:
+        print('  '.join(value.ljust(width) if column == 0 else value.rjust(width)
+                        for column, (value, width) in enumerate(zip(row, widths))))
+
+
+def write_summary(results: List[SampleResult], handle: TextIO) -> None:
+    writer = csv.writer(handle, csv.excel_tab)
+    writer.writerow(SUMMARY_COLUMNS)
+    writer.writerows(summary_rows(results))
@@ -0,0 +1,251 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import zlib
+from time import sleep, time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+FASTQ_SUFFIXES: Tuple[str, ...] = ('.fastq', '.fq', '.fastq.gz', '.fq.gz')
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def is_fastq(path: str) -> bool:
+    return path.endswith(FASTQ_SUFFIXES)
+
+
+class FastqTail:
+    """
+    Follows a (possibly still growing, possibly gzipped) FASTQ file. Every call of read returns the records that were
+    completed since the last call, at most about max_bytes of the file at a time, so memory stays bounded no matter
+    how large the file gets. Gzip members are decompressed incrementally, which also works while MinKNOW still
+    appends to the file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.offset = 0
+        self.records = 0
+        self._gzipped = path.endswith('.gz')
+        self._decompressor = None
+        self._rest = b''
+
+    def _decompress(self, data: bytes) -> bytes:
+        if not self._gzipped:
+            return data
+        output = []
+        while data:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            output.append(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            data = self._decompressor.unused_data
+            self._decompressor = None
+        return b''.join(output)
+
+    def read(self, max_bytes: int) -> Tuple[List[List[str]], bool]:
+        """
+        :return: The new complete records (as lists of four lines) and whether the end of the file was reached.
+        """
+        with open(self.path, 'rb') as handle:
+            handle.seek(self.offset)
+            data = handle.read(max_bytes)
+            at_end = len(data) < max_bytes
+        self.offset += len(data)
+        lines = (self._rest + self._decompress(data)).split(b'\n')
+        # The last record may still be written
+        complete = (len(lines) - 1) // 4 * 4
+        self._rest = b'\n'.join(lines[complete:])
+        records = [[line.decode() for line in lines[start:start + 4]] for start in range(0, complete, 4)]
+        self.records += len(records)
+        return records, at_end
+
+    def finish(self) -> List[List[str]]:
+        """The last record of a file that is complete, if it lacks the final line break."""
+        lines = [line.decode() for line in self._rest.split(b'\n') if line]
+        self._rest = b''
+        if len(lines) != 4:
+            return []
+        self.records += 1
+        return [lines]
+
+
+class DirectoryWatcher:
+    """
+    Reports FASTQ files below a directory that were created or grew. Uses inotify on Linux (through libc, no extra
+    dependency) and falls back to comparing file sizes every poll_interval seconds elsewhere or if inotify fails, e.g.
+    on network file systems.
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 2.0, use_inotify: bool = True) -> None:
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self._sizes: Dict[str, int] = {}
+        self._watches: Dict[int, str] = {}
+        self._fd: Optional[int] = None
+        self._libc = None
+        if use_inotify:
+            self._setup_inotify()
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._fd is not None
+
+    def _setup_inotify(self) -> None:
+        library = ctypes.util.find_library('c')
+        if library is None:
+            return
+        try:
+            libc = ctypes.CDLL(library, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        self._libc, self._fd = libc, fd
+        for root, _, _ in os.walk(self.directory):
+            self._add_watch(root)
+
+    def _add_watch(self, directory: str) -> None:
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+        if wd >= 0:
+            self._watches[wd] = directory
+
+    def existing_files(self) -> List[str]:
+        """All FASTQ files that are already there, oldest first."""
+        files = [os.path.join(root, name) for root, _, names in os.walk(self.directory) for name in names
+                 if is_fastq(name)]
+        return sorted(files, key=lambda path: os.stat(path).st_mtime)
+
+    def changes(self, timeout: float) -> Set[str]:
+        """Wait at most timeout seconds for FASTQ files to be created or to grow and return their paths."""
+        if self._fd is not None:
+            return self._inotify_changes(timeout)
+        return self._polled_changes(timeout)
+
+    def _inotify_changes(self, timeout: float) -> Set[str]:
+        changed: Set[str] = set()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        position = 0
+        while position < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, position)
+            position += _EVENT_HEADER.size
+            name = os.fsdecode(buffer[position:position + length].rstrip(b'\0'))
+            position += length
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_DELETE_SELF:
+                del self._watches[wd]
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # New subdirectory (e.g. a new barcode), files in it may have been written before the watch existed
+                for root, _, _ in os.walk(path):
+                    self._add_watch(root)
+                changed.update(os.path.join(root, file) for root, _, files in os.walk(path) for file in files
+                               if is_fastq(file))
+            elif is_fastq(name):
+                changed.add(path)
+        return changed
+
+    def _polled_changes(self, timeout: float) -> Set[str]:
+        deadline = time() + timeout
+        while True:
+            changed = set()
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    if not is_fastq(name):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        size = os.stat(path).st_size
+                    except FileNotFoundError:
+                        continue
+                    if self._sizes.get(path) != size:
+                        self._sizes[path] = size
+                        changed.add(path)
+            if changed or time() >= deadline:
+                return changed
+            sleep(min(self.poll_interval, max(0.0, deadline - time())))
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def run_finished(directory: str) -> bool:
+    """MinKNOW writes final_summary_*.txt next to the reads once a run is over."""
+    return any(name.startswith('final_summary') and name.endswith('.txt')
+               for _, _, names in os.walk(directory) for name in names)
+
+
+def follow(watcher: DirectoryWatcher, block_size: int, idle_timeout: float,
+           stop_on_final_summary: bool) -> Iterator[Optional[List[List[str]]]]:
+    """
+    Yield batches of new records from all FASTQ files below the watched directory, at most about block_size bytes of
+    a file at a time, until no new data arrived for idle_timeout seconds (never if 0) or the run finished. Yields None
+    whenever the watcher waited without anything new, so the caller can keep its context alive.
+    """
+    tails: Dict[str, FastqTail] = {}
+    broken: Set[str] = set()
+    dirty: List[str] = watcher.existing_files()
+    last_data = time()
+    while True:
+        while dirty:
+            path = dirty.pop(0)
+            if path in broken:
+                continue
+            tail = tails.setdefault(path, FastqTail(path))
+            try:
+                records, at_end = tail.read(block_size)
+            except FileNotFoundError:
+                continue
+            except zlib.error as e:
+                print(f'Skipping the rest of {path}, it is not a valid gzip file: {e}')
+                broken.add(path)
+                continue
+            if not at_end and path not in dirty:
+                # More than one block was added, other files get their turn first
+                dirty.append(path)
+            if records:
+                last_data = time()
+                yield records
+        if stop_on_final_summary and run_finished(watcher.directory):
+            break
+        if idle_timeout > 0 and time() - last_data > idle_timeout:
+            break
+        changed = watcher.changes(min(watcher.poll_interval, idle_timeout) if idle_timeout > 0 else watcher.poll_interval)
+        if not changed:
+            yield None
+        dirty.extend(path for path in sorted(changed) if path not in dirty)
+    # Everything written since the last change, and files that end without a final line break
+    for path, tail in tails.items():
+        if path in broken:
+            continue
+        at_end = False
+        while not at_end:
+            records, at_end = tail.read(block_size)
+            if at_end:
+                records += tail.finish()
+            if records:
+                yield records